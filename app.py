@@ -1,912 +1,6582 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, send_file
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.sansio.multipart import (
+    MultipartDecoder, NeedData, Epilogue, Field, File, Data
+)
 import sqlite3
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import json
+import base64
+import errno
+import hashlib
+import hmac
+import io
 import mimetypes
-from flask import session
+import zipfile
+from flask import session, g, has_app_context
 import secrets
 import re
 import os
+import shutil
+import sys
+import tempfile
+import random
+import threading
+import time
+import uuid
+import queue
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeout
+from datetime import datetime
+from stat import S_ISREG
+from urllib.parse import quote, unquote
+from PIL import Image, ImageOps
 
 app = Flask(__name__)
 
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "CHANGE_ME_IN_PROD")  
 
 
-@app.before_request
-def validate_logged_in_user():
+# METRICS
+#
+# Counters and histograms kept in the process and served by /metrics in
+# the Prometheus text format: latency per endpoint and requests in flight,
+# S3 calls / errors / latency / object bytes per operation (recorded by the
+# S3 wrapper), SQLite statements and the time spent executing them, and the
+# size of the drive trees sent by and posted to /api/drive. Job queue,
+# ledger and pool gauges are read when /metrics is scraped. Recording is a
+# bisect and a few additions under one lock, cheap enough to leave on.
+#
+# /metrics answers admins, or a scraper sending MINIDRIVE_METRICS_TOKEN as
+# a bearer token. Each worker process has its own numbers.
 
-    # allow public routes
-    if request.endpoint and request.endpoint in ("login", "signup", "static", "check_username"):
-        return None
+METRICS_TOKEN = os.environ.get("MINIDRIVE_METRICS_TOKEN")
 
-    if "user" not in session:
-        return redirect(url_for("login"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))      # 1 KB .. 256 MB
 
-    db = get_db()
-    cursor = db.cursor()
+metrics_lock = threading.Lock()
+registered_metrics = []     # in /metrics order
 
-    cursor.execute(
-        "SELECT id FROM users WHERE username=?",
-        (session["user"],)
+
+def metric_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
     )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
 
-    user = cursor.fetchone()
-    db.close()
 
-    if not user:
-        session.clear()
-        return redirect(url_for("login"))
+def metric_value(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
 
 
-    # User deleted but session exists
-    if not user:
+class Metric:
+    """A counter or gauge, one value per combination of label values."""
 
-        session.clear()   
+    def __init__(self, name, kind, help, labels=()):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        registered_metrics.append(self)
 
-        return redirect(url_for("login"))
+    def inc(self, *labels, amount=1):
+        with metrics_lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
 
+    def set(self, value, *labels):
+        with metrics_lock:
+            self.values[labels] = value
 
-# S3 CONFIG 
-BUCKET_NAME = "gourab-gdrive"
-REGION = "ap-south-1"
+    def clear(self):
+        with metrics_lock:
+            self.values.clear()
 
-s3 = boto3.client("s3", region_name=REGION)
+    def render(self):
+        with metrics_lock:
+            values = sorted(self.values.items())
 
-#  DATABASE 
-DB_FILE = "database.db"
+        return [
+            f"{self.name}{metric_labels(self.labels, labels)} {metric_value(value)}"
+            for labels, value in values
+        ]
 
 
-def get_db():
-    return sqlite3.connect(DB_FILE)
+class Histogram(Metric):
 
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, "histogram", help, labels)
+        self.buckets = buckets
 
-#INIT DRIVE TABLE 
+    def observe(self, value, *labels):
+        slot = bisect_left(self.buckets, value)
 
-def init_drive():
+        with metrics_lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0]
 
-    db = get_db()
-    c = db.cursor()
+            series[0][slot] += 1
+            series[1] += value
 
-    # USERS
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE,
-            password TEXT,
-            role TEXT DEFAULT 'user'
-        )
-    """)
+    def render(self):
+        with metrics_lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.values.items())
 
-    # DRIVE (per user)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS drive (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE,
-            data TEXT
-        )
-    """)
+        lines = []
 
-    db.commit()
-    db.close()
+        for labels, (counts, total) in values:
+            seen = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                seen += count
+                le = metric_labels(self.labels, labels, [("le", metric_value(bound) if bound != "+Inf" else bound)])
+                lines.append(f"{self.name}_bucket{le} {seen}")
 
+            lines.append(f"{self.name}_sum{metric_labels(self.labels, labels)} {metric_value(total)}")
+            lines.append(f"{self.name}_count{metric_labels(self.labels, labels)} {seen}")
 
+        return lines
 
-init_drive()
 
+def render_metrics():
+    lines = []
 
-def load_data():
+    for metric in registered_metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines += metric.render()
 
-    username = session.get("user")
+    return "\n".join(lines) + "\n"
 
-    db = get_db()
-    c = db.cursor()
 
-    row = c.execute(
-        "SELECT data FROM drive WHERE username=?",
-        (username,)
-    ).fetchone()
+http_in_flight = Metric("minidrive_http_requests_in_flight", "gauge", "Requests being handled.")
+http_seconds = Histogram(
+    "minidrive_http_request_duration_seconds", "Time to a response, per endpoint.",
+    ("endpoint", "method", "status")
+)
 
-    #  Auto create drive if missing
-    if not row:
+s3_calls = Metric("minidrive_s3_requests_total", "counter", "S3 calls per operation.", ("operation",))
+s3_errors = Metric("minidrive_s3_errors_total", "counter", "S3 calls that failed.", ("operation",))
+s3_seconds = Histogram(
+    "minidrive_s3_request_duration_seconds", "S3 call latency, retries included.", ("operation",)
+)
+s3_bytes = Metric(
+    "minidrive_s3_bytes_total", "counter", "Object bytes sent to or read from S3.", ("operation",)
+)
+s3_in_flight = Metric("minidrive_s3_requests_in_flight", "gauge", "S3 calls running.")
+s3_timeouts = Metric("minidrive_s3_timeouts_total", "counter", "S3 calls past their deadline.")
 
-        empty_drive = {
-            "root": {},
-            "trash": {},
-            "recent": []
-        }
+db_queries = Metric(
+    "minidrive_db_queries_total", "counter", "SQLite statements run, per statement.", ("statement",)
+)
+db_seconds = Metric(
+    "minidrive_db_query_seconds_total", "counter",
+    "Time in execute() calls (a SELECT's later rows are read on fetch).", ("statement",)
+)
+db_pool_idle = Metric("minidrive_db_pool_idle_connections", "gauge", "Pooled SQLite connections not in use.")
 
-        c.execute(
-            "INSERT INTO drive (username, data) VALUES (?, ?)",
-            (username, json.dumps(empty_drive))
-        )
+drive_body_bytes = Histogram(
+    "minidrive_drive_body_bytes", "Drive trees built for (load) and posted to (save) /api/drive.",
+    ("op",), SIZE_BUCKETS
+)
+drive_cache_size = Metric("minidrive_drive_cache_bytes", "gauge", "Serialized drive trees cached.")
 
-        db.commit()
-        db.close()
+jobs_waiting = Metric("minidrive_jobs", "gauge", "Queued and running background jobs.", ("kind", "state"))
+storage_bytes = Metric("minidrive_storage_bytes", "gauge", "Storage pool ledger.", ("kind",))
 
-        return empty_drive
 
-    db.close()
+# statement kind ("SELECT", "INSERT", "WITH"...) per SQL string
+statement_kinds = {}
 
-    return json.loads(row[0])
 
+def record_query(sql, seconds):
+    kind = statement_kinds.get(sql)
 
-def save_data(data):
+    if kind is None:
+        words = sql.split(None, 1)
+        kind = words[0].upper() if words else "?"
+        if len(statement_kinds) < 10000:
+            statement_kinds[sql] = kind
 
-    username = session.get("user")
+    with metrics_lock:
+        db_queries.values[(kind,)] = db_queries.values.get((kind,), 0) + 1
+        db_seconds.values[(kind,)] = db_seconds.values.get((kind,), 0) + seconds
 
-    db = get_db()
-    c = db.cursor()
 
-    c.execute(
-        "UPDATE drive SET data=? WHERE username=?",
-        (json.dumps(data), username)
-    )
+def metrics_token_valid():
+    header = request.headers.get("Authorization", "")
+    return bool(METRICS_TOKEN) and hmac.compare_digest(header, f"Bearer {METRICS_TOKEN}")
 
-    db.commit()
-    db.close()
 
-#Add helper functions for validation
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    http_in_flight.inc()
 
-def update_drive_key(data, old_key, new_key):
-    def recurse(folder):
-        for k in list(folder.keys()):
-            if k == old_key:
-                folder[new_key] = folder.pop(k)
-                return True
-            if isinstance(folder[k], dict):
-                if recurse(folder[k]):
-                    return True
-        return False
 
-    recurse(data["root"])
+@app.after_request
+def record_request_metrics(response):
+    started = g.get("metrics_started")
 
+    if started is not None:
+        http_seconds.observe(
+            time.perf_counter() - started,
+            request.endpoint or "none", request.method, str(response.status_code)
+        )
 
+    return response
 
-#username validation function
-def validate_username(username):
-    # length: min 3, max 12
-    if not 3 <= len(username) <= 12:
-        return "Username must be between 3 and 12 characters."
 
-    # allowed characters only (no spaces)
-    if not re.fullmatch(r"[A-Za-z0-9@#&]+", username):
-        return "Only letters, numbers and @ # & are allowed."
+@app.teardown_request
+def end_request_metrics(exc):
+    if g.pop("metrics_started", None) is not None:
+        http_in_flight.inc(amount=-1)
 
-    # only one special character allowed
-    specials = re.findall(r"[@#&]", username)
-    if len(specials) > 1:
-        return "Only one special character (@, #, &) is allowed."
 
+# SESSION CACHE
+#
+# Users whose session was checked against the database recently, so most
+# requests skip the SELECT. Deleting a user (or changing a role) must call
+# invalidate_user_session() so it takes effect on the next request.
+#
+# The cache is per process and invalidation only reaches the process that
+# made the change: under several workers, another one keeps accepting a
+# deleted user (or an old role) until its entry expires. So it is off
+# (TTL 0) unless MINIDRIVE_SESSION_CACHE_TTL opts in, which is safe with a
+# single process and otherwise bounds that window by the TTL.
+
+SESSION_CACHE_TTL = float(os.environ.get("MINIDRIVE_SESSION_CACHE_TTL", "0"))
+SESSION_CACHE_MAX = 10000
+
+session_cache = {}      # username -> (role, expires_at)
+session_cache_lock = threading.Lock()
+
+
+def cached_session_role(username):
+    entry = session_cache.get(username)
+    if entry and entry[1] > time.monotonic():
+        return entry[0]
     return None
 
 
+def remember_session(username, role):
+    if SESSION_CACHE_TTL <= 0:
+        return
 
-#password validation function
+    now = time.monotonic()
 
-def validate_password(password):
-    if len(password) < 4:
-        return "Password must be at least 4 characters long."
+    with session_cache_lock:
+        if len(session_cache) >= SESSION_CACHE_MAX:
+            for name, (_, expires) in list(session_cache.items()):
+                if expires <= now:
+                    del session_cache[name]
 
-    if not re.search(r"[A-Za-z]", password):
-        return "Password must contain at least one letter."
+        if len(session_cache) < SESSION_CACHE_MAX:
+            session_cache[username] = (role, now + SESSION_CACHE_TTL)
 
-    if not re.search(r"[0-9]", password):
-        return "Password must contain at least one number."
 
-    if not re.search(r"[@#&!$%^*]", password):
-        return "Password must contain at least one special character."
+def invalidate_user_session(username):
+    with session_cache_lock:
+        session_cache.pop(username, None)
 
-    return None
 
+@app.before_request
+def validate_logged_in_user():
 
+    # allow public routes
+    if request.endpoint and request.endpoint in ("login", "signup", "static", "check_username", "serve_object"):
+        return None
 
-# ROUTES 
+    # the Prometheus scraper has a token, not a session
+    if request.endpoint == "metrics" and metrics_token_valid():
+        return None
 
-@app.route("/")
-def home():
-    return redirect(url_for("login"))
+    if "user" not in session:
+        return redirect(url_for("login"))
 
-@app.route("/signup", methods=["GET", "POST"])
-def signup():
-    if request.method == "POST":
+    role = cached_session_role(session["user"])
 
-        db = None
+    if role is None:
+        db = get_db()
+        cursor = db.cursor()
 
-        try:
-            username = request.form.get("username", "").strip()
-            password_raw = request.form.get("password", "")
+        cursor.execute(
+            "SELECT id, role FROM users WHERE username=?",
+            (session["user"],)
+        )
 
-            #  Validate username format
-            username_error = validate_username(username)
-            if username_error:
-                flash(username_error, "signup_error")
-                return redirect(url_for("signup"))
+        user = cursor.fetchone()
+        db.close()
 
-            #  Validate Password
-            password_error = validate_password(password_raw)
-            if password_error:
-                flash(password_error, "signup_error")
-                return redirect(url_for("signup"))
+        # User deleted but session exists
+        if not user:
+            session.clear()
+            return redirect(url_for("login"))
 
-            db = get_db()
-            cursor = db.cursor()
+        role = user[1]
+        remember_session(session["user"], role)
 
-            # Check username exists
-            cursor.execute(
-                "SELECT 1 FROM users WHERE username = ?",
-                (username,)
-            )
-            if cursor.fetchone():
-                flash("Username already exists", "signup_error")
-                return redirect(url_for("signup"))
+    # role changed since login
+    if session.get("role") != role:
+        session["role"] = role
 
-            password = generate_password_hash(password_raw)
 
-            cursor.execute(
-                "INSERT INTO users (username, password) VALUES (?, ?)",
-                (username, password)
-            )
+# S3 CONFIG 
+BUCKET_NAME = "gourab-gdrive"
+REGION = "ap-south-1"
 
-            empty_drive = {
-                "root": {},
-                "trash": {},
-                "recent": []
-            }
+# S3 CLIENT
+#
+# Every S3 call in this file goes through `s3`, a wrapper around a single
+# boto3 client (or LocalStorage, see below) with the same method names. The client gets a connection
+# pool big enough for the thread pools below (batch uploads, copies, ZIP
+# prefetch and scans all call S3 in parallel), adaptive retries (it backs
+# off by itself when S3 throttles) and short connect / read timeouts.
+#
+# Calls run on one bounded executor: at most S3_MAX_IN_FLIGHT at a time,
+# each with a deadline for the whole call, retries included. When S3 is
+# slow, requests get slower and then fail with S3Unavailable (a 503),
+# instead of every worker thread hanging on a socket. s3.submit() starts
+# a call without waiting for it. Presigning is local and passed through.
 
-            cursor.execute(
-                "INSERT INTO drive (username, data) VALUES (?, ?)",
-                (username, json.dumps(empty_drive))
-            )
+S3_POOL = int(os.environ.get("MINIDRIVE_S3_POOL", "64"))
+S3_MAX_IN_FLIGHT = int(os.environ.get("MINIDRIVE_S3_MAX_IN_FLIGHT", str(S3_POOL)))
+S3_ATTEMPTS = int(os.environ.get("MINIDRIVE_S3_ATTEMPTS", "5"))
+S3_CONNECT_TIMEOUT = 5
+S3_READ_TIMEOUT = 30
+S3_DEADLINE = float(os.environ.get("MINIDRIVE_S3_DEADLINE", "60"))
 
-            db.commit()
+# calls that carry (or copy) up to a whole part get longer
+S3_SLOW_CALLS = {
+    "put_object", "upload_part", "copy_object", "upload_part_copy",
+    "complete_multipart_upload", "delete_objects",
+}
+S3_SLOW_DEADLINE = S3_DEADLINE * 5
 
-            flash("Account created successfully. Please login.")
-            return redirect(url_for("login"))
 
-        except Exception as e:
-            print("Signup error:", e)
-            flash("Something went wrong. Please try again.")
-            return redirect(url_for("signup"))
+class S3Unavailable(Exception):
+    """S3 didn't answer within the deadline, or too many calls are waiting."""
 
-        finally:
-            if db:
-                db.close()
 
-    return render_template("login.html")
+class S3Paginator:
+    """list_objects_v2 pages, each page fetched through the wrapper."""
 
+    def __init__(self, client):
+        self.client = client
 
+    def paginate(self, **kwargs):
+        while True:
+            page = self.client.call("list_objects_v2", **kwargs)
+            yield page
 
-#Login Route
-@app.route("/login", methods=["GET", "POST"])
-def login():
+            if not page.get("IsTruncated"):
+                return
 
-    if request.method == "POST":
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
 
-        username = request.form["username"]
-        password = request.form["password"]
 
-        db = get_db()
-        cursor = db.cursor()
+class S3Client:
 
-        user = cursor.execute(
-            "SELECT * FROM users WHERE username=?", (username,)
-        ).fetchone()
+    def __init__(self, client):
+        self.client = client
+        self.exceptions = client.exceptions
 
-        db.close()   
+        self.slots = threading.BoundedSemaphore(S3_MAX_IN_FLIGHT)
+        self.pool = ThreadPoolExecutor(max_workers=S3_MAX_IN_FLIGHT, thread_name_prefix="s3")
 
-        if user and check_password_hash(user[2], password):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.timeouts = 0
+        self.ops = {}        # operation -> [calls, errors, seconds]
 
-            session["user"] = user[1]
-            session["role"] = user[3]     # role
-            return redirect(url_for("dashboard"))
+    def deadline(self, operation):
+        return S3_SLOW_DEADLINE if operation in S3_SLOW_CALLS else S3_DEADLINE
 
-        else:
-            flash("Invalid credentials")
-            return redirect(url_for("login"))
+    def submit(self, operation, **kwargs):
+        """Start one call, returns its Future (pass it to result())."""
 
-    return render_template("login.html")
+        deadline = self.deadline(operation)
 
-# LOGOUT ROUTE 
-@app.route("/logout")
-def logout():
-    session.pop("user", None)
-    return redirect(url_for("login"))
+        if not self.slots.acquire(timeout=deadline):
+            with self.lock:
+                self.timeouts += 1
+            raise S3Unavailable(f"{operation}: {S3_MAX_IN_FLIGHT} S3 calls in flight")
 
+        started = time.perf_counter()
 
-#check username
-@app.route("/api/check-username")
-def check_username():
-    username = request.args.get("username", "").strip()
+        body = kwargs.get("Body")
+        sent = len(body) if isinstance(body, (bytes, bytearray)) else 0
 
-    if not username:
-        return jsonify({"exists": False})
+        with self.lock:
+            self.in_flight += 1
 
-    db = get_db()
-    cursor = db.cursor()
+        def finished(future):
+            failed = future.cancelled() or future.exception() is not None
 
-    cursor.execute(
-        "SELECT 1 FROM users WHERE username = ?",
-        (username,)
-    )
-    exists = cursor.fetchone() is not None
+            received = 0
+            if not failed and operation == "get_object":
+                received = future.result().get("ContentLength", 0)
 
-    db.close()
+            with self.lock:
+                self.in_flight -= 1
 
-    return jsonify({"exists": exists})
+            self.record(operation, time.perf_counter() - started, failed, sent + received)
+            self.slots.release()
 
+        try:
+            future = self.pool.submit(getattr(self.client, operation), **kwargs)
+        except BaseException:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+            raise
 
+        future.operation = operation
+        future.add_done_callback(finished)
+        return future
 
-# Dashboard route
-@app.route("/dashboard")
-def dashboard():
+    def result(self, future):
+        """Wait for a submitted call, up to its deadline."""
 
-    if not session.get("user"):
-        return redirect(url_for("login"))
+        deadline = self.deadline(future.operation)
 
-    return render_template(
-        "dashboard.html",
-        username=session["user"]
+        try:
+            return future.result(timeout=deadline)
+        except FutureTimeout:
+            with self.lock:
+                self.timeouts += 1
+            raise S3Unavailable(f"{future.operation}: no answer in {deadline:g}s")
+
+    def call(self, operation, **kwargs):
+        return self.result(self.submit(operation, **kwargs))
+
+    def record(self, operation, seconds, failed, nbytes=0):
+        """Count a finished call (also for calls made around the pool)."""
+
+        with self.lock:
+            stat = self.ops.setdefault(operation, [0, 0, 0.0])
+            stat[0] += 1
+            stat[1] += failed
+            stat[2] += seconds
+
+        s3_calls.inc(operation)
+        s3_seconds.observe(seconds, operation)
+
+        if failed:
+            s3_errors.inc(operation)
+        if nbytes:
+            s3_bytes.inc(operation, amount=nbytes)
+
+    def get_paginator(self, operation):
+        if operation != "list_objects_v2":
+            raise ValueError(f"no paginator for {operation}")
+        return S3Paginator(self)
+
+    def generate_presigned_url(self, *args, **kwargs):
+        return self.client.generate_presigned_url(*args, **kwargs)
+
+    def generate_presigned_post(self, *args, **kwargs):
+        return self.client.generate_presigned_post(*args, **kwargs)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "in_flight": self.in_flight,
+                "timeouts": self.timeouts,
+                "ops": {op: list(stat) for op, stat in self.ops.items()}
+            }
+
+    def __getattr__(self, operation):
+        # s3.put_object(...) etc.: any other client method, as a call
+        if operation.startswith("_"):
+            raise AttributeError(operation)
+        return lambda **kwargs: self.call(operation, **kwargs)
+
+
+# LOCAL STORAGE
+#
+# MINIDRIVE_STORAGE=local keeps the objects on disk under
+# MINIDRIVE_STORAGE_DIR instead of in S3: on-prem installs, and running
+# (or benchmarking) without AWS. The backend boundary is the set of S3
+# calls this file makes: LocalStorage answers the same subset (put,
+# streaming get, head, list, copy, delete, multipart, presign) with the
+# same response shapes and ClientError codes, and sits behind the same
+# `s3` wrapper, so nothing above it knows which one it talks to.
+#
+# Key "alice/3f2a..." is the file <dir>/alice/3f2a... . Writes go to a temp
+# file under <dir>/.minidrive, fdatasync'd every LOCAL_SYNC_BYTES so dirty
+# pages never pile up, fsynced and renamed into place: readers see the old
+# object or the whole new one. Objects are only ever replaced, never
+# changed in place, so copies are hard links and the parts of a multipart
+# upload are joined with copy_file_range, without the bytes going through
+# Python. Content types aren't stored, they come from the nodes.
+#
+# Presigned URLs point at /storage/<key>, signed with the app's secret
+# key; without a signature /storage/<key> serves the logged-in user's own
+# files. Files go out through send_file: conditional GETs, Range requests,
+# and the WSGI server's sendfile (wsgi.file_wrapper) for whole files. With
+# MINIDRIVE_X_SENDFILE=1 only an X-Sendfile header is sent and the front
+# server (Apache mod_xsendfile, lighttpd) sends the file itself.
+# /api/upload/initiate always answers "proxy" with this backend: uploads
+# go through Flask.
+
+STORAGE_BACKEND = os.environ.get("MINIDRIVE_STORAGE", "s3")
+STORAGE_DIR = os.path.abspath(os.environ.get("MINIDRIVE_STORAGE_DIR", "storage"))
+LOCAL_WORK_DIR = ".minidrive"     # temp files and multipart parts, not listed
+LOCAL_URL = "/storage/"
+LOCAL_SYNC_BYTES = int(os.environ.get("MINIDRIVE_LOCAL_SYNC_MB", "32")) * 1024 * 1024
+
+app.use_x_sendfile = os.environ.get("MINIDRIVE_X_SENDFILE", "0") == "1"
+
+if STORAGE_BACKEND not in ("s3", "local"):
+    sys.exit(f"MINIDRIVE_STORAGE must be s3 or local, not {STORAGE_BACKEND!r}")
+
+
+def local_error(code, operation, key):
+    status = 404 if code in ("404", "NoSuchKey", "NoSuchUpload") else 400
+    if code == "PreconditionFailed":
+        status = 412
+
+    return ClientError(
+        {
+            "Error": {"Code": code, "Message": key},
+            "ResponseMetadata": {"HTTPStatusCode": status}
+        },
+        operation
     )
 
 
-#admin dashboard route
-def get_user_storage(username):
+def local_etag(st):
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
 
-    total_bytes = 0
 
-    paginator = s3.get_paginator('list_objects_v2')
+def local_chunks(body, chunk_size=1024 * 1024):
+    """Body as chunks: bytes, a file-like object or an iterable of bytes."""
 
-    for page in paginator.paginate(
-        Bucket=BUCKET_NAME,
-        Prefix=f"{username}/"
-    ):
-        if "Contents" in page:
-            for obj in page["Contents"]:
-                total_bytes += obj["Size"]
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        yield body
+    elif hasattr(body, "read"):
+        yield from iter(lambda: body.read(chunk_size), b"")
+    else:
+        yield from body
 
-    return round(total_bytes / (1024 * 1024), 2)
 
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
 
 
-@app.route("/admin")
-def admin_panel():
+def copy_fd_range(src_fd, dst_fd, offset, length):
+    """Append length bytes of src_fd (from offset) to dst_fd. In the kernel
+    with copy_file_range where the platform and filesystem allow it."""
 
-    if "user" not in session:
-        return redirect(url_for("login"))
+    kernel = hasattr(os, "copy_file_range")
 
-    if session.get("role") != "admin":
-        return "Access Denied", 403
+    while length > 0:
+        if kernel:
+            try:
+                n = os.copy_file_range(src_fd, dst_fd, min(length, 1 << 30), offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                kernel = False
+                continue
+        else:
+            data = os.pread(src_fd, min(length, 1024 * 1024), offset)
+            write_all(dst_fd, data)
+            n = len(data)
 
-    db = get_db()
-    cursor = db.cursor()   
+        if n == 0:
+            raise OSError(errno.EIO, "source shorter than the range copied")
 
-    users_raw = cursor.execute(
-        "SELECT id, username, role FROM users"
-    ).fetchall()
+        offset += n
+        length -= n
 
-    users = []
 
-    for u in users_raw:
-        storage = get_user_storage(u[1])
+class LocalBody:
+    """get_object's Body for a file: read() / iter_chunks(), closed at EOF."""
 
-        users.append({
-            "id": u[0],
-            "username": u[1],
-            "role": u[2],
-            "storage": storage
-        })
+    def __init__(self, f):
+        self.f = f
 
-    db.close()
+    def read(self, amt=None):
+        data = self.f.read() if amt is None else self.f.read(amt)
+        if amt is None or not data:
+            self.close()
+        return data
 
-    return render_template("admin.html", users=users)
+    def iter_chunks(self, chunk_size=1024 * 1024):
+        try:
+            yield from iter(lambda: self.f.read(chunk_size), b"")
+        finally:
+            self.close()
 
-# delete user route
-def delete_user_s3_folder(username):
+    def close(self):
+        self.f.close()
 
-    if not username:
-        raise ValueError("Invalid username — refusing to delete.")
 
+class LocalStorageErrors:
+    ClientError = ClientError
 
-    paginator = s3.get_paginator("list_objects_v2")
-    deleted = False
 
-    for page in paginator.paginate(
-        Bucket=BUCKET_NAME,
-        Prefix=f"{username}/"
-    ):
+class LocalStorage:
+    """The S3 calls MiniDrive makes, on a local directory."""
 
-        if "Contents" in page:
+    exceptions = LocalStorageErrors
 
-            objects = [{"Key": obj["Key"]} for obj in page["Contents"]]
+    def __init__(self, root):
+        self.root = root
+        self.tmp = os.path.join(root, LOCAL_WORK_DIR, "tmp")
+        self.uploads = os.path.join(root, LOCAL_WORK_DIR, "uploads")
 
-            s3.delete_objects(
-                Bucket=BUCKET_NAME,
-                Delete={"Objects": objects}
-            )
+        os.makedirs(self.tmp, exist_ok=True)
+        os.makedirs(self.uploads, exist_ok=True)
 
-            deleted = True
+    def path(self, key):
+        parts = key.split("/")
 
-    return deleted
+        if (
+            any(part in ("", ".", "..") for part in parts)
+            or parts[0] == LOCAL_WORK_DIR
+            or "\0" in key
+        ):
+            raise local_error("InvalidArgument", "Key", key)
+
+        return os.path.join(self.root, *parts)
+
+    # writing
+
+    def new_file(self):
+        return tempfile.mkstemp(dir=self.tmp)
+
+    def place(self, tmp, dst):
+        """Rename a finished temp file over dst, durably."""
+
+        folder = os.path.dirname(dst)
+
+        # a delete may prune the (then empty) folder in between
+        for attempt in range(3):
+            os.makedirs(folder, exist_ok=True)
+            try:
+                os.replace(tmp, dst)
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+        fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def store(self, dst, fill):
+        """Write a temp file with fill(fd), fsync it and move it to dst.
+        Returns the file's stat."""
+
+        fd, tmp = self.new_file()
+
+        try:
+            try:
+                fill(fd)
+                os.fsync(fd)
+                st = os.fstat(fd)
+            finally:
+                os.close(fd)
+
+            self.place(tmp, dst)
+
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+        return st
+
+    def write_body(self, dst, body):
+        sync = getattr(os, "fdatasync", os.fsync)
+
+        def fill(fd):
+            unsynced = 0
+
+            for chunk in local_chunks(body):
+                write_all(fd, chunk)
+                unsynced += len(chunk)
+
+                if unsynced >= LOCAL_SYNC_BYTES:
+                    sync(fd)
+                    unsynced = 0
+
+        return self.store(dst, fill)
+
+    def prune(self, folder):
+        """Remove folders left empty by a delete, up to the root."""
+
+        while folder != self.root and folder.startswith(self.root):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                return
+            folder = os.path.dirname(folder)
+
+    # objects
+
+    def create_bucket(self, **kwargs):
+        os.makedirs(self.root, exist_ok=True)
+        return {}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        try:
+            st = os.stat(self.path(Key))
+        except (FileNotFoundError, NotADirectoryError):
+            raise local_error("404", "HeadObject", Key)
+
+        if not S_ISREG(st.st_mode):
+            raise local_error("404", "HeadObject", Key)
+
+        return {"ContentLength": st.st_size, "ETag": local_etag(st)}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        try:
+            f = open(self.path(Key), "rb")
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            raise local_error("NoSuchKey", "GetObject", Key)
+
+        st = os.fstat(f.fileno())
+
+        return {"Body": LocalBody(f), "ContentLength": st.st_size, "ETag": local_etag(st)}
+
+    def put_object(self, Bucket, Key, Body=b"", **kwargs):
+        st = self.write_body(self.path(Key), Body)
+        return {"ETag": local_etag(st)}
+
+    def copy_object(self, Bucket, CopySource, Key, CopySourceIfMatch=None, **kwargs):
+        src = self.path(CopySource["Key"])
+        tmp = os.path.join(self.tmp, uuid.uuid4().hex)
+
+        try:
+            try:
+                os.link(src, tmp)
+            except (FileNotFoundError, NotADirectoryError):
+                raise local_error("NoSuchKey", "CopyObject", CopySource["Key"])
+            except OSError:
+                # no hard links here (another filesystem, FAT...)
+                shutil.copyfile(src, tmp)
+                fd = os.open(tmp, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+            # checked on the linked file: whatever replaces src now can't matter
+            st = os.stat(tmp)
+            if CopySourceIfMatch and local_etag(st) != CopySourceIfMatch:
+                raise local_error("PreconditionFailed", "CopyObject", CopySource["Key"])
+
+            self.place(tmp, self.path(Key))
+
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+        return {"CopyObjectResult": {"ETag": local_etag(st)}}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        path = self.path(Key)
+
+        try:
+            os.remove(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return {}
+
+        self.prune(os.path.dirname(path))
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        deleted, errors = [], []
+
+        for obj in Delete["Objects"]:
+            try:
+                self.delete_object(Bucket=Bucket, Key=obj["Key"])
+                deleted.append({"Key": obj["Key"]})
+            except (ClientError, OSError) as e:
+                errors.append({"Key": obj["Key"], "Code": "InternalError", "Message": str(e)})
+
+        resp = {"Errors": errors} if errors else {}
+        if not Delete.get("Quiet"):
+            resp["Deleted"] = deleted
+
+        return resp
+
+    # listing
+
+    def list_objects_v2(
+        self, Bucket, Prefix="", Delimiter=None, StartAfter="",
+        ContinuationToken=None, MaxKeys=1000, **kwargs
+    ):
+        if Delimiter not in (None, "/"):
+            raise local_error("InvalidArgument", "ListObjectsV2", Delimiter)
+
+        start = ContinuationToken or StartAfter or ""
+        base = Prefix.rpartition("/")[0]
+        folder = self.path(base) if base else self.root
+
+        contents, prefixes = [], []
+        truncated = False
+        last = None
+
+        for key, st in self.walk(folder, base + "/" if base else "", Prefix, Delimiter, start):
+            if len(contents) + len(prefixes) >= MaxKeys:
+                truncated = True
+                break
+
+            if st is None:
+                prefixes.append({"Prefix": key})
+            else:
+                contents.append({"Key": key, "Size": st.st_size, "ETag": local_etag(st)})
+
+            last = key
+
+        page = {
+            "Prefix": Prefix,
+            "KeyCount": len(contents) + len(prefixes),
+            "MaxKeys": MaxKeys,
+            "IsTruncated": truncated
+        }
+
+        if contents:
+            page["Contents"] = contents
+        if prefixes:
+            page["CommonPrefixes"] = prefixes
+        if truncated:
+            page["NextContinuationToken"] = last
+
+        return page
+
+    def walk(self, folder, key_prefix, prefix, delimiter, start):
+        """(key, stat) in S3's order, (common prefix, None) with a
+        delimiter. Folders that sort wholly before start aren't opened."""
+
+        try:
+            entries = list(os.scandir(folder))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+
+        named = []
+
+        for entry in entries:
+            if not key_prefix and entry.name == LOCAL_WORK_DIR:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                named.append((entry.name + "/", entry))
+            elif entry.is_file(follow_symlinks=False):
+                named.append((entry.name, entry))
+
+        # "a/" sorts after "a-b" and "a.txt", like the keys inside it do
+        named.sort(key=lambda n: n[0])
+
+        for name, entry in named:
+            key = key_prefix + name
+
+            if not name.endswith("/"):
+                if key.startswith(prefix) and key > start:
+                    yield key, entry.stat(follow_symlinks=False)
+                continue
+
+            if not (key.startswith(prefix) or prefix.startswith(key)):
+                continue
+
+            if delimiter and key.startswith(prefix):
+                if key > start:
+                    yield key, None
+                continue
+
+            if key <= start and not start.startswith(key):
+                continue
+
+            yield from self.walk(entry.path, key, prefix, delimiter, start)
+
+    # multipart
+
+    def upload_dir(self, upload_id, operation):
+        folder = os.path.join(self.uploads, str(upload_id))
+
+        if not re.fullmatch(r"[0-9a-f]{32}", str(upload_id)) or not os.path.isdir(folder):
+            raise local_error("NoSuchUpload", operation, str(upload_id))
+
+        return folder
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.path(Key)
+
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.uploads, upload_id))
+
+        return {"Bucket": Bucket, "Key": Key, "UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        folder = self.upload_dir(UploadId, "UploadPart")
+        st = self.write_body(os.path.join(folder, str(PartNumber)), Body)
+
+        return {"ETag": local_etag(st)}
+
+    def upload_part_copy(
+        self, Bucket, Key, UploadId, PartNumber, CopySource,
+        CopySourceRange=None, CopySourceIfMatch=None, **kwargs
+    ):
+        folder = self.upload_dir(UploadId, "UploadPartCopy")
+
+        try:
+            src = os.open(self.path(CopySource["Key"]), os.O_RDONLY)
+        except (FileNotFoundError, NotADirectoryError):
+            raise local_error("NoSuchKey", "UploadPartCopy", CopySource["Key"])
+
+        try:
+            st = os.fstat(src)
+            if CopySourceIfMatch and local_etag(st) != CopySourceIfMatch:
+                raise local_error("PreconditionFailed", "UploadPartCopy", CopySource["Key"])
+
+            start, end = 0, st.st_size - 1
+            if CopySourceRange:
+                start, end = (int(n) for n in CopySourceRange.split("=", 1)[1].split("-"))
+
+            part = self.store(
+                os.path.join(folder, str(PartNumber)),
+                lambda fd: copy_fd_range(src, fd, start, end - start + 1)
+            )
+        finally:
+            os.close(src)
+
+        return {"CopyPartResult": {"ETag": local_etag(part)}}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        folder = self.upload_dir(UploadId, "CompleteMultipartUpload")
+
+        def fill(fd):
+            for part in MultipartUpload["Parts"]:
+                try:
+                    src = os.open(os.path.join(folder, str(part["PartNumber"])), os.O_RDONLY)
+                except FileNotFoundError:
+                    raise local_error("InvalidPart", "CompleteMultipartUpload", Key)
+
+                try:
+                    st = os.fstat(src)
+                    if part.get("ETag") and part["ETag"] != local_etag(st):
+                        raise local_error("InvalidPart", "CompleteMultipartUpload", Key)
+                    copy_fd_range(src, fd, 0, st.st_size)
+                finally:
+                    os.close(src)
+
+        st = self.store(self.path(Key), fill)
+        shutil.rmtree(folder, ignore_errors=True)
+
+        return {"Bucket": Bucket, "Key": Key, "ETag": local_etag(st)}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        shutil.rmtree(self.upload_dir(UploadId, "AbortMultipartUpload"), ignore_errors=True)
+        return {}
+
+    # presigning: download links to /storage/<key> (uploads always go
+    # through Flask with this backend, see initiate_upload)
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600, **kwargs):
+        if ClientMethod != "get_object":
+            raise ValueError(f"can't presign {ClientMethod} on local storage")
+
+        return signed_object_url(
+            Params["Key"], Params.get("ResponseContentDisposition", ""), ExpiresIn
+        )
+
+
+def object_signature(key, expires, disposition):
+    message = f"{key}\n{expires}\n{disposition}".encode()
+    return hmac.new(app.secret_key.encode(), message, hashlib.sha256).hexdigest()
+
+
+def signed_object_url(key, disposition, expires_in):
+    expires = int(time.time()) + expires_in
+
+    return url_for(
+        "serve_object",
+        key=key,
+        expires=expires,
+        disposition=disposition or None,
+        sig=object_signature(key, expires, disposition or ""),
+        _external=True
+    )
+
+
+@app.route(LOCAL_URL + "<path:key>")
+def serve_object(key):
+    if STORAGE_BACKEND != "local":
+        return jsonify({"error": "not found"}), 404
+
+    expires = request.args.get("expires", type=int)
+    disposition = request.args.get("disposition", "")
+
+    db = get_db()
+
+    if expires is not None:
+        # presigned: share links work without a session
+        signature = object_signature(key, expires, disposition)
+        if expires < time.time() or not hmac.compare_digest(request.args.get("sig", ""), signature):
+            db.close()
+            return jsonify({"error": "link expired"}), 403
+
+        row = db.execute("SELECT mime FROM nodes WHERE s3_key=? LIMIT 1", (key,)).fetchone()
+
+    elif "user" in session:
+        row = db.execute(
+            "SELECT mime FROM nodes WHERE owner=? AND s3_key=? LIMIT 1",
+            (session["user"], key)
+        ).fetchone()
+
+        if not row:
+            db.close()
+            return jsonify({"error": "not found"}), 404
+
+    else:
+        db.close()
+        return jsonify({"error": "unauthorized"}), 401
+
+    db.close()
+
+    try:
+        path = s3.client.path(key)
+        resp = send_file(
+            path,
+            mimetype=(row[0] if row else None) or "application/octet-stream",
+            conditional=True,
+            etag=True
+        )
+    except (ClientError, FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        return jsonify({"error": "not found"}), 404
+
+    resp.headers["Content-Disposition"] = disposition or "inline"
+    resp.headers["Cache-Control"] = "private, no-cache"
+
+    return resp
+
+
+if STORAGE_BACKEND == "local":
+    s3 = S3Client(LocalStorage(STORAGE_DIR))
+
+else:
+    s3 = S3Client(boto3.client(
+        "s3",
+        region_name=REGION,
+        config=Config(
+            max_pool_connections=S3_POOL,
+            retries={"mode": "adaptive", "max_attempts": S3_ATTEMPTS},
+            connect_timeout=S3_CONNECT_TIMEOUT,
+            read_timeout=S3_READ_TIMEOUT,
+            tcp_keepalive=True
+        )
+    ))
+
+
+@app.errorhandler(S3Unavailable)
+def s3_unavailable(e):
+    print("S3 unavailable:", e)
+    return jsonify({"error": "storage is busy, try again"}), 503
+
+
+#  DATABASE 
+DB_FILE = "database.db"
+
+# idle connections kept around for reuse
+DB_POOL_SIZE = int(os.environ.get("MINIDRIVE_DB_POOL_SIZE", "8"))
+
+db_pool = queue.LifoQueue()
+
+
+def open_connection():
+    conn = sqlite3.connect(
+        DB_FILE,
+        timeout=10,                 # busy timeout instead of "database is locked"
+        check_same_thread=False,    # pooled connections move between threads
+        cached_statements=256
+    )
+
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=10000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+
+    return conn
+
+
+def acquire_connection():
+    try:
+        return db_pool.get_nowait()
+    except queue.Empty:
+        return open_connection()
+
+
+def release_connection(conn):
+    # never hand out a connection with someone else's half-done transaction
+    if conn.in_transaction:
+        conn.rollback()
+
+    if db_pool.qsize() < DB_POOL_SIZE:
+        db_pool.put(conn)
+    else:
+        conn.close()
+
+
+class TimedCursor:
+    """A cursor whose statements are counted in the metrics."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            self._cursor.execute(sql, *args)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+        return self
+
+    def executemany(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            self._cursor.executemany(sql, *args)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+        return self
+
+
+class PooledConnection:
+    """A pooled sqlite3 connection. close() gives it back to the pool
+    (rolling back anything uncommitted, like a real close would)."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def execute(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            return self._conn.execute(sql, *args)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            return self._conn.executemany(sql, *args)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+    def cursor(self):
+        return TimedCursor(self._conn.cursor())
+
+    def close(self):
+        if self._conn is not None:
+            release_connection(self._conn)
+            self._conn = None
+
+
+class RequestConnection(PooledConnection):
+    """The one connection of a request, shared by before_request and the
+    handler. close() only ends the current transaction; the connection
+    goes back to the pool when the request is torn down."""
+
+    def close(self):
+        if self._conn.in_transaction:
+            self._conn.rollback()
+
+    def release(self):
+        PooledConnection.close(self)
+
+
+def get_db():
+
+    if has_app_context():
+        if "db" not in g:
+            g.db = RequestConnection(acquire_connection())
+        return g.db
+
+    # background threads: borrow from the pool
+    return PooledConnection(acquire_connection())
+
+
+@app.teardown_appcontext
+def release_request_db(exc):
+    db = g.pop("db", None)
+    if db is not None:
+        db.release()
+
+
+#INIT DRIVE TABLE 
+
+def init_drive():
+
+    db = get_db()
+    c = db.cursor()
+
+    # USERS
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE,
+            password TEXT,
+            role TEXT DEFAULT 'user'
+        )
+    """)
+
+    # DRIVE (per user)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS drive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE,
+            data TEXT
+        )
+    """)
+
+    # bumped on every change to a user's drive (edits are based on it);
+    # `keys` counts the object key swaps that leave the tree as it was
+    # (uploads moved into the blob store), cache key / ETag use both
+    columns = [r[1] for r in c.execute("PRAGMA table_info(drive)").fetchall()]
+    if "version" not in columns:
+        c.execute("ALTER TABLE drive ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    if "keys" not in columns:
+        c.execute("ALTER TABLE drive ADD COLUMN keys INTEGER NOT NULL DEFAULT 0")
+
+    # STORAGE LEDGER (per user + shared pool, in bytes)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS storage_usage (
+            username TEXT PRIMARY KEY,
+            used_bytes INTEGER NOT NULL DEFAULT 0,
+            reserved_bytes INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS storage_pool (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            used_bytes INTEGER NOT NULL DEFAULT 0,
+            reserved_bytes INTEGER NOT NULL DEFAULT 0,
+            reconciled_at TEXT
+        )
+    """)
+
+    c.execute("INSERT OR IGNORE INTO storage_pool (id) VALUES (1)")
+
+    # bytes of the blobs a user's files point at (the blobs themselves are
+    # stored, and charged to the pool, once under BLOB_OWNER)
+    columns = [r[1] for r in c.execute("PRAGMA table_info(storage_usage)").fetchall()]
+    if "linked_bytes" not in columns:
+        c.execute("ALTER TABLE storage_usage ADD COLUMN linked_bytes INTEGER NOT NULL DEFAULT 0")
+
+    # CONTENT-ADDRESSED BLOBS (one S3 object per distinct content, stored
+    # under _blobs/<sha256>; refs counts the nodes pointing at it)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refs INTEGER NOT NULL DEFAULT 0,
+            state TEXT NOT NULL DEFAULT 'live',
+            created TEXT,
+            idle_since TEXT
+        )
+    """)
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_blobs_idle ON blobs (idle_since) WHERE refs = 0")
+
+    # what the last bucket scan found per top level prefix (the admin page
+    # renders from this; storage_pool.reconciled_at is when it ran)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS usage_scan (
+            username TEXT PRIMARY KEY,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            objects INTEGER NOT NULL DEFAULT 0,
+            scanned_at TEXT
+        )
+    """)
+
+    # DRIVE NODES (one row per file / folder)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS nodes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner TEXT NOT NULL,
+            parent_id INTEGER,
+            name TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            size INTEGER,
+            mime TEXT,
+            s3_key TEXT,
+            created TEXT,
+            modified TEXT
+        )
+    """)
+
+    c.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_nodes_path
+        ON nodes (owner, parent_id, name)
+    """)
+
+    # the per-user "root" and "trash" containers have no parent
+    c.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_nodes_top
+        ON nodes (owner, name) WHERE parent_id IS NULL
+    """)
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_nodes_key ON nodes (s3_key)")
+
+    # one per /api/list sort order (see LIST_SORTS)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_nodes_list_name
+        ON nodes (owner, parent_id, kind, name COLLATE NOCASE)
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_nodes_list_size
+        ON nodes (owner, parent_id, kind, COALESCE(size, 0))
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_nodes_list_date
+        ON nodes (owner, parent_id, kind, COALESCE(modified, ''))
+    """)
+
+    # any write to nodes / drive.data moves the drive version, so no code
+    # path can forget to invalidate the drive cache
+    for event, row in (("INSERT", "NEW"), ("DELETE", "OLD")):
+        c.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS nodes_version_{event.lower()}
+            AFTER {event} ON nodes
+            BEGIN
+                UPDATE drive SET version = version + 1 WHERE username = {row}.owner;
+            END
+        """)
+
+    # ...except a new object key alone: the file is the same, only its url
+    # changed, and clients' pending edits shouldn't conflict over it
+    c.execute("DROP TRIGGER IF EXISTS nodes_version_update")
+    c.execute("""
+        CREATE TRIGGER nodes_version_update
+        AFTER UPDATE ON nodes
+        BEGIN
+            UPDATE drive
+            SET version = version + (
+                    NEW.parent_id IS NOT OLD.parent_id OR NEW.name IS NOT OLD.name
+                    OR NEW.kind IS NOT OLD.kind OR NEW.size IS NOT OLD.size
+                    OR NEW.mime IS NOT OLD.mime OR NEW.created IS NOT OLD.created
+                    OR NEW.modified IS NOT OLD.modified OR NEW.owner IS NOT OLD.owner
+                ),
+                keys = keys + (NEW.s3_key IS NOT OLD.s3_key)
+            WHERE username = NEW.owner;
+        END
+    """)
+
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS drive_version_data
+        AFTER UPDATE OF data ON drive
+        BEGIN
+            UPDATE drive SET version = version + 1 WHERE id = NEW.id;
+        END
+    """)
+
+    # blob reference counts follow the nodes pointing at them, whichever
+    # code path inserts, repoints or deletes the rows
+    link = """
+        UPDATE blobs SET refs = refs + 1, idle_since = NULL
+        WHERE sha256 = substr(NEW.s3_key, 8);
+
+        INSERT INTO storage_usage (username, linked_bytes)
+        VALUES (NEW.owner, COALESCE(NEW.size, 0))
+        ON CONFLICT (username) DO UPDATE
+        SET linked_bytes = linked_bytes + excluded.linked_bytes;
+    """
+
+    unlink = """
+        UPDATE blobs
+        SET refs = refs - 1,
+            idle_since = CASE WHEN refs = 1 THEN datetime('now') END
+        WHERE sha256 = substr(OLD.s3_key, 8);
+
+        UPDATE storage_usage
+        SET linked_bytes = MAX(0, linked_bytes - COALESCE(OLD.size, 0))
+        WHERE username = OLD.owner;
+    """
+
+    is_blob = "substr({}.s3_key, 1, 7) = '_blobs/'"
+
+    for name, event, row, body in (
+        ("blobs_insert", "INSERT", "NEW", link),
+        ("blobs_delete", "DELETE", "OLD", unlink),
+        ("blobs_update_old", "UPDATE OF owner, size, s3_key", "OLD", unlink),
+        ("blobs_update_new", "UPDATE OF owner, size, s3_key", "NEW", link),
+    ):
+        c.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {name}
+            AFTER {event} ON nodes WHEN {is_blob.format(row)}
+            BEGIN
+                {body}
+            END
+        """)
+
+    # OBJECTS NO NODE POINTS AT ANY MORE (removed or replaced files, in the
+    # owner's own prefix), waiting for delete_orphans() to delete them
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS orphans (
+            s3_key TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            created TEXT
+        )
+    """)
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orphans_owner ON orphans (owner)")
+
+    own_key = "substr(OLD.s3_key, 1, length(OLD.owner) + 1) = OLD.owner || '/'"
+    release = """
+        INSERT OR REPLACE INTO orphans (s3_key, owner, size, created)
+        VALUES (OLD.s3_key, OLD.owner, COALESCE(OLD.size, 0), datetime('now'));
+    """
+
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS orphans_delete
+        AFTER DELETE ON nodes WHEN OLD.kind = 'file' AND {own_key}
+        BEGIN
+            {release}
+        END
+    """)
+
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS orphans_update
+        AFTER UPDATE OF s3_key ON nodes
+        WHEN OLD.s3_key IS NOT NEW.s3_key AND {own_key}
+        BEGIN
+            {release}
+        END
+    """)
+
+    # SEARCH INDEX (trigram FTS5 over name and mime; rowid is the node id).
+    # Kept in step with nodes by triggers, so every upload, rename and
+    # delete updates it without the handlers knowing. Each row only
+    # describes its own node: folder paths are worked out when searching,
+    # so moving a folder never re-indexes what is inside it.
+    columns = [r[1] for r in c.execute("PRAGMA table_info(nodes_fts)").fetchall()]
+
+    # indexes from before stored each node's folder path too
+    if "path" in columns:
+        for trigger in ("insert", "update", "delete"):
+            c.execute(f"DROP TRIGGER IF EXISTS nodes_fts_{trigger}")
+        c.execute("DROP TABLE nodes_fts")
+        columns = []
+
+    c.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS nodes_fts
+        USING fts5(name, mime, tokenize='trigram')
+    """)
+
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS nodes_fts_insert
+        AFTER INSERT ON nodes WHEN NEW.parent_id IS NOT NULL
+        BEGIN
+            INSERT INTO nodes_fts (rowid, name, mime) VALUES (NEW.id, NEW.name, NEW.mime);
+        END
+    """)
+
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS nodes_fts_update
+        AFTER UPDATE OF name, mime ON nodes WHEN NEW.parent_id IS NOT NULL
+        BEGIN
+            UPDATE nodes_fts SET name = NEW.name, mime = NEW.mime WHERE rowid = NEW.id;
+        END
+    """)
+
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS nodes_fts_delete
+        AFTER DELETE ON nodes
+        BEGIN
+            DELETE FROM nodes_fts WHERE rowid = OLD.id;
+        END
+    """)
+
+    if not columns:
+        c.execute("""
+            INSERT INTO nodes_fts (rowid, name, mime)
+            SELECT id, name, mime FROM nodes WHERE parent_id IS NOT NULL
+        """)
+
+    # RECENT ACTIVITY (the "Recent" list, see RECENT ACTIVITY below)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS recent_activity (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            ts REAL NOT NULL,
+            name TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            size REAL,
+            path TEXT,
+            time TEXT,
+            owner TEXT
+        )
+    """)
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_recent_user_ts ON recent_activity (username, ts, id)")
+
+    # THUMBNAILS (one row per object key; see THUMBNAILS below)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS thumbs (
+            s3_key TEXT PRIMARY KEY,
+            state TEXT NOT NULL DEFAULT 'queued',
+            bytes INTEGER NOT NULL DEFAULT 0,
+            width INTEGER,
+            height INTEGER,
+            created TEXT
+        )
+    """)
+
+    # TRASH (when each item directly in a trash container was put there,
+    # kept by triggers like the search index; see TRASH below)
+    has_trash = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE name='trash'"
+    ).fetchone()
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS trash (
+            node_id INTEGER PRIMARY KEY,
+            owner TEXT NOT NULL,
+            deleted_at REAL NOT NULL
+        )
+    """)
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_trash_deleted ON trash (deleted_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_trash_owner ON trash (owner)")
+
+    now = "(julianday('now') - 2440587.5) * 86400.0"
+    in_trash = "(SELECT kind FROM nodes WHERE id = NEW.parent_id) = 'trash'"
+
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trash_insert
+        AFTER INSERT ON nodes WHEN {in_trash}
+        BEGIN
+            INSERT OR REPLACE INTO trash (node_id, owner, deleted_at)
+            VALUES (NEW.id, NEW.owner, {now});
+        END
+    """)
+
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trash_update
+        AFTER UPDATE OF parent_id ON nodes WHEN OLD.parent_id IS NOT NEW.parent_id
+        BEGIN
+            DELETE FROM trash WHERE node_id = NEW.id;
+
+            INSERT INTO trash (node_id, owner, deleted_at)
+            SELECT NEW.id, NEW.owner, {now} WHERE {in_trash};
+        END
+    """)
+
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trash_delete
+        AFTER DELETE ON nodes
+        BEGIN
+            DELETE FROM trash WHERE node_id = OLD.id;
+        END
+    """)
+
+    # what was in the trash before has its TTL start now
+    if not has_trash:
+        c.execute(f"""
+            INSERT INTO trash (node_id, owner, deleted_at)
+            SELECT n.id, n.owner, {now}
+            FROM nodes n JOIN nodes t ON t.id = n.parent_id
+            WHERE t.kind = 'trash'
+        """)
+
+    # folder renames used to move objects to a new prefix, checkpointed in
+    # `moves`. Nodes were repointed before originals were deleted, so an
+    # unfinished one left every file readable and needs nothing more
+    c.execute("DROP TABLE IF EXISTS moves")
+
+    # BACKGROUND JOBS
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner TEXT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            run_after REAL NOT NULL,
+            progress_done INTEGER NOT NULL DEFAULT 0,
+            progress_total INTEGER,
+            result TEXT,
+            error TEXT,
+            locked_by TEXT,
+            locked_at REAL,
+            created TEXT,
+            updated TEXT
+        )
+    """)
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs (state, run_after)")
+
+    # resuming an old prefix move (see `moves` above) isn't needed any more
+    c.execute("""
+        UPDATE jobs SET state='done', locked_by=NULL
+        WHERE kind='move_prefix' AND state IN ('queued', 'running')
+    """)
+
+    # DIRECT UPLOADS the browser was given presigned URLs for
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS pending_uploads (
+            id TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            s3_key TEXT NOT NULL,
+            path TEXT NOT NULL,
+            name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mime TEXT,
+            multipart_id TEXT,
+            created REAL NOT NULL
+        )
+    """)
+
+    # one-shot data migrations that have run (see run_migrations)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS migrations (
+            name TEXT PRIMARY KEY,
+            done REAL NOT NULL
+        )
+    """)
+
+    db.commit()
+    db.close()
+
+
+
+init_drive()
+
+
+# DRIVE NODES
+#
+# Every file and folder is a row in `nodes`. Each user owns two top level
+# containers, "root" (My Drive) and "trash", and everything else hangs off
+# them through parent_id. Sizes are stored in bytes, the JSON sent to the
+# dashboard keeps the old {"size": MB, "url": ..., "type": ...} shape.
+# `drive.data` is left over from the JSON blob days (the recent list
+# moved to `recent_activity`).
+
+MB = 1024 * 1024
+
+NODE_COLUMNS = "id, parent_id, name, kind, size, mime, s3_key"
+
+SUBTREE_CTE = """
+    WITH RECURSIVE subtree(id) AS (
+        SELECT ?
+        UNION ALL
+        SELECT n.id FROM nodes n JOIN subtree s ON n.parent_id = s.id
+        WHERE n.owner = ?
+    )
+"""
+
+
+def timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def s3_url(s3_key):
+    if STORAGE_BACKEND == "local":
+        return LOCAL_URL + quote(s3_key)
+    return f"https://{BUCKET_NAME}.s3.{REGION}.amazonaws.com/{s3_key}"
+
+
+def new_object_key(username):
+    """A fresh key in the user's prefix. It says nothing about where the
+    file sits in the drive, so renames and moves never touch S3."""
+
+    return f"{username}/{uuid.uuid4().hex}"
+
+
+def key_from_url(url):
+    """The object key in a file url (either backend's), None if it has none."""
+
+    url = url or ""
+
+    if ".amazonaws.com/" in url:
+        return url.split(".amazonaws.com/", 1)[1] or None
+    if LOCAL_URL in url:
+        return unquote(url.split(LOCAL_URL, 1)[1]) or None
+    return None
+
+
+def to_mb(size):
+    return round((size or 0) / MB, 2)
+
+
+def get_drive_roots(db, username):
+    """Return {"root": id, "trash": id}, creating the containers on first use."""
+
+    roots = dict(db.execute(
+        "SELECT name, id FROM nodes WHERE owner=? AND parent_id IS NULL",
+        (username,)
+    ).fetchall())
+
+    for name in ("root", "trash"):
+        if name not in roots:
+            db.execute(
+                """
+                INSERT OR IGNORE INTO nodes (owner, parent_id, name, kind, created)
+                VALUES (?, NULL, ?, ?, ?)
+                """,
+                (username, name, name, timestamp())
+            )
+            roots[name] = db.execute(
+                "SELECT id FROM nodes WHERE owner=? AND parent_id IS NULL AND name=?",
+                (username, name)
+            ).fetchone()[0]
+
+    return roots
+
+
+def find_child(db, username, parent_id, name):
+    return db.execute(
+        f"SELECT {NODE_COLUMNS} FROM nodes WHERE owner=? AND parent_id=? AND name=?",
+        (username, parent_id, name)
+    ).fetchone()
+
+
+def resolve_folder(db, username, names, create=False, area="root"):
+    """Walk a folder path (without the leading "root"), one indexed lookup
+    per level. Returns the folder id, or None if it doesn't exist."""
+
+    folder_id = get_drive_roots(db, username)[area]
+
+    for name in names:
+        row = find_child(db, username, folder_id, name)
+
+        if row is None:
+            if not create:
+                return None
+
+            folder_id = db.execute(
+                """
+                INSERT INTO nodes (owner, parent_id, name, kind, created, modified)
+                VALUES (?, ?, ?, 'folder', ?, ?)
+                """,
+                (username, folder_id, name, timestamp(), timestamp())
+            ).lastrowid
+
+        elif row[3] == "file":
+            return None
+
+        else:
+            folder_id = row[0]
+
+    return folder_id
+
+
+def put_file_node(db, username, folder_id, name, size, mime, s3_key):
+    """Insert or replace a file row (the replaced file's object, if it was
+    the user's own, is queued in `orphans` by a trigger). False when a
+    folder has the name: nothing is written."""
+
+    cur = db.execute(
+        """
+        INSERT INTO nodes (owner, parent_id, name, kind, size, mime, s3_key, created, modified)
+        VALUES (?, ?, ?, 'file', ?, ?, ?, ?, ?)
+        ON CONFLICT (owner, parent_id, name) DO UPDATE
+        SET size = excluded.size,
+            mime = excluded.mime,
+            s3_key = excluded.s3_key,
+            modified = excluded.modified
+        WHERE kind = 'file'
+        """,
+        (username, folder_id, name, size, mime, s3_key, timestamp(), timestamp())
+    )
+
+    return cur.rowcount > 0
+
+
+def orphan_upload(db, username, s3_key):
+    """Queue the object of an upload that got no node for delete_orphans.
+    Its bytes were never charged (size 0, deleting it credits nothing);
+    blobs are left to collect_blobs."""
+
+    if is_blob_key(s3_key):
+        return
+
+    db.execute(
+        """
+        INSERT OR REPLACE INTO orphans (s3_key, owner, size, created)
+        VALUES (?, ?, 0, datetime('now'))
+        """,
+        (s3_key, username)
+    )
+
+
+def file_entry(node_id, size, mime, s3_key):
+    return {
+        "id": node_id,
+        "size": to_mb(size),
+        "url": s3_url(s3_key),
+        "type": mime
+    }
+
+
+def build_tree(db, username):
+    """Rebuild the {"root": {...}, "trash": {...}} tree from one query."""
+
+    get_drive_roots(db, username)
+
+    rows = db.execute(
+        f"SELECT {NODE_COLUMNS} FROM nodes WHERE owner=?",
+        (username,)
+    ).fetchall()
+
+    folders = {r[0]: {} for r in rows if r[3] != "file"}
+    tree = {}
+
+    for node_id, parent_id, name, kind, size, mime, s3_key in rows:
+
+        if parent_id is None:
+            tree[name] = folders[node_id]
+            continue
+
+        parent = folders.get(parent_id)
+        if parent is None:
+            continue
+
+        if kind == "file":
+            parent[name] = file_entry(node_id, size, mime, s3_key)
+        else:
+            parent[name] = folders[node_id]
+
+    return tree
+
+
+def flatten_tree(folder, prefix):
+    """Yield (path, spec) for every node of a posted JSON tree.
+
+    spec is (kind, size_mb, mime, s3_key, created). Non-dict values are the
+    old "created"/"owner" folder metadata and are skipped.
+    """
+
+    for name, item in folder.items():
+
+        if not isinstance(item, dict):
+            continue
+
+        path = prefix + (name,)
+
+        if "url" in item:
+            size = item.get("size")
+            try:
+                size = float(size or 0)
+            except (TypeError, ValueError):
+                size = 0.0
+
+            yield path, ("file", size, item.get("type"), key_from_url(item["url"]), None)
+
+        else:
+            created = item.get("created")
+            yield path, ("folder", None, None, None, created if isinstance(created, str) else None)
+            yield from flatten_tree(item, path)
+
+
+def linked_size(db, s3_key, known=None):
+    """Bytes of an object a posted tree or op links in. The client's size
+    is never taken: it comes from the blob row, a file already pointing at
+    the object (`known` maps keys to sizes the caller has), or S3."""
+
+    if known is not None and s3_key in known:
+        return known[s3_key]
+
+    if is_blob_key(s3_key):
+        row = db.execute(
+            "SELECT size FROM blobs WHERE sha256=?", (s3_key[len(BLOB_PREFIX):],)
+        ).fetchone()
+    else:
+        row = db.execute(
+            "SELECT size FROM nodes WHERE s3_key=? AND kind='file' LIMIT 1", (s3_key,)
+        ).fetchone()
+
+    size = row[0] if row else get_object_size(s3_key)
+
+    if known is not None:
+        known[s3_key] = size
+
+    return size
+
+
+def sync_drive(db, username, data):
+    """Make the rows match a whole posted tree, touching only what differs.
+
+    Paths that disappeared are deleted, new paths are inserted, and a file
+    that shows up under a new path with the same s3_key (moved to trash,
+    recovered, ...) keeps its row and is just re-parented.
+    """
+
+    roots = get_drive_roots(db, username)
+
+    rows = db.execute(
+        f"SELECT {NODE_COLUMNS} FROM nodes WHERE owner=? AND parent_id IS NOT NULL",
+        (username,)
+    ).fetchall()
+
+    by_id = {r[0]: r for r in rows}
+    area_of = {node_id: name for name, node_id in roots.items()}
+    paths = {}
+
+    def path_of(node_id):
+        if node_id in area_of:
+            return (area_of[node_id],)
+        if node_id not in paths:
+            row = by_id.get(node_id)
+            parent = path_of(row[1]) if row else None
+            paths[node_id] = parent + (row[2],) if parent else None
+        return paths[node_id]
+
+    existing = {}
+    for r in rows:
+        path = path_of(r[0])
+        if path:
+            existing[path] = r
+
+    wanted = {}
+    for area in ("root", "trash"):
+        wanted.update(flatten_tree(data.get(area) or {}, (area,)))
+
+    # posted urls may only name the user's own objects: their prefix, or a
+    # blob their files pointed at before this save. Sizes are the stored
+    # ones (see linked_size), whatever the tree says.
+    linked = {r[6]: r[4] for r in rows if is_blob_key(r[6])}
+    sizes = {r[6]: r[4] for r in rows if r[3] == "file" and r[6]}
+
+    def owns(s3_key):
+        return s3_key is not None and (s3_key.startswith(username + "/") or s3_key in linked)
+
+    gone = [
+        path for path, r in existing.items()
+        if path not in wanted or wanted[path][0] != r[3]
+    ]
+
+    movable = {}
+    for path in gone:
+        r = existing[path]
+        if r[3] == "file" and r[6]:
+            movable.setdefault(r[6], r)
+
+    new_paths = sorted(
+        (path for path in wanted if path not in existing or path in gone),
+        key=len
+    )
+
+    moves = {}
+    for path in new_paths:
+        kind, _, _, s3_key, _ = wanted[path]
+        if kind == "file" and s3_key in movable:
+            moves[path] = movable.pop(s3_key)
+
+    moved_ids = {r[0] for r in moves.values()}
+    doomed = [existing[path][0] for path in gone if existing[path][0] not in moved_ids]
+
+    for i in range(0, len(doomed), 500):
+        chunk = doomed[i:i + 500]
+        db.execute(
+            f"DELETE FROM nodes WHERE id IN ({','.join('?' * len(chunk))})",
+            chunk
+        )
+
+    # park moved rows so their old names can't collide with new inserts
+    for node_id in moved_ids:
+        db.execute("UPDATE nodes SET name = ? WHERE id = ?", (f"\0{node_id}", node_id))
+
+    ids = {(area,): node_id for area, node_id in roots.items()}
+    ids.update({path: r[0] for path, r in existing.items() if path not in gone})
+
+    for path in new_paths:
+
+        parent_id = ids.get(path[:-1])
+        if parent_id is None:
+            continue
+
+        kind, _, mime, s3_key, created = wanted[path]
+
+        if path in moves:
+            node_id = moves[path][0]
+            db.execute(
+                "UPDATE nodes SET parent_id=?, name=?, modified=? WHERE id=?",
+                (parent_id, path[-1], timestamp(), node_id)
+            )
+
+        elif kind == "file":
+            if not owns(s3_key):
+                continue
+
+            node_id = db.execute(
+                """
+                INSERT INTO nodes (owner, parent_id, name, kind, size, mime, s3_key, created, modified)
+                VALUES (?, ?, ?, 'file', ?, ?, ?, ?, ?)
+                """,
+                (username, parent_id, path[-1], linked_size(db, s3_key, sizes),
+                 mime, s3_key, timestamp(), timestamp())
+            ).lastrowid
+
+        else:
+            node_id = db.execute(
+                """
+                INSERT INTO nodes (owner, parent_id, name, kind, created, modified)
+                VALUES (?, ?, ?, 'folder', ?, ?)
+                """,
+                (username, parent_id, path[-1], created or timestamp(), timestamp())
+            ).lastrowid
+
+        ids[path] = node_id
+
+    # files that stayed put but whose attributes changed
+    for path, r in existing.items():
+
+        if path in gone or r[3] != "file":
+            continue
+
+        _, _, mime, s3_key, _ = wanted[path]
+
+        if not owns(s3_key):
+            s3_key = r[6]
+
+        if r[5] != mime or r[6] != s3_key:
+            size = r[4] if r[6] == s3_key else linked_size(db, s3_key, sizes)
+            db.execute(
+                "UPDATE nodes SET size=?, mime=?, s3_key=?, modified=? WHERE id=?",
+                (size, mime, s3_key, timestamp(), r[0])
+            )
+
+
+def ensure_drive(db, username):
+
+    row = db.execute(
+        "SELECT 1 FROM drive WHERE username=?",
+        (username,)
+    ).fetchone()
+
+    #  Auto create drive if missing
+    if not row:
+        db.execute(
+            "INSERT INTO drive (username, data) VALUES (?, ?)",
+            (username, json.dumps({"recent": []}))
+        )
+
+
+def load_data():
+
+    username = session.get("user")
+
+    db = get_db()
+
+    try:
+        ensure_drive(db, username)
+        data = build_tree(db, username)
+        db.commit()
+
+    finally:
+        db.close()
+
+    return data
+
+
+# DRIVE CACHE
+#
+# Serialized /api/drive bodies per user, tagged with the drive version they
+# were built from. A request only has to read the version row: same version
+# means the cached body (or a 304) is still right. LRU, bounded by bytes.
+
+DRIVE_CACHE_BYTES = int(os.environ.get("MINIDRIVE_DRIVE_CACHE_MB", "64")) * MB
+
+drive_cache = OrderedDict()     # username -> ((version, keys), body)
+drive_cache_bytes = 0
+drive_cache_lock = threading.Lock()
+
+
+def get_drive_version(db, username):
+
+    row = db.execute(
+        "SELECT version FROM drive WHERE username=?",
+        (username,)
+    ).fetchone()
+
+    if not row:
+        ensure_drive(db, username)
+        db.commit()
+        return 0
+
+    return row[0]
+
+
+def get_drive_revision(db, username):
+    """(version, keys): what the serialized drive depends on, urls included."""
+
+    row = db.execute(
+        "SELECT version, keys FROM drive WHERE username=?",
+        (username,)
+    ).fetchone()
+
+    if not row:
+        ensure_drive(db, username)
+        db.commit()
+        return (0, 0)
+
+    return tuple(row)
+
+
+def cache_get_drive(username, version):
+    with drive_cache_lock:
+        entry = drive_cache.get(username)
+        if entry and entry[0] == version:
+            drive_cache.move_to_end(username)
+            return entry[1]
+    return None
+
+
+def cache_put_drive(username, version, body):
+    global drive_cache_bytes
+
+    if len(body) > DRIVE_CACHE_BYTES:
+        return
+
+    with drive_cache_lock:
+        old = drive_cache.pop(username, None)
+        if old:
+            drive_cache_bytes -= len(old[1])
+
+        drive_cache[username] = (version, body)
+        drive_cache_bytes += len(body)
+
+        while drive_cache_bytes > DRIVE_CACHE_BYTES:
+            _, (_, evicted) = drive_cache.popitem(last=False)
+            drive_cache_bytes -= len(evicted)
+
+
+def drop_cached_drive(username):
+    global drive_cache_bytes
+
+    with drive_cache_lock:
+        old = drive_cache.pop(username, None)
+        if old:
+            drive_cache_bytes -= len(old[1])
+
+
+def load_drive_body(username):
+    """Return (revision, serialized drive), from the cache when possible."""
+
+    db = get_db()
+
+    try:
+        revision = get_drive_revision(db, username)
+
+        body = cache_get_drive(username, revision)
+        if body is not None:
+            return revision, body
+
+        # revision + tree from one transaction (read the revision last, in
+        # case building had to create the root/trash containers)
+        db.execute("BEGIN")
+        data = build_tree(db, username)
+        revision = get_drive_revision(db, username)
+        db.commit()
+
+    finally:
+        db.close()
+
+    # clients send this back as base_version with their edits
+    data["version"] = revision[0]
+
+    body = app.json.dumps(data).encode()
+    cache_put_drive(username, revision, body)
+    drive_body_bytes.observe(len(body), "load")
+
+    return revision, body
+
+
+class DriveConflict(Exception):
+    """The drive changed since the version the client based its edit on."""
+
+    def __init__(self, version):
+        super().__init__(version)
+        self.version = version
+
+
+def save_data(data):
+
+    username = session.get("user")
+
+    db = get_db()
+
+    try:
+        db.execute("BEGIN IMMEDIATE")
+
+        ensure_drive(db, username)
+
+        # trees loaded from a versioned /api/drive carry their version
+        base = data.get("version")
+        current = get_drive_version(db, username)
+        if base is not None and base != current:
+            raise DriveConflict(current)
+
+        # a posted "recent" list is ignored, it is kept through the ops
+        sync_drive(db, username, data)
+
+        db.commit()
+
+    except Exception:
+        db.rollback()
+        raise
+
+    finally:
+        db.close()
+
+
+def migrate_drive_blobs():
+    """One-shot move of the old whole-tree JSON blobs into `nodes`.
+
+    Each user is migrated in its own transaction; afterwards drive.data
+    only keeps the recent list, so running this again is a no-op.
+    """
+
+    db = get_db()
+
+    try:
+        usernames = [r[0] for r in db.execute(
+            "SELECT username FROM drive WHERE data LIKE '%\"root\"%' OR data LIKE '%\"trash\"%'"
+        ).fetchall()]
+
+        for username in usernames:
+
+            db.execute("BEGIN IMMEDIATE")
+
+            raw = db.execute(
+                "SELECT data FROM drive WHERE username=?",
+                (username,)
+            ).fetchone()[0]
+
+            blob = json.loads(raw or "{}")
+
+            if "root" in blob or "trash" in blob:
+                sync_drive(db, username, blob)
+
+                db.execute(
+                    "UPDATE drive SET data=? WHERE username=?",
+                    (json.dumps({"recent": blob.get("recent", [])}), username)
+                )
+
+                print("Migrated drive of", username)
+
+            db.commit()
+
+    finally:
+        db.close()
+
+
+#username validation function
+def validate_username(username):
+    # length: min 3, max 12
+    if not 3 <= len(username) <= 12:
+        return "Username must be between 3 and 12 characters."
+
+    # allowed characters only (no spaces)
+    if not re.fullmatch(r"[A-Za-z0-9@#&]+", username):
+        return "Only letters, numbers and @ # & are allowed."
+
+    # only one special character allowed
+    specials = re.findall(r"[@#&]", username)
+    if len(specials) > 1:
+        return "Only one special character (@, #, &) is allowed."
+
+    return None
+
+
+
+#password validation function
+
+def validate_password(password):
+    if len(password) < 4:
+        return "Password must be at least 4 characters long."
+
+    if not re.search(r"[A-Za-z]", password):
+        return "Password must contain at least one letter."
+
+    if not re.search(r"[0-9]", password):
+        return "Password must contain at least one number."
+
+    if not re.search(r"[@#&!$%^*]", password):
+        return "Password must contain at least one special character."
+
+    return None
+
+
+
+# ROUTES 
+
+@app.route("/")
+def home():
+    return redirect(url_for("login"))
+
+@app.route("/signup", methods=["GET", "POST"])
+def signup():
+    if request.method == "POST":
+
+        db = None
+
+        try:
+            username = request.form.get("username", "").strip()
+            password_raw = request.form.get("password", "")
+
+            #  Validate username format
+            username_error = validate_username(username)
+            if username_error:
+                flash(username_error, "signup_error")
+                return redirect(url_for("signup"))
+
+            #  Validate Password
+            password_error = validate_password(password_raw)
+            if password_error:
+                flash(password_error, "signup_error")
+                return redirect(url_for("signup"))
+
+            db = get_db()
+            cursor = db.cursor()
+
+            # Check username exists
+            cursor.execute(
+                "SELECT 1 FROM users WHERE username = ?",
+                (username,)
+            )
+            if cursor.fetchone():
+                flash("Username already exists", "signup_error")
+                return redirect(url_for("signup"))
+
+            # files of a removed account with this name are still being deleted
+            cursor.execute(
+                """
+                SELECT 1 FROM jobs
+                WHERE kind = 'delete_user_files'
+                  AND state IN ('queued', 'running')
+                  AND payload = ?
+                """,
+                (json.dumps({"username": username}),)
+            )
+            if cursor.fetchone():
+                flash("Username already exists", "signup_error")
+                return redirect(url_for("signup"))
+
+            password = generate_password_hash(password_raw)
+
+            cursor.execute(
+                "INSERT INTO users (username, password) VALUES (?, ?)",
+                (username, password)
+            )
+
+            cursor.execute(
+                "INSERT INTO drive (username, data) VALUES (?, ?)",
+                (username, json.dumps({"recent": []}))
+            )
+
+            get_drive_roots(db, username)
+
+            db.commit()
+
+            flash("Account created successfully. Please login.")
+            return redirect(url_for("login"))
+
+        except Exception as e:
+            print("Signup error:", e)
+            flash("Something went wrong. Please try again.")
+            return redirect(url_for("signup"))
+
+        finally:
+            if db:
+                db.close()
+
+    return render_template("login.html")
+
+
+
+#Login Route
+@app.route("/login", methods=["GET", "POST"])
+def login():
+
+    if request.method == "POST":
+
+        username = request.form["username"]
+        password = request.form["password"]
+
+        db = get_db()
+        cursor = db.cursor()
+
+        user = cursor.execute(
+            "SELECT * FROM users WHERE username=?", (username,)
+        ).fetchone()
+
+        db.close()   
+
+        if user and check_password_hash(user[2], password):
+
+            session["user"] = user[1]
+            session["role"] = user[3]     # role
+            return redirect(url_for("dashboard"))
+
+        else:
+            flash("Invalid credentials")
+            return redirect(url_for("login"))
+
+    return render_template("login.html")
+
+# LOGOUT ROUTE 
+@app.route("/logout")
+def logout():
+    session.pop("user", None)
+    return redirect(url_for("login"))
+
+
+#check username
+@app.route("/api/check-username")
+def check_username():
+    username = request.args.get("username", "").strip()
+
+    if not username:
+        return jsonify({"exists": False})
+
+    db = get_db()
+    cursor = db.cursor()
+
+    cursor.execute(
+        "SELECT 1 FROM users WHERE username = ?",
+        (username,)
+    )
+    exists = cursor.fetchone() is not None
+
+    db.close()
+
+    return jsonify({"exists": exists})
+
+
+
+# Dashboard route
+@app.route("/dashboard")
+def dashboard():
+
+    if not session.get("user"):
+        return redirect(url_for("login"))
+
+    return render_template(
+        "dashboard.html",
+        username=session["user"]
+    )
+
+
+#admin dashboard route
+def get_user_storage(username):
+
+    db = get_db()
+
+    # own objects + the deduplicated blobs the user's files point at
+    row = db.execute(
+        "SELECT used_bytes + linked_bytes FROM storage_usage WHERE username=?",
+        (username,)
+    ).fetchone()
+
+    db.close()
+
+    total_bytes = row[0] if row else 0
+
+    return round(total_bytes / (1024 * 1024), 2)
+
+
+
+@app.route("/admin")
+def admin_panel():
+
+    if "user" not in session:
+        return redirect(url_for("login"))
+
+    if session.get("role") != "admin":
+        return "Access Denied", 403
+
+    db = get_db()
+    cursor = db.cursor()   
+
+    # ledger usage + last scan, one query however many users there are
+    users_raw = cursor.execute(
+        """
+        SELECT u.id, u.username, u.role,
+               COALESCE(s.used_bytes + s.linked_bytes, 0), c.objects
+        FROM users u
+        LEFT JOIN storage_usage s ON s.username = u.username
+        LEFT JOIN usage_scan c ON c.username = u.username
+        ORDER BY u.id
+        """
+    ).fetchall()
+
+    scanned_at = cursor.execute(
+        "SELECT reconciled_at FROM storage_pool WHERE id = 1"
+    ).fetchone()[0]
+
+    db.close()
+
+    users = []
+
+    for u in users_raw:
+        users.append({
+            "id": u[0],
+            "username": u[1],
+            "role": u[2],
+            "storage": to_mb(u[3]),
+            "objects": u[4]
+        })
+
+    refreshing = usage_scan_stale(scanned_at) and request_usage_scan()
+
+    return render_template(
+        "admin.html",
+        users=users,
+        scanned_at=scanned_at,
+        refreshing=refreshing
+    )
+
+
+def usage_scan_stale(scanned_at):
+
+    if not scanned_at:
+        return True
+
+    age = datetime.now() - datetime.strptime(scanned_at, "%Y-%m-%d %H:%M:%S")
+    return age.total_seconds() > USAGE_MAX_AGE
+
+
+def request_usage_scan():
+    """Queue a background bucket scan unless one is already on its way."""
+
+    db = get_db()
+    pending = db.execute(
+        """
+        SELECT 1 FROM jobs
+        WHERE kind = 'reconcile_storage' AND state IN ('queued', 'running')
+        """
+    ).fetchone()
+    db.close()
+
+    if not pending:
+        enqueue_job("reconcile_storage", {}, max_attempts=1)
+
+    return True
+
+# delete user route
+def delete_prefix_objects(owner, prefix, progress=None):
+    """Delete everything under prefix, page by page, crediting the ledger."""
+
+    paginator = s3.get_paginator("list_objects_v2")
+    deleted = 0
+
+    for page in paginator.paginate(
+        Bucket=BUCKET_NAME,
+        Prefix=prefix
+    ):
+
+        if "Contents" in page:
+
+            delete_s3_keys([obj["Key"] for obj in page["Contents"]])
+
+            adjust_usage(
+                owner,
+                -sum(obj["Size"] for obj in page["Contents"])
+            )
+
+            deleted += len(page["Contents"])
+
+            if progress:
+                progress(deleted)
+
+    return deleted
+
+
+def delete_orphans(owner=None, progress=None, rate=None):
+    """Delete the objects queued in `orphans` (the owner's, or everyone's
+    for owner=None), unless a node points at them again, crediting the
+    ledger with the sizes the nodes had.
+
+    One delete_objects call per DELETE_BATCH keys; rate caps the objects
+    deleted per second. A row is credited by whoever removes it, so two
+    sweeps running at once don't credit an object twice.
+    """
+
+    deleted = 0
+    started = time.time()
+
+    while True:
+        db = get_db()
+        rows = db.execute(
+            "SELECT s3_key, owner, size FROM orphans WHERE ? IS NULL OR owner=? LIMIT ?",
+            (owner, owner, DELETE_BATCH)
+        ).fetchall()
+
+        keys = [r[0] for r in rows]
+        in_use = {
+            r[0] for r in db.execute(
+                f"SELECT s3_key FROM nodes WHERE s3_key IN ({','.join('?' * len(keys))})",
+                keys
+            ).fetchall()
+        } if keys else set()
+        db.close()
+
+        if not rows:
+            return deleted
+
+        doomed = [row for row in rows if row[0] not in in_use]
+
+        delete_s3_keys([key for key, _, _ in doomed])
+        drop_thumbnails([key for key, _, _ in doomed])
+
+        freed = {}
+
+        db = get_db()
+        for key, key_owner, size in rows:
+            removed = db.execute("DELETE FROM orphans WHERE s3_key=?", (key,)).rowcount
+            if removed and key not in in_use:
+                freed[key_owner] = freed.get(key_owner, 0) + size
+        db.commit()
+        db.close()
+
+        for key_owner, size in freed.items():
+            adjust_usage(key_owner, -size)
+
+        deleted += len(doomed)
+
+        if progress:
+            progress(deleted)
+
+        if rate:
+            time.sleep(max(0, started + deleted / rate - time.time()))
+
+
+def schedule_orphan_sweep(username):
+    """Queue delete_orphans for the user if anything is waiting, unless a
+    sweep is queued already. Call it after the transaction commits.
+    Returns the id of the job that will do it, or None."""
+
+    db = get_db()
+    waiting = db.execute(
+        "SELECT 1 FROM orphans WHERE owner=? LIMIT 1", (username,)
+    ).fetchone()
+    queued = waiting and db.execute(
+        "SELECT id FROM jobs WHERE kind='delete_orphans' AND owner=? AND state='queued'",
+        (username,)
+    ).fetchone()
+    db.close()
+
+    if not waiting:
+        return None
+
+    if queued:
+        return queued[0]
+
+    return enqueue_job("delete_orphans", {"owner": username}, owner=username)
+
+
+def delete_user_s3_folder(username, progress=None):
+
+    if not username:
+        raise ValueError("Invalid username — refusing to delete.")
+
+    delete_prefix_objects(THUMB_OWNER, f"{THUMB_PREFIX}{username}/")
+
+    return delete_prefix_objects(username, f"{username}/", progress) > 0
 
 
 @app.route("/admin/delete-user/<username>", methods=["POST"])
 def delete_user(username):
 
-    if session.get("role") != "admin":
-        return "Access Denied", 403
+    if session.get("role") != "admin":
+        return "Access Denied", 403
+
+    if username == session["user"]:
+        return "Admin cannot delete himself!"
+
+    try:
+        db = get_db()
+        cursor = db.cursor()
+
+        # confirm user exists
+        cursor.execute("SELECT * FROM users WHERE username=?", (username,))
+        user = cursor.fetchone()
+
+        if not user:
+            return "User not found", 404
+
+        cursor.execute("DELETE FROM users WHERE username=?", (username,))
+        cursor.execute("DELETE FROM drive WHERE username=?", (username,))
+        cursor.execute("DELETE FROM nodes WHERE owner=?", (username,))
+        cursor.execute("DELETE FROM recent_activity WHERE username=?", (username,))
+
+        # the whole prefix goes below, not object by object (thumbnails too)
+        cursor.execute("DELETE FROM orphans WHERE owner=?", (username,))
+        cursor.execute(
+            "DELETE FROM thumbs WHERE substr(s3_key, 1, ?) = ?",
+            (len(username) + 1, username + "/")
+        )
+
+        db.commit()
+
+        invalidate_user_session(username)
+        drop_cached_drive(username)
+
+        # S3 files go in the background (the ledger row goes with them)
+        enqueue_job(
+            "delete_user_files",
+            {"username": username},
+            owner=session["user"]
+        )
+
+    except Exception as e:
+        print("Delete error:", e)
+        return "Failed to delete user", 500
+
+    finally:
+        db.close()
+
+    return redirect(url_for("admin_panel"))
+
+
+
+
+# Drive APi
+
+def drive_etag(username, revision):
+    """Versions count per user (and start at 0 for everyone), the ETag
+    names the user too so one user's copy never validates another's."""
+
+    user = hashlib.sha1(username.encode()).hexdigest()[:12]
+    return f"{user}-v{revision[0]}.{revision[1]}"
+
+
+@app.route("/api/drive", methods=["GET"])
+def get_drive():
+
+    if "user" not in session:
+        return jsonify({"error":"unauthorized"}),401
+
+    username = session["user"]
+
+    # the dashboard lists folders through /api/list and recent entries
+    # through /api/recent, it only needs the version
+    if request.args.get("tree") == "0":
+        db = get_db()
+        try:
+            version = get_drive_version(db, username)
+        finally:
+            db.close()
+
+        return jsonify({"version": version})
+
+    db = get_db()
+    try:
+        etag = drive_etag(username, get_drive_revision(db, username))
+    finally:
+        db.close()
+
+    # unchanged since the browser's copy: no tree, no body
+    if etag in request.if_none_match:
+        resp = app.response_class(status=304)
+    else:
+        revision, body = load_drive_body(username)
+        etag = drive_etag(username, revision)
+        resp = app.response_class(body, mimetype="application/json")
+
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.vary.add("Cookie")
+    return resp
+
+
+
+@app.route("/api/drive", methods=["POST"])
+def save_drive():
+
+    if "user" not in session:
+        return jsonify({"error":"unauthorized"}),401
+
+    drive_body_bytes.observe(request.content_length or 0, "save")
+
+    try:
+        save_data(request.json)
+    except DriveConflict as e:
+        return jsonify({"error": "conflict", "version": e.version}), 409
+
+    schedule_orphan_sweep(session["user"])
+
+    return jsonify({"status":"ok"})
+
+
+
+# DRIVE OPS
+#
+# Small edits against the version the client last loaded, instead of
+# re-posting the whole tree:
+#
+#   {"base_version": 12, "ops": [
+#       {"op": "add",    "path": ["root", "docs"], "kind": "folder"},
+#       {"op": "move",   "from": ["root", "a.txt"], "to": ["trash", "a.txt"]},
+#       {"op": "remove", "path": ["trash", "old"]},
+#       {"op": "set",    "path": ["root", "a.txt"], "attrs": {"type": "text/plain"}},
+#       {"op": "add",    "path": ["recent"], "entry": {...}}
+#   ]}
+#
+# Paths start with the area ("root", "trash" or "recent") and name the node
+# exactly: every lookup is one indexed (owner, parent_id, name) probe per
+# level, never a scan. All ops apply in one transaction, or none do; a
+# stale base_version gets a 409 (unless every op is a "recent" one: those
+# don't touch the drive, so nothing can conflict).
+
+MAX_DRIVE_OPS = 500
+
+
+class DriveOpError(Exception):
+    pass
+
+
+def op_area(op):
+    """"root", "trash" or "recent": the area the op's path starts in."""
+
+    path = op.get("path") or op.get("from") or [None]
+    return path[0] if isinstance(path, list) and path else None
+
+
+def is_inside(db, folder_id, node_id):
+    """True when folder_id is node_id or one of its descendants (a folder
+    can't go inside itself)."""
+
+    ancestor = folder_id
+    while ancestor is not None:
+        if ancestor == node_id:
+            return True
+        ancestor = db.execute(
+            "SELECT parent_id FROM nodes WHERE id=?", (ancestor,)
+        ).fetchone()[0]
+    return False
+
+
+def op_path(value, areas=("root", "trash")):
+
+    if (
+        not isinstance(value, list) or len(value) < 2
+        or value[0] not in areas
+        or not all(isinstance(n, str) and n and "/" not in n for n in value[1:])
+    ):
+        raise DriveOpError("invalid path")
+
+    return value
+
+
+def find_node(db, username, path):
+    """The row at ["root"|"trash", ..., name], or None."""
+
+    parent_id = resolve_folder(db, username, path[1:-1], area=path[0])
+    return parent_id and find_child(db, username, parent_id, path[-1])
+
+
+def apply_tree_op(db, username, op):
+
+    kind = op.get("op")
+
+    if kind == "add":
+        path = op_path(op.get("path"))
+        parent_id = resolve_folder(db, username, path[1:-1], area=path[0])
+
+        if parent_id is None:
+            raise DriveOpError("no such folder")
+
+        if op.get("kind", "folder") == "folder":
+            db.execute(
+                """
+                INSERT INTO nodes (owner, parent_id, name, kind, created, modified)
+                VALUES (?, ?, ?, 'folder', ?, ?)
+                """,
+                (username, parent_id, path[-1], timestamp(), timestamp())
+            )
+            return
+
+        s3_key = key_from_url(op.get("url"))
+
+        # only the user's own objects can be linked in
+        if s3_key is None or not may_link(db, username, s3_key):
+            raise DriveOpError("invalid url")
+
+        size = linked_size(db, s3_key)
+
+        db.execute(
+            """
+            INSERT INTO nodes (owner, parent_id, name, kind, size, mime, s3_key, created, modified)
+            VALUES (?, ?, ?, 'file', ?, ?, ?, ?, ?)
+            """,
+            (username, parent_id, path[-1], size, op.get("type"), s3_key,
+             timestamp(), timestamp())
+        )
+        return
+
+    if kind == "remove":
+        node = find_node(db, username, op_path(op.get("path")))
+
+        if not node:
+            raise DriveOpError("not found")
+
+        db.execute(
+            SUBTREE_CTE + "DELETE FROM nodes WHERE id IN (SELECT id FROM subtree)",
+            (node[0], username)
+        )
+        return
+
+    if kind == "move":
+        src = op_path(op.get("from"))
+        dst = op_path(op.get("to"))
+
+        node = find_node(db, username, src)
+        if not node:
+            raise DriveOpError("not found")
+
+        parent_id = resolve_folder(db, username, dst[1:-1], area=dst[0])
+        if parent_id is None:
+            raise DriveOpError("no such folder")
+
+        if is_inside(db, parent_id, node[0]):
+            raise DriveOpError("cannot move a folder into itself")
+
+        db.execute(
+            "UPDATE nodes SET parent_id=?, name=?, modified=? WHERE id=?",
+            (parent_id, dst[-1], timestamp(), node[0])
+        )
+        return
+
+    if kind == "set":
+        node = find_node(db, username, op_path(op.get("path")))
+        attrs = op.get("attrs")
+
+        if not node:
+            raise DriveOpError("not found")
+
+        # the name and url only change through /api/rename (S3 follows)
+        if node[3] != "file" or not isinstance(attrs, dict) or set(attrs) - {"type"}:
+            raise DriveOpError("invalid attrs")
+
+        db.execute(
+            "UPDATE nodes SET mime=?, modified=? WHERE id=?",
+            (attrs.get("type"), timestamp(), node[0])
+        )
+        return
+
+    raise DriveOpError("unknown op")
+
+
+def apply_recent_op(db, username, op):
+    """Apply one op to the user's `recent_activity` rows.
+
+    Entries are addressed by the path of the item they point at, e.g.
+    ["recent", "root", "docs", "a.txt"]. The two-part ["recent", name] form
+    matches on the bare name, for entries saved before they had a path.
+    """
+
+    kind = op.get("op")
+    path = op.get("path")
+
+    if kind == "add" and path == ["recent"]:
+        entry = op.get("entry")
+        if not isinstance(entry, dict) or not isinstance(entry.get("name"), str) \
+                or not entry["name"]:
+            raise DriveOpError("invalid entry")
+        add_recent(db, username, entry)
+        return
+
+    if not isinstance(path, list) or len(path) < 2 or path[0] != "recent":
+        raise DriveOpError("invalid path")
+
+    target = path[1:]
+    attrs = op.get("attrs") if isinstance(op.get("attrs"), dict) else {}
+
+    if len(target) == 1:
+        if kind == "remove":
+            db.execute(
+                "DELETE FROM recent_activity WHERE username=? AND name=?",
+                (username, target[0])
+            )
+            return
+
+        new_name = attrs.get("name")
+        if kind == "set" and isinstance(new_name, str) and new_name:
+            db.execute(
+                "UPDATE recent_activity SET name=? WHERE username=? AND name=?",
+                (new_name, username, target[0])
+            )
+            return
+
+        raise DriveOpError("unknown op")
+
+    op_path(target)
+    depth = len(target)
+
+    if kind == "remove":
+        db.execute(
+            "DELETE FROM recent_activity WHERE username=? AND path=?",
+            (username, json.dumps(target))
+        )
+        return
+
+    if kind == "set":
+        new_path = op_path(attrs.get("path"))
+
+        # a renamed folder takes the recent entries inside it along
+        prefix = json.dumps(target)[:-1]
+        rows = db.execute(
+            "SELECT id, path FROM recent_activity WHERE username=? AND substr(path, 1, ?) = ?",
+            (username, len(prefix), prefix)
+        ).fetchall()
+
+        for entry_id, old in rows:
+            old = json.loads(old)
+            if old[:depth] != target:
+                continue
+
+            db.execute(
+                "UPDATE recent_activity SET path=? WHERE id=?",
+                (json.dumps(new_path + old[depth:]), entry_id)
+            )
+            if len(old) == depth:
+                db.execute(
+                    "UPDATE recent_activity SET name=? WHERE id=?",
+                    (new_path[-1], entry_id)
+                )
+        return
+
+    raise DriveOpError("unknown op")
+
+
+@app.route("/api/drive/ops", methods=["POST"])
+def drive_ops():
+
+    if "user" not in session:
+        return jsonify({"error":"unauthorized"}),401
+
+    info = request.get_json(silent=True) or {}
+    ops = info.get("ops")
+    base = info.get("base_version")
+
+    if not isinstance(ops, list) or not isinstance(base, int) or len(ops) > MAX_DRIVE_OPS:
+        return jsonify({"error": "invalid data"}), 400
+
+    username = session["user"]
+
+    recent_only = ops and all(
+        isinstance(op, dict) and op_area(op) == "recent" for op in ops
+    )
+
+    db = get_db()
+
+    try:
+        db.execute("BEGIN IMMEDIATE")
+
+        version = get_drive_version(db, username)
+
+        if base != version and not recent_only:
+            db.rollback()
+            return jsonify({"error": "conflict", "version": version}), 409
+
+        for index, op in enumerate(ops):
+            try:
+                if not isinstance(op, dict):
+                    raise DriveOpError("invalid op")
+
+                if op_area(op) == "recent":
+                    apply_recent_op(db, username, op)
+                else:
+                    apply_tree_op(db, username, op)
+
+            except sqlite3.IntegrityError:
+                db.rollback()
+                return jsonify({"error": "exists", "op": index}), 400
+
+            except DriveOpError as e:
+                db.rollback()
+                return jsonify({"error": str(e), "op": index}), 400
+
+        version = get_drive_version(db, username)
+        db.commit()
+
+    except Exception:
+        db.rollback()
+        raise
+
+    finally:
+        db.close()
+
+    body = {"status": "ok", "version": version}
+
+    # removed files give their objects back in the background
+    job_id = schedule_orphan_sweep(username)
+    if job_id:
+        body["job_id"] = job_id
+
+    return jsonify(body)
+
+
+
+# RECENT ACTIVITY
+#
+# /api/recent?q=&type=&limit=&cursor=
+#
+# The "Recent" list, one `recent_activity` row per entry, newest first. It
+# used to be a JSON array in drive.data that every drive read and write
+# carried along; now entries are written by the "recent" drive ops and
+# read a page at a time. Each user keeps the newest RECENT_LIMIT entries,
+# adding one trims the rest. q filters on the name (substring,
+# case-insensitive), type is "file" or "folder". Recent entries are not
+# part of the drive and don't move its version.
+
+RECENT_LIMIT = int(os.environ.get("MINIDRIVE_RECENT_LIMIT", "200"))
+RECENT_PAGE = 50
+
+
+def add_recent(db, username, entry, ts=None):
+    """Insert one entry (the client's {name, type, size, path, time,
+    owner}) and trim the user's list back to RECENT_LIMIT."""
+
+    path = entry.get("path")
+    if not isinstance(path, list) or not all(isinstance(p, str) for p in path):
+        path = None
+
+    size = entry.get("size")
+    if isinstance(size, bool) or not isinstance(size, (int, float)):
+        size = None
+
+    db.execute(
+        """
+        INSERT INTO recent_activity (username, ts, name, kind, size, path, time, owner)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            username,
+            time.time() if ts is None else ts,
+            entry["name"],
+            "folder" if entry.get("type") == "folder" else "file",
+            size,
+            json.dumps(path) if path else None,
+            str(entry.get("time") or timestamp()),
+            str(entry.get("owner") or "me")
+        )
+    )
+
+    db.execute(
+        """
+        DELETE FROM recent_activity
+        WHERE username = ? AND id IN (
+            SELECT id FROM recent_activity WHERE username = ?
+            ORDER BY ts DESC, id DESC
+            LIMIT -1 OFFSET ?
+        )
+        """,
+        (username, username, RECENT_LIMIT)
+    )
+
+
+def recent_entry(entry_id, name, kind, size, path, shown, owner):
+    """A row in the shape the dashboard has always kept entries in."""
+
+    entry = {
+        "id": entry_id,
+        "name": name,
+        "type": kind,
+        "size": size if size is not None else "",
+        "time": shown,
+        "owner": owner
+    }
+
+    if path:
+        entry["path"] = json.loads(path)
+
+    return entry
+
+
+@app.route("/api/recent")
+def list_recent():
+
+    if "user" not in session:
+        return jsonify({"error":"unauthorized"}),401
+
+    username = session["user"]
+
+    query = (request.args.get("q") or "").strip()
+    kind = request.args.get("type") or None
+
+    try:
+        limit = min(int(request.args.get("limit") or RECENT_PAGE), RECENT_LIMIT)
+    except ValueError:
+        return jsonify({"error": "invalid data"}), 400
+
+    if kind not in (None, "file", "folder") or limit < 1:
+        return jsonify({"error": "invalid data"}), 400
+
+    where = ["username = ?"]
+    args = [username]
+
+    if query:
+        where.append("name LIKE ? ESCAPE '\\'")
+        args.append(f"%{escape_like(query)}%")
+
+    if kind:
+        where.append("kind = ?")
+        args.append(kind)
+
+    # cursor: (ts, id) of the last entry sent, same trick as /api/list
+    if request.args.get("cursor"):
+        cursor = decode_cursor(request.args["cursor"])
+
+        if not isinstance(cursor, list) or len(cursor) != 2:
+            return jsonify({"error": "invalid cursor"}), 400
+
+        where.append("ts <= ? AND (ts < ? OR id < ?)")
+        args += [cursor[0], cursor[0], cursor[1]]
+
+    db = get_db()
+    rows = db.execute(
+        f"""
+        SELECT id, name, kind, size, path, time, owner, ts
+        FROM recent_activity
+        WHERE {' AND '.join(where)}
+        ORDER BY ts DESC, id DESC
+        LIMIT ?
+        """,
+        args + [limit + 1]
+    ).fetchall()
+    db.close()
+
+    page = rows[:limit]
+
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor([page[-1][7], page[-1][0]])
+
+    return jsonify({
+        "items": [recent_entry(*row[:7]) for row in page],
+        "next_cursor": next_cursor
+    })
+
+
+def migrate_recent_lists():
+    """One-shot move of the recent arrays in drive.data into
+    `recent_activity`, kept in their order. Running it again is a no-op."""
+
+    db = get_db()
+
+    try:
+        usernames = [r[0] for r in db.execute(
+            """
+            SELECT username FROM drive
+            WHERE data LIKE '%"recent"%' AND data NOT LIKE '%"recent": []%'
+            """
+        ).fetchall()]
+
+        for username in usernames:
+
+            db.execute("BEGIN IMMEDIATE")
+
+            # read again inside the transaction, another process may
+            # have moved it meanwhile
+            raw = db.execute(
+                "SELECT data FROM drive WHERE username=?",
+                (username,)
+            ).fetchone()[0]
+
+            recent = json.loads(raw or "{}").get("recent") or []
+            now = time.time()
+
+            # oldest first, each a little older than the one above it
+            for age, entry in reversed(list(enumerate(recent[:RECENT_LIMIT]))):
+                if isinstance(entry, dict) and isinstance(entry.get("name"), str) \
+                        and entry["name"]:
+                    add_recent(db, username, entry, ts=now - age)
+
+            db.execute(
+                "UPDATE drive SET data=? WHERE username=?",
+                (json.dumps({"recent": []}), username)
+            )
+
+            db.commit()
+
+    finally:
+        db.close()
+
+
+# TRASH
+#
+# Trashed items stay in their owner's "trash" container; the `trash` table
+# (kept by triggers) says when each top level item got there. Items older
+# than TRASH_TTL days are purged by a background loop every
+# TRASH_PURGE_INTERVAL seconds: their nodes are deleted a batch at a time,
+# which queues their objects in `orphans`, then the orphans of all users
+# go in delete_objects calls of DELETE_BATCH keys, at most PURGE_RATE
+# objects a second so a big purge doesn't crowd out user traffic.
+#
+# Emptying the trash only backdates the user's rows (deleted_at 0): the
+# items disappear from listings at once and a purge job removes them.
+
+TRASH_TTL = int(os.environ.get("MINIDRIVE_TRASH_TTL_DAYS", "30")) * 86400   # 0 = keep
+TRASH_PURGE_INTERVAL = int(os.environ.get("MINIDRIVE_TRASH_PURGE_INTERVAL", "3600"))
+TRASH_PURGE_BATCH = 100       # top level items deleted per transaction
+PURGE_RATE = int(os.environ.get("MINIDRIVE_PURGE_RATE", "2000"))
+
+
+def trash_cutoff():
+    """Trash rows with deleted_at at or before this are gone for the user."""
+
+    return time.time() - TRASH_TTL if TRASH_TTL > 0 else 0
+
+
+def trash_expired(db, node_id):
+    """True for a top level trash item that is gone for the user (past its
+    TTL or emptied), though the purge hasn't deleted it yet."""
+
+    return db.execute(
+        "SELECT 1 FROM trash WHERE node_id=? AND deleted_at <= ?",
+        (node_id, trash_cutoff())
+    ).fetchone() is not None
+
+
+def trash_path_expired(db, username, path):
+    """True for a path inside a trash item that is gone for the user.
+    Only the top level item (path[1]) has a `trash` row."""
+
+    if path[0] != "trash" or len(path) < 2:
+        return False
+
+    top = find_node(db, username, path[:2])
+    return top is not None and trash_expired(db, top[0])
+
+
+def purge_trash(progress=None):
+    """Delete expired (or emptied) trash items and then their objects.
+    Returns (items, objects) deleted."""
+
+    items = 0
+
+    while True:
+        db = get_db()
+
+        try:
+            db.execute("BEGIN IMMEDIATE")
+
+            rows = db.execute(
+                """
+                SELECT node_id, owner FROM trash
+                WHERE deleted_at <= ?
+                ORDER BY deleted_at
+                LIMIT ?
+                """,
+                (trash_cutoff(), TRASH_PURGE_BATCH)
+            ).fetchall()
+
+            # the trash rows go with the nodes (trigger)
+            for node_id, owner in rows:
+                db.execute(
+                    SUBTREE_CTE + "DELETE FROM nodes WHERE id IN (SELECT id FROM subtree)",
+                    (node_id, owner)
+                )
+
+            db.commit()
+
+        finally:
+            db.close()
+
+        if not rows:
+            break
+
+        items += len(rows)
+
+    return items, delete_orphans(None, progress, rate=PURGE_RATE)
+
+
+def schedule_trash_purge():
+    """Queue a purge_trash job unless one is queued already; returns its id."""
+
+    db = get_db()
+    queued = db.execute(
+        "SELECT id FROM jobs WHERE kind='purge_trash' AND state='queued'"
+    ).fetchone()
+    db.close()
+
+    if queued:
+        return queued[0]
+
+    return enqueue_job("purge_trash", {})
+
+
+@app.route("/api/trash/empty", methods=["POST"])
+def empty_trash():
+
+    if "user" not in session:
+        return jsonify({"error":"unauthorized"}),401
+
+    username = session["user"]
+
+    db = get_db()
+    emptied = db.execute(
+        "UPDATE trash SET deleted_at = 0 WHERE owner=? AND deleted_at > 0",
+        (username,)
+    ).rowcount
+    db.commit()
+    db.close()
+
+    body = {"status": "emptied", "items": emptied}
+
+    if emptied:
+        body["job_id"] = schedule_trash_purge()
+
+    return jsonify(body)
+
+
+def start_trash_purger():
+
+    def loop():
+        while True:
+            try:
+                items, objects = purge_trash()
+                if items or objects:
+                    print("Trash purge:", items, "items,", objects, "objects")
+            except Exception as e:
+                print("Trash purge error:", e)
+
+            time.sleep(TRASH_PURGE_INTERVAL)
+
+    threading.Thread(
+        target=loop,
+        name="trash-purge",
+        daemon=True
+    ).start()
+
+
+# SEARCH
+#
+# /api/search?q=&type=&min_size=&area=&cursor=
+#
+# q is matched as a substring (case-insensitive) against names and mime
+# types through the trigram index, name hits ranking above mime hits; then
+# come path hits, everything inside folders whose name matches. Queries
+# under 3 characters can't use trigrams and fall back to a LIKE over the
+# user's own rows. type is "file", "folder" or a mime prefix ("image",
+# "application/pdf"), min_size is in MB like the sizes the drive shows.
+# cursor is opaque to the client.
+#
+# The index has no paths (a folder move would have to re-index everything
+# inside it): each hit's path is read upwards through its folders, every
+# folder once per request, and hits outside the area are skipped.
+
+SEARCH_PAGE = 50
+SEARCH_WEIGHTS = "10.0, 1.0"     # name, mime
+
+
+def escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def folder_resolver(db):
+    """folder id -> (path, top): the folder's path from its area container
+    ("root/docs/2024") and the id of its ancestor directly in the container
+    (None for the container itself). None for a folder deleted meanwhile."""
+
+    memo = {}
+
+    def resolve(folder_id):
+        chain = []
+        node = folder_id
+
+        while node not in memo:
+            row = db.execute("SELECT parent_id, name FROM nodes WHERE id=?", (node,)).fetchone()
+            if row is None:
+                return None
+
+            if row[0] is None:
+                memo[node] = (row[1], None)
+                break
+
+            chain.append((node, row[0], row[1]))
+            node = row[0]
+
+        for node, parent_id, name in reversed(chain):
+            path, top = memo[parent_id]
+            memo[node] = (path + "/" + name, top or node)
+
+        return memo[folder_id]
+
+    return resolve
+
+
+@app.route("/api/search")
+def search_drive():
+
+    if "user" not in session:
+        return jsonify({"error":"unauthorized"}),401
+
+    username = session["user"]
+
+    q = request.args.get("q", "").strip()
+    kind = request.args.get("type", "").strip()
+    area = request.args.get("area", "root")
+
+    try:
+        min_size = float(request.args.get("min_size") or 0)
+        offset = int(request.args.get("cursor") or 0)
+        limit = min(int(request.args.get("limit") or SEARCH_PAGE), 200)
+    except ValueError:
+        return jsonify({"error": "invalid data"}), 400
+
+    if area not in ("root", "trash") or offset < 0 or limit < 1:
+        return jsonify({"error": "invalid data"}), 400
+
+    where = ["n.owner = ?"]
+    args = [username]
+
+    if kind == "folder":
+        where.append("n.kind = 'folder'")
+    elif kind == "file":
+        where.append("n.kind = 'file'")
+    elif kind:
+        where.append("n.mime LIKE ? ESCAPE '\\'")
+        args.append(escape_like(kind) + "%")
+
+    if min_size:
+        where.append("n.size >= ?")
+        args.append(int(min_size * MB))
+
+    columns = "n.id, n.name, n.kind, n.size, n.mime, n.s3_key, n.parent_id"
+
+    if len(q) >= 3:
+        match = '"' + q.replace('"', '""') + '"'
+        queries = [
+            (f"""
+                SELECT {columns}
+                FROM nodes_fts f JOIN nodes n ON n.id = f.rowid
+                WHERE nodes_fts MATCH ? AND {" AND ".join(where)}
+                ORDER BY bm25(nodes_fts, {SEARCH_WEIGHTS}), n.id
+            """, [match] + args),
+            (f"""
+                WITH RECURSIVE hits(id) AS MATERIALIZED (
+                    SELECT rowid FROM nodes_fts WHERE nodes_fts MATCH ?
+                ),
+                inside(id) AS (
+                    SELECT n.id FROM hits h CROSS JOIN nodes n
+                    ON n.owner = ? AND n.parent_id = h.id
+                    UNION
+                    SELECT n.id FROM inside i CROSS JOIN nodes n
+                    ON n.owner = ? AND n.parent_id = i.id
+                )
+                SELECT {columns}
+                FROM inside i JOIN nodes n ON n.id = i.id
+                WHERE {" AND ".join(where)}
+                ORDER BY length(n.name), n.name, n.id
+            """, [match, username, username] + args),
+        ]
+
+    else:
+        where += ["n.parent_id IS NOT NULL", "n.name LIKE ? ESCAPE '\\'"]
+        args.append(f"%{escape_like(q)}%")
+        queries = [(f"""
+            SELECT {columns}
+            FROM nodes n
+            WHERE {" AND ".join(where)}
+            ORDER BY length(n.name), n.name, n.id
+        """, args)]
+
+    results = []
+    seen = set()
+    skipped = 0
+    more = False
+
+    db = get_db()
+
+    try:
+        resolve = folder_resolver(db)
+
+        # nothing under a trash item that is gone for the user
+        expired = {r[0] for r in db.execute(
+            "SELECT node_id FROM trash WHERE owner=? AND deleted_at <= ?",
+            (username, trash_cutoff())
+        ).fetchall()} if area == "trash" else set()
+
+        for sql, sql_args in queries:
+            for node_id, name, node_kind, size, mime, s3_key, parent_id in db.execute(sql, sql_args):
+
+                if node_id in seen:
+                    continue
+                seen.add(node_id)
+
+                folder = resolve(parent_id)
+                if folder is None or folder[0].split("/", 1)[0] != area \
+                        or (folder[1] or node_id) in expired:
+                    continue
+
+                if skipped < offset:
+                    skipped += 1
+                    continue
+
+                if len(results) == limit:
+                    more = True
+                    break
+
+                entry = {"id": node_id, "name": name, "kind": node_kind, "path": folder[0].split("/")}
+
+                if node_kind == "file":
+                    entry.update(file_entry(node_id, size, mime, s3_key))
+
+                results.append(entry)
+
+            if more:
+                break
+
+    finally:
+        db.close()
+
+    return jsonify({
+        "results": results,
+        "next_cursor": str(offset + limit) if more else None
+    })
+
+
+
+# FOLDER LISTING
+#
+# /api/list?path=root/docs&sort=name|size|date&limit=&cursor=
+#
+# One level of one folder: folders first, then files, each in the sort order
+# with the node id breaking ties. Pagination is keyset: the cursor holds the
+# (kind, sort key, id) of the last row sent, so every page is an index range
+# scan however deep into a 50k-entry folder it is, and rows added or removed
+# meanwhile don't shift the pages after it.
+
+LIST_PAGE = 200
+LIST_MAX = 1000
+
+# sort: (expression, direction) - the expressions match the idx_nodes_list_*
+# indexes exactly. Folders have no size, so "size" lists them by name.
+LIST_SORTS = {
+    "name": ("name COLLATE NOCASE", "ASC"),
+    "size": ("COALESCE(size, 0)", "DESC"),
+    "date": ("COALESCE(modified, '')", "DESC"),
+}
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, UnicodeError):
+        return None
+
+
+def list_page(db, username, folder_id, kind, sort, after, limit, trash=False):
+    """Up to `limit` children of one kind, after the (key, id) pair `after`.
+    trash=True leaves out trashed items that are past their TTL."""
+
+    expr, direction = LIST_SORTS["name" if kind == "folder" and sort == "size" else sort]
+    op = ">" if direction == "ASC" else "<"
+
+    where = "owner=? AND parent_id=? AND kind=?"
+    args = [username, folder_id, kind]
+
+    if trash:
+        where += " AND id NOT IN (SELECT node_id FROM trash WHERE owner=? AND deleted_at <= ?)"
+        args += [username, trash_cutoff()]
+
+    # "key >= k AND (key > k OR id > i)" keeps the index range usable
+    if after:
+        where += f" AND {expr} {op}= ? AND ({expr} {op} ? OR id {op} ?)"
+        args += [after[0], after[0], after[1]]
+
+    return db.execute(
+        f"""
+        SELECT id, name, kind, size, mime, s3_key, modified, {expr}
+        FROM nodes
+        WHERE {where}
+        ORDER BY {expr} {direction}, id {direction}
+        LIMIT ?
+        """,
+        args + [limit]
+    ).fetchall()
+
+
+@app.route("/api/list")
+def list_folder():
+
+    if "user" not in session:
+        return jsonify({"error":"unauthorized"}),401
+
+    username = session["user"]
+
+    path = [p for p in request.args.get("path", "root").split("/") if p]
+    sort = request.args.get("sort", "name")
+
+    try:
+        limit = min(int(request.args.get("limit") or LIST_PAGE), LIST_MAX)
+    except ValueError:
+        return jsonify({"error": "invalid data"}), 400
+
+    if not path or path[0] not in ("root", "trash") or sort not in LIST_SORTS or limit < 1:
+        return jsonify({"error": "invalid data"}), 400
+
+    # cursor: [sort, kind, key, id] of the last row of the previous page
+    phase, after = "folder", None
+
+    if request.args.get("cursor"):
+        cursor = decode_cursor(request.args["cursor"])
+
+        if not isinstance(cursor, list) or len(cursor) != 4 or cursor[0] != sort \
+                or cursor[1] not in ("folder", "file"):
+            return jsonify({"error": "invalid cursor"}), 400
+
+        phase, after = cursor[1], cursor[2:]
+
+    db = get_db()
+
+    try:
+        folder_id = resolve_folder(db, username, path[1:], area=path[0])
+
+        if folder_id is None or trash_path_expired(db, username, path):
+            return jsonify({"error": "not found"}), 404
+
+        rows = []
+        trash = path == ["trash"]
+
+        if phase == "folder":
+            rows = list_page(db, username, folder_id, "folder", sort, after, limit + 1, trash)
+            if len(rows) <= limit:
+                after = None
+
+        if len(rows) <= limit:
+            rows += list_page(
+                db, username, folder_id, "file", sort, after, limit + 1 - len(rows), trash
+            )
+
+        page, more = rows[:limit], len(rows) > limit
+
+        # child counts for the folders on this page, one grouped query
+        folder_ids = [r[0] for r in page if r[2] != "file"]
+        counts = {}
+
+        if folder_ids:
+            counts = dict(db.execute(
+                f"""
+                SELECT parent_id, COUNT(*) FROM nodes
+                WHERE owner=? AND parent_id IN ({",".join("?" * len(folder_ids))})
+                GROUP BY parent_id
+                """,
+                [username] + folder_ids
+            ).fetchall())
+
+        # thumbnail state of the files on this page, same idea
+        file_keys = [r[5] for r in page if r[2] == "file" and r[5]]
+        thumbs = {}
+
+        if file_keys:
+            thumbs = dict(db.execute(
+                f"SELECT s3_key, state FROM thumbs WHERE s3_key IN ({','.join('?' * len(file_keys))})",
+                file_keys
+            ).fetchall())
+
+        version = get_drive_version(db, username)
+
+    finally:
+        db.close()
+
+    # images from before thumbnails existed get theirs once they are seen
+    queue_thumbnails([
+        (r[5], r[4], r[3]) for r in page if r[2] == "file" and r[5] and r[5] not in thumbs
+    ])
+
+    items = []
+
+    for node_id, name, kind, size, mime, s3_key, modified, _ in page:
+
+        item = {"name": name, "kind": kind, "modified": modified}
+
+        if kind == "file":
+            item.update(file_entry(node_id, size, mime, s3_key))
+
+            if thumbs.get(s3_key) == "ready":
+                item["thumb"] = thumb_url(node_id, s3_key)
+        else:
+            item["children"] = counts.get(node_id, 0)
+
+        items.append(item)
+
+    next_cursor = None
+    if more:
+        last = page[-1]
+        next_cursor = encode_cursor([sort, last[2], last[7], last[0]])
+
+    return jsonify({
+        "path": path,
+        "items": items,
+        "next_cursor": next_cursor,
+        "version": version
+    })
+
+
+@app.route("/api/folder-size")
+def folder_size():
+
+    if "user" not in session:
+        return jsonify({"error":"unauthorized"}),401
+
+    username = session["user"]
+    path = [p for p in request.args.get("path", "").split("/") if p]
+
+    if len(path) < 2 or path[0] not in ("root", "trash"):
+        return jsonify({"error": "invalid data"}), 400
+
+    db = get_db()
+
+    try:
+        folder_id = resolve_folder(db, username, path[1:], area=path[0])
+
+        # an expired trash item counts for nothing, whatever is inside
+        if folder_id is None or trash_path_expired(db, username, path):
+            return jsonify({"error": "not found"}), 404
+
+        size, files = db.execute(
+            SUBTREE_CTE + """
+            SELECT COALESCE(SUM(n.size), 0), COUNT(n.s3_key)
+            FROM nodes n JOIN subtree s ON n.id = s.id
+            WHERE n.kind = 'file'
+            """,
+            (folder_id, username)
+        ).fetchone()
+
+    finally:
+        db.close()
+
+    return jsonify({"size": to_mb(size), "files": files})
+
+
+
+#  create folder
+
+@app.route("/api/create-folder", methods=["POST"])
+def create_folder():
+
+    info = request.get_json()
+
+    if not info:
+        return jsonify({"error": "No data"}), 400
+
+    name = info.get("name")
+    path = info.get("path")
+
+    if not name or not path:
+        return jsonify({"error": "Invalid data"}), 400
+
+
+    username = session["user"]
+
+    db = get_db()
+
+    try:
+        parent_id = resolve_folder(db, username, path[1:], create=True)
+
+        if parent_id is None:
+            return jsonify({"error": "Invalid data"}), 400
+
+        if find_child(db, username, parent_id, name):
+            return jsonify({"error": "exists"}), 400
+
+        # folders only exist in metadata (object keys don't follow paths)
+        db.execute(
+            """
+            INSERT INTO nodes (owner, parent_id, name, kind, created, modified)
+            VALUES (?, ?, ?, 'folder', ?, ?)
+            """,
+            (username, parent_id, name, timestamp(), timestamp())
+        )
+
+        db.commit()
+
+    except sqlite3.IntegrityError:
+        return jsonify({"error": "exists"}), 400
+
+    finally:
+        db.close()
+
+    return jsonify({"status": "created"})
+
+
+
+
+# FILE UPLOAD WITH PATH SUPPORT
+
+MINIDRIVE_LIMIT_MB = 3 * 1024   # 3 GB
+
+MINIDRIVE_LIMIT_BYTES = MINIDRIVE_LIMIT_MB * 1024 * 1024
+
+# how often the background job re-checks the ledger against S3 (0 = off)
+RECONCILE_INTERVAL = int(os.environ.get("MINIDRIVE_RECONCILE_INTERVAL", "900"))
+
+# prefixes listed in parallel by a scan, and how old a scan the admin page
+# accepts before it asks for a fresh one
+SCAN_WORKERS = int(os.environ.get("MINIDRIVE_SCAN_WORKERS", "8"))
+USAGE_MAX_AGE = int(os.environ.get("MINIDRIVE_USAGE_MAX_AGE", "900"))
+
+
+def get_total_minidrive_storage():
+
+    db = get_db()
+
+    used_bytes = db.execute(
+        "SELECT used_bytes FROM storage_pool WHERE id = 1"
+    ).fetchone()[0]
+
+    db.close()
+
+    return round(used_bytes / (1024 * 1024), 2)  # MB
+
+
+def reserve_storage(username, size):
+    """Reserve `size` bytes of the shared pool before an upload starts.
+
+    The limit check and the reservation are one UPDATE, so two uploads
+    racing for the last free bytes can't both get through.
+    Returns False when the pool is full.
+    """
+
+    db = get_db()
+
+    try:
+        cur = db.execute(
+            """
+            UPDATE storage_pool
+            SET reserved_bytes = reserved_bytes + ?
+            WHERE id = 1 AND used_bytes + reserved_bytes + ? <= ?
+            """,
+            (size, size, MINIDRIVE_LIMIT_BYTES)
+        )
+
+        if cur.rowcount == 0:
+            db.rollback()
+            return False
+
+        db.execute(
+            """
+            INSERT INTO storage_usage (username, reserved_bytes) VALUES (?, ?)
+            ON CONFLICT(username) DO UPDATE
+            SET reserved_bytes = reserved_bytes + excluded.reserved_bytes
+            """,
+            (username, size)
+        )
+
+        db.commit()
+        return True
+
+    finally:
+        db.close()
+
+
+def commit_storage(username, reserved, used, charge_to=None):
+    """Turn a reservation into real usage (`used` may differ from the
+    reservation, and is 0 when the upload failed). `used` goes on
+    charge_to's row when the bytes belong to someone else (a new blob)."""
+
+    charge_to = charge_to or username
+
+    db = get_db()
+
+    try:
+        db.execute(
+            """
+            UPDATE storage_pool
+            SET reserved_bytes = MAX(0, reserved_bytes - ?),
+                used_bytes = MAX(0, used_bytes + ?)
+            WHERE id = 1
+            """,
+            (reserved, used)
+        )
+
+        for owner, owner_reserved, owner_used in (
+            [(username, reserved, used)] if charge_to == username
+            else [(username, reserved, 0), (charge_to, 0, used)]
+        ):
+            db.execute(
+                """
+                INSERT INTO storage_usage (username, used_bytes) VALUES (?, MAX(0, ?))
+                ON CONFLICT(username) DO UPDATE
+                SET reserved_bytes = MAX(0, reserved_bytes - ?),
+                    used_bytes = MAX(0, used_bytes + ?)
+                """,
+                (owner, owner_used, owner_reserved, owner_used)
+            )
+
+        db.commit()
+
+    finally:
+        db.close()
+
+
+def release_storage(username, reserved):
+    commit_storage(username, reserved, 0)
+
+
+def adjust_usage(username, delta):
+    """Add (or with a negative delta, remove) bytes that were written or
+    deleted outside of a reservation."""
+
+    if delta:
+        commit_storage(username, 0, delta)
+
+
+def forget_user_usage(cursor, username):
+    """Drop a user's ledger row inside the caller's transaction."""
+
+    row = cursor.execute(
+        "SELECT used_bytes FROM storage_usage WHERE username=?",
+        (username,)
+    ).fetchone()
+
+    if not row:
+        return
+
+    cursor.execute(
+        "UPDATE storage_pool SET used_bytes = MAX(0, used_bytes - ?) WHERE id = 1",
+        (row[0],)
+    )
+    cursor.execute("DELETE FROM storage_usage WHERE username=?", (username,))
+
+
+def object_exists(s3_key):
+    try:
+        s3.head_object(Bucket=BUCKET_NAME, Key=s3_key)
+        return True
+    except s3.exceptions.ClientError:
+        return False
+
+
+def get_object_size(s3_key):
+    try:
+        return s3.head_object(Bucket=BUCKET_NAME, Key=s3_key)["ContentLength"]
+    except s3.exceptions.ClientError:
+        return 0
+
+
+def list_prefix_usage(prefix):
+    total = objects = 0
+    paginator = s3.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            total += obj["Size"]
+            objects += 1
+
+    return total, objects
+
+
+def scan_bucket_usage():
+    """One pass over the bucket, grouped by top level prefix (= user).
+
+    The top level is listed with a delimiter first, then each prefix is
+    paginated on its own worker, so one big user doesn't hold up the rest.
+    Returns {owner: (bytes, objects)}.
+    """
+
+    totals = {}
+    prefixes = []
+    paginator = s3.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Delimiter="/"):
+        prefixes += [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+
+        # stray objects at the top level count for the "owner" they're named after
+        for obj in page.get("Contents", []):
+            size, objects = totals.get(obj["Key"], (0, 0))
+            totals[obj["Key"]] = (size + obj["Size"], objects + 1)
+
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        for prefix, (size, objects) in zip(prefixes, pool.map(list_prefix_usage, prefixes)):
+            owner = prefix.rstrip("/")
+            old_size, old_objects = totals.get(owner, (0, 0))
+            totals[owner] = (old_size + size, old_objects + objects)
+
+    return totals
+
+
+def reconcile_storage():
+    """Correct ledger drift against what is really in S3.
+
+    A row that changed while the (slow) scan was running is left alone,
+    the next run will pick it up. The pool moves by the same deltas so
+    it always equals the sum of the rows.
+
+    Uploads in progress (reserved_bytes) may already be partly in the
+    bucket without being charged, so a user's real usage is only known to
+    lie between the scanned bytes minus their reservations and the scanned
+    bytes; the ledger is only moved when it is outside that range.
+    """
+
+    db = get_db()
+    snapshot = {
+        username: (used, reserved)
+        for username, used, reserved in db.execute(
+            "SELECT username, used_bytes, reserved_bytes FROM storage_usage"
+        ).fetchall()
+    }
+    db.close()
+
+    scanned = scan_bucket_usage()
+    scanned_at = timestamp()
+
+    db = get_db()
+    drift = 0
+
+    try:
+        db.execute("BEGIN IMMEDIATE")
+
+        for owner in set(snapshot) | set(scanned):
+
+            actual = scanned.get(owner, (0, 0))[0]
+            expected = snapshot.get(owner)
+
+            if expected is None:
+                cur = db.execute(
+                    "INSERT OR IGNORE INTO storage_usage (username, used_bytes) VALUES (?, ?)",
+                    (owner, actual)
+                )
+                if cur.rowcount:
+                    drift += actual
+
+            else:
+                used, reserved = expected
+                target = max(actual - reserved, min(used, actual))
+
+                if target != used:
+                    cur = db.execute(
+                        """
+                        UPDATE storage_usage SET used_bytes=?
+                        WHERE username=? AND used_bytes=? AND reserved_bytes=?
+                        """,
+                        (target, owner, used, reserved)
+                    )
+                    if cur.rowcount:
+                        drift += target - used
+
+        db.execute(
+            """
+            UPDATE storage_pool
+            SET used_bytes = MAX(0, used_bytes + ?), reconciled_at = ?
+            WHERE id = 1
+            """,
+            (drift, scanned_at)
+        )
+
+        db.execute("DELETE FROM usage_scan")
+        db.executemany(
+            "INSERT INTO usage_scan (username, bytes, objects, scanned_at) VALUES (?, ?, ?, ?)",
+            [(owner, size, objects, scanned_at) for owner, (size, objects) in scanned.items()]
+        )
+
+        db.commit()
+
+    except Exception:
+        db.rollback()
+        raise
+
+    finally:
+        db.close()
+
+    return drift
+
+
+def start_storage_reconciler():
+
+    def loop():
+        while True:
+            try:
+                expire_pending_uploads()
+                collect_blobs()
+                drift = reconcile_storage()
+                if drift:
+                    print("Storage ledger corrected by", drift, "bytes")
+            except Exception as e:
+                print("Reconcile error:", e)
+
+            time.sleep(RECONCILE_INTERVAL)
+
+    threading.Thread(
+        target=loop,
+        name="storage-reconcile",
+        daemon=True
+    ).start()
+
+
+# CONTENT-ADDRESSED BLOBS
+#
+# Uploaded bytes are stored once per distinct content, under
+# _blobs/<sha256>, and file nodes point at the blob. The `blobs` row counts
+# the nodes pointing at it (kept by triggers on nodes), so a second upload
+# of the same bytes is just a new node, with nothing sent to S3.
+#
+# Blob bytes are charged to the pool once, on the BLOB_OWNER ledger row
+# (the same row the reconciler's scan of the _blobs/ prefix lands on);
+# each user's linked_bytes holds what their own files point at. A blob
+# nothing has pointed at for BLOB_GRACE seconds is deleted by
+# collect_blobs(). Direct uploads can't be hashed on the way in, they go
+# to the user's prefix as before and absorb_upload() moves them over.
+
+BLOB_OWNER = "_blobs"          # usernames can't start with "_"
+BLOB_PREFIX = BLOB_OWNER + "/"
+BLOB_GRACE = int(os.environ.get("MINIDRIVE_BLOB_GRACE", "3600"))
+
+
+class BlobCollected(Exception):
+    pass
+
+
+def blob_key(sha256):
+    return BLOB_PREFIX + sha256
+
+
+def is_blob_key(s3_key):
+    return bool(s3_key) and s3_key.startswith(BLOB_PREFIX)
+
+
+def hash_stream(stream):
+    """SHA-256 of a seekable stream (a spooled upload), rewound afterwards."""
+
+    digest = hashlib.sha256()
+
+    for chunk in iter(lambda: stream.read(MB), b""):
+        digest.update(chunk)
+
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def blob_state(sha256):
+    """'live', 'deleting' or None when there is no such blob."""
+
+    db = get_db()
+    row = db.execute("SELECT state FROM blobs WHERE sha256=?", (sha256,)).fetchone()
+    db.close()
+
+    return row[0] if row else None
+
+
+def claim_blob(db, sha256, size, stored):
+    """Make sure a blob can be linked, in the transaction that links it.
+
+    stored means this upload just wrote the object, so a missing row is
+    created. Returns the bytes the pool gained (the size, for a new row)
+    or None when the blob is being collected.
+    """
+
+    if stored:
+        cur = db.execute(
+            """
+            INSERT INTO blobs (sha256, size, created, idle_since)
+            VALUES (?, ?, ?, datetime('now'))
+            ON CONFLICT (sha256) DO NOTHING
+            """,
+            (sha256, size, timestamp())
+        )
+        if cur.rowcount:
+            return size
+
+    row = db.execute("SELECT state FROM blobs WHERE sha256=?", (sha256,)).fetchone()
+
+    return 0 if row and row[0] == "live" else None
+
+
+def may_link(db, username, s3_key):
+    """A client-supplied key may only name the user's own objects: their
+    prefix, or a blob one of their files already points at."""
+
+    if s3_key.startswith(username + "/"):
+        return True
+
+    return is_blob_key(s3_key) and db.execute(
+        "SELECT 1 FROM nodes WHERE owner=? AND s3_key=? LIMIT 1",
+        (username, s3_key)
+    ).fetchone() is not None
+
+
+def collect_blobs():
+    """Delete the blobs nothing has pointed at for BLOB_GRACE seconds.
+
+    Rows are marked 'deleting' first, so an upload racing the collector
+    doesn't link to (or write again) an object that is about to go; the
+    rows go once the objects are gone. Returns the bytes freed.
+    """
+
+    db = get_db()
+
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        db.execute(
+            """
+            UPDATE blobs SET state = 'deleting'
+            WHERE refs = 0 AND state = 'live' AND idle_since <= datetime('now', ?)
+            """,
+            (f"-{BLOB_GRACE} seconds",)
+        )
+        doomed = db.execute(
+            "SELECT sha256, size FROM blobs WHERE refs = 0 AND state = 'deleting'"
+        ).fetchall()
+        db.commit()
+
+    finally:
+        db.close()
+
+    if not doomed:
+        return 0
+
+    delete_s3_keys([blob_key(sha256) for sha256, _ in doomed])
+    drop_thumbnails([blob_key(sha256) for sha256, _ in doomed])
+
+    db = get_db()
+    db.executemany(
+        "DELETE FROM blobs WHERE sha256=? AND state='deleting'",
+        [(sha256,) for sha256, _ in doomed]
+    )
+    db.commit()
+    db.close()
+
+    freed = sum(size for _, size in doomed)
+    adjust_usage(BLOB_OWNER, -freed)
+
+    return freed
+
+
+def absorb_upload(owner, s3_key):
+    """Move an object uploaded straight to S3 into the blob store.
+
+    The object is hashed where it is; new content is copied to its blob
+    key (server side, and only if it is still the object that was hashed),
+    then the owner's nodes are pointed at the blob and the original is
+    deleted. Thumbnails are queued for wherever the file ends up. Returns
+    the number of the owner's orphaned objects deleted.
+    """
+
+    # already removed again, the orphan sweep has it
+    db = get_db()
+    wanted = db.execute(
+        "SELECT mime FROM nodes WHERE owner=? AND s3_key=? LIMIT 1", (owner, s3_key)
+    ).fetchone()
+    db.close()
+
+    if not wanted:
+        return 0
+
+    try:
+        obj = s3.get_object(Bucket=BUCKET_NAME, Key=s3_key)
+    except s3.exceptions.ClientError:
+        return 0
+
+    etag, size = obj["ETag"], obj["ContentLength"]
+
+    def stay():
+        queue_thumbnails([(s3_key, wanted[0], size)])
+        return 0
+
+    digest = hashlib.sha256()
+
+    for chunk in obj["Body"].iter_chunks(MB):
+        digest.update(chunk)
+
+    sha256 = digest.hexdigest()
+    state = blob_state(sha256)
+
+    if state == "deleting":
+        return stay()
+
+    if state is None:
+        copy_s3_object(
+            s3_key, blob_key(sha256), size,
+            content_type=obj.get("ContentType"), if_match=etag
+        )
+
+    # the same name may have been uploaded again since it was hashed
+    try:
+        replaced = s3.head_object(Bucket=BUCKET_NAME, Key=s3_key)["ETag"] != etag
+    except s3.exceptions.ClientError:
+        replaced = None
+
+    if replaced is not False:
+        # a blob copied for nothing is left unreferenced, to be collected
+        if state is None:
+            db = get_db()
+            db.execute("BEGIN IMMEDIATE")
+            gained = claim_blob(db, sha256, size, True) or 0
+            db.commit()
+            db.close()
+            adjust_usage(BLOB_OWNER, gained)
+
+        return stay() if replaced else 0
+
+    db = get_db()
+
+    try:
+        db.execute("BEGIN IMMEDIATE")
+
+        gained = claim_blob(db, sha256, size, state is None)
+        if gained is None:
+            db.rollback()
+            return stay()
+
+        # the original lands in `orphans` (trigger) once no node has it
+        db.execute(
+            "UPDATE nodes SET s3_key=? WHERE owner=? AND s3_key=? AND size=?",
+            (blob_key(sha256), owner, s3_key, size)
+        )
+
+        db.commit()
+
+    finally:
+        db.close()
+
+    adjust_usage(BLOB_OWNER, gained)
+    queue_thumbnails([(blob_key(sha256), wanted[0], size)])
+
+    return delete_orphans(owner)
+
+# STREAMING UPLOADS
+#
+# Uploads are copied from the request into an S3 multipart upload one part
+# at a time, with a few parts uploading in parallel. At most
+# UPLOAD_PARTS_IN_FLIGHT + 1 parts are held in memory, whatever the file size.
+#
+# /api/upload parses its multipart body as it comes off the socket
+# (request.files would have Werkzeug spool it to a temp file first): the
+# file part goes straight into the part pool and is hashed on the way.
+# Since the hash is only known at the end, the bytes land under a new key
+# of the user's, and are deduplicated afterwards like direct uploads.
+
+UPLOAD_PART_SIZE = max(5, int(os.environ.get("MINIDRIVE_UPLOAD_PART_MB", "8"))) * MB
+UPLOAD_PARTS_IN_FLIGHT = int(os.environ.get("MINIDRIVE_UPLOAD_PARTS_IN_FLIGHT", "4"))
+UPLOAD_READ_SIZE = 64 * 1024
+UPLOAD_FIELD_MAX = 64 * 1024       # form fields other than the file
+
+
+class StorageFull(Exception):
+    pass
+
+
+def multipart_events(stream, boundary):
+    """Events of a multipart/form-data body, parsed as it is read."""
+
+    # field sizes are capped by read_form_fields; the decoder's own cap
+    # would count unparsed file bytes too
+    decoder = MultipartDecoder(boundary.encode(), max_parts=16)
+
+    while True:
+        event = decoder.next_event()
+
+        if isinstance(event, NeedData):
+            decoder.receive_data(stream.read(UPLOAD_READ_SIZE) or None)
+            continue
+
+        if isinstance(event, Epilogue):
+            return
+
+        yield event
+
+
+def read_form_fields(events, fields, until=None):
+    """Collect fields into `fields` until the file part named `until`
+    starts (returned) or the body ends (None)."""
+
+    name = None
+
+    for event in events:
+        if isinstance(event, File) and event.name == until:
+            return event
+
+        if isinstance(event, (Field, File)):
+            name = event.name
+            fields[name] = bytearray()
+
+        elif isinstance(event, Data) and name is not None:
+            fields[name] += event.data
+            if len(fields[name]) > UPLOAD_FIELD_MAX:
+                raise ValueError("form field too large")
+
+    return None
+
+
+class PartReader:
+    """File-like reader of the part multipart_events is at, hashing and
+    counting the bytes that go through."""
+
+    def __init__(self, events):
+        self.events = events
+        self.buffer = bytearray()
+        self.done = False
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, n=-1):
+        while not self.done and (n < 0 or len(self.buffer) < n):
+            event = next(self.events, None)
+            if not isinstance(event, Data):
+                raise ValueError("upload cut short")
+
+            self.buffer += event.data
+            self.done = not event.more_data
+
+        if n < 0:
+            n = len(self.buffer)
+
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+
+def read_part(stream):
+    """Read up to one part, even from streams that return short reads."""
+
+    buf = bytearray()
+
+    while len(buf) < UPLOAD_PART_SIZE:
+        chunk = stream.read(UPLOAD_PART_SIZE - len(buf))
+        if not chunk:
+            break
+        buf += chunk
+
+    return bytes(buf)
+
+
+def stream_to_s3(stream, s3_key, content_type, on_part=None):
+    """Copy `stream` to S3 and return the number of bytes written.
+
+    on_part(size) is called before each part is sent and may raise to
+    stop the upload. On any error the multipart upload
+    is aborted so no orphaned parts are left behind.
+    """
+
+    if STORAGE_BACKEND == "local":
+        return stream_to_disk(stream, s3_key, on_part)
+
+    chunk = read_part(stream)
+
+    # small file: one request is enough
+    if len(chunk) < UPLOAD_PART_SIZE:
+        if on_part:
+            on_part(len(chunk))
+
+        s3.put_object(
+            Bucket=BUCKET_NAME,
+            Key=s3_key,
+            Body=chunk,
+            ContentType=content_type,
+            ContentDisposition="inline"
+        )
+        return len(chunk)
+
+    upload_id = s3.create_multipart_upload(
+        Bucket=BUCKET_NAME,
+        Key=s3_key,
+        ContentType=content_type,
+        ContentDisposition="inline"
+    )["UploadId"]
+
+    def send(part_number, body):
+        resp = s3.upload_part(
+            Bucket=BUCKET_NAME,
+            Key=s3_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+        return {"PartNumber": part_number, "ETag": resp["ETag"]}
+
+    parts = []
+    total = 0
+    part_number = 1
+
+    try:
+        with ThreadPoolExecutor(max_workers=UPLOAD_PARTS_IN_FLIGHT) as pool:
+
+            pending = set()
+
+            try:
+                while chunk:
+                    if on_part:
+                        on_part(len(chunk))
+
+                    # wait for a free slot before reading the next part
+                    if len(pending) >= UPLOAD_PARTS_IN_FLIGHT:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        parts.extend(f.result() for f in done)
+
+                    pending.add(pool.submit(send, part_number, chunk))
+                    total += len(chunk)
+                    part_number += 1
+
+                    chunk = read_part(stream)
+
+            finally:
+                done, _ = wait(pending)
+
+            parts.extend(f.result() for f in done)
+
+        parts.sort(key=lambda p: p["PartNumber"])
+
+        s3.complete_multipart_upload(
+            Bucket=BUCKET_NAME,
+            Key=s3_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts}
+        )
+
+    except BaseException:
+        try:
+            s3.abort_multipart_upload(
+                Bucket=BUCKET_NAME,
+                Key=s3_key,
+                UploadId=upload_id
+            )
+        except Exception as e:
+            print("Abort multipart error:", e)
+        raise
+
+    return total
+
+
+def stream_to_disk(stream, s3_key, on_part=None):
+    """stream_to_s3 for the local backend: one file, written (and synced)
+    as the request comes in. Runs on the caller's thread, not through the
+    S3 call pool, whose per-call deadline would cut big uploads short."""
+
+    total = 0
+
+    def parts():
+        nonlocal total
+
+        chunk = read_part(stream)
+        while chunk:
+            if on_part:
+                on_part(len(chunk))
+
+            total += len(chunk)
+            yield chunk
+
+            chunk = read_part(stream)
+
+    started = time.perf_counter()
+    failed = True
+
+    try:
+        s3.client.put_object(Bucket=BUCKET_NAME, Key=s3_key, Body=parts())
+        failed = False
+    finally:
+        s3.record("put_object", time.perf_counter() - started, failed, total)
+
+    return total
+
+
+def parse_upload_path(raw):
+    try:
+        path = json.loads(raw or b"null")
+    except ValueError:
+        path = None
+
+    if not isinstance(path, list) or not path \
+            or not all(isinstance(p, str) for p in path):
+        raise ValueError("invalid path")
+
+    return path
+
+
+@app.route("/api/upload", methods=["POST"])
+def upload_file():
+    boundary = request.mimetype_params.get("boundary")
+
+    if request.mimetype != "multipart/form-data" or not boundary:
+        return jsonify({"error": "no file"}), 400
+
+    username = session["user"]
+
+    events = multipart_events(request.stream, boundary)
+    fields = {}
+
+    try:
+        part = read_form_fields(events, fields, until="file")
+    except ValueError:
+        return jsonify({"error": "invalid data"}), 400
+
+    if part is None:
+        return jsonify({"error": "no file"}), 400
+
+    filename = secure_filename(part.filename or "")
+    mime = (
+        part.headers.get("Content-Type", "").split(";")[0].strip()
+        or "application/octet-stream"
+    )
+    s3_key = new_object_key(username)
+
+    # the body's length bounds the file's; without one (chunked) the
+    # reservation grows part by part
+    reserved = request.content_length or 0
+
+    if not reserve_storage(username, reserved):
+        return jsonify({
+            "error": "MINIDRIVE_STORAGE_FULL",
+            "message": "MiniDrive total storage limit (3GB) reached"
+        }), 403
+
+    reader = PartReader(events)
+
+    def charge(size):
+        nonlocal reserved
+        missing = reader.size - reserved
+        if missing > 0:
+            if not reserve_storage(username, missing):
+                raise StorageFull()
+            reserved += missing
+
+    # stream file into S3 part by part
+    try:
+        stream_to_s3(reader, s3_key, mime, on_part=charge)
+
+        # fields sent after the file
+        read_form_fields(events, fields)
+        path = parse_upload_path(fields.get("path"))
+
+    except StorageFull:
+        release_storage(username, reserved)
+        return jsonify({
+            "error": "MINIDRIVE_STORAGE_FULL",
+            "message": "MiniDrive total storage limit (3GB) reached"
+        }), 403
+
+    except ValueError as e:
+        s3.delete_object(Bucket=BUCKET_NAME, Key=s3_key)
+        release_storage(username, reserved)
+        return jsonify({"error": str(e)}), 400
+
+    except Exception as e:
+        print("S3 error:", e)
+        release_storage(username, reserved)
+        return jsonify({"error": "S3 failed"}), 500
+
+    size = reader.size
+    sha256 = reader.sha256.hexdigest()
+
+    # content the drive has already: link it, drop the copy just sent
+    if blob_state(sha256) == "live":
+        try:
+            resp = finish_upload(
+                username, path, filename, size, mime,
+                blob_key(sha256), reserved, blob=(sha256, False)
+            )
+            s3.delete_object(Bucket=BUCKET_NAME, Key=s3_key)
+            return resp
+
+        except BlobCollected:
+            # collected meanwhile: keep this copy after all
+            reserved = size
+            if not reserve_storage(username, size):
+                s3.delete_object(Bucket=BUCKET_NAME, Key=s3_key)
+                return jsonify({
+                    "error": "MINIDRIVE_STORAGE_FULL",
+                    "message": "MiniDrive total storage limit (3GB) reached"
+                }), 403
+
+    resp = finish_upload(
+        username, path, filename, size, mime, s3_key, reserved, thumbnail=False
+    )
+
+    # new content goes into the blob store in the background, which queues
+    # the thumbnails for the key it ends up at
+    if not isinstance(resp, tuple):
+        enqueue_job("absorb_upload", {"owner": username, "s3_key": s3_key}, owner=username)
+
+    return resp
+
+
+def finish_upload(username, path, filename, size, mime, s3_key, reserved,
+                  blob=None, extra=None, thumbnail=True):
+    """Record an object that is already in S3 and settle its reservation.
+
+    blob is (sha256, stored) when s3_key is a blob key, stored being True
+    when this upload wrote the object. Raises BlobCollected (reservation
+    released) when the blob is being collected and can't be linked.
+    thumbnail=False leaves queueing the thumbnails to the caller.
+    """
+
+    #save file info (only this row + any missing parent folders)
+    db = get_db()
+    gained = 0
+
+    try:
+        db.execute("BEGIN IMMEDIATE")
+
+        if blob:
+            gained = claim_blob(db, blob[0], size, blob[1])
+
+            if gained is None:
+                db.rollback()
+                release_storage(username, reserved)
+                raise BlobCollected()
+
+        folder_id = resolve_folder(db, username, path[1:], create=True)
+
+        if folder_id is None:
+            db.rollback()
+
+            if not blob:
+                s3.delete_object(Bucket=BUCKET_NAME, Key=s3_key)
+
+            # a blob written for nothing is left unreferenced, to be collected
+            elif blob[1]:
+                gained = claim_blob(db, blob[0], size, True) or 0
+                db.commit()
+
+            commit_storage(username, reserved, gained, charge_to=BLOB_OWNER)
+            return jsonify({"error": "invalid path"}), 400
+
+        # a folder has the name: the reservation is released and the
+        # object queued for deletion, an unlinked blob is left to collect
+        clash = not put_file_node(
+            db, username, folder_id, filename,
+            size, mime, s3_key
+        )
+
+        if clash:
+            orphan_upload(db, username, s3_key)
+
+        db.commit()
+
+    finally:
+        db.close()
+
+    if blob:
+        commit_storage(username, reserved, gained, charge_to=BLOB_OWNER)
+    else:
+        commit_storage(username, reserved, 0 if clash else size)
+
+    # a file replaced under the same name gives its object back
+    schedule_orphan_sweep(username)
+
+    if clash:
+        return jsonify({"error": "a folder with that name exists"}), 409
+
+    if thumbnail:
+        queue_thumbnails([(s3_key, mime, size)])
+
+    return jsonify({
+        "name": filename,
+        "size": to_mb(size),
+        "url": s3_url(s3_key),
+        "type": mime,
+        **(extra or {})
+    })
+
+
+
+# DIRECT TO S3 UPLOADS
+#
+# initiate: check + reserve quota, hand out a presigned POST (or presigned
+#           part URLs for big files)
+# browser:  sends the bytes straight to S3
+# complete: HeadObject to verify, then record the node like /api/upload
+#
+# Needs a CORS rule on the bucket allowing POST/PUT from the app origin
+# and exposing the ETag header.
+
+DIRECT_UPLOADS = os.environ.get("MINIDRIVE_DIRECT_UPLOADS", "1") == "1"
+DIRECT_MULTIPART_THRESHOLD = int(os.environ.get("MINIDRIVE_DIRECT_MULTIPART_MB", "64")) * MB
+PRESIGN_EXPIRY = 3600
+
+
+def get_pending_upload(db, upload_id, username):
+    return db.execute(
+        """
+        SELECT id, s3_key, path, name, size, mime, multipart_id
+        FROM pending_uploads WHERE id=? AND owner=?
+        """,
+        (upload_id, username)
+    ).fetchone()
+
+
+def drop_pending_upload(upload_id):
+    """Delete the ticket; False if someone else already finished it."""
+
+    db = get_db()
+    cur = db.execute("DELETE FROM pending_uploads WHERE id=?", (upload_id,))
+    db.commit()
+    db.close()
+
+    return cur.rowcount > 0
+
+
+def expire_pending_uploads():
+    """Give back reservations of direct uploads the browser never finished.
+
+    Multipart uploads are aborted. A single POST may have landed without
+    /complete ever being called: its object goes to `orphans` (the sweep
+    leaves it alone if a node links it after all).
+    """
+
+    cutoff = time.time() - 2 * PRESIGN_EXPIRY
+
+    db = get_db()
+    stale = db.execute(
+        "SELECT id, owner, s3_key, size, multipart_id FROM pending_uploads WHERE created < ?",
+        (cutoff,)
+    ).fetchall()
+    db.close()
+
+    sweep = set()
+
+    for upload_id, owner, s3_key, size, multipart_id in stale:
+        if multipart_id:
+            try:
+                s3.abort_multipart_upload(
+                    Bucket=BUCKET_NAME, Key=s3_key, UploadId=multipart_id
+                )
+            except Exception as e:
+                print("Abort multipart error:", e)
+
+        if not drop_pending_upload(upload_id):
+            continue
+
+        if not multipart_id and object_exists(s3_key):
+            db = get_db()
+            orphan_upload(db, owner, s3_key)
+            db.commit()
+            db.close()
+            sweep.add(owner)
+
+        release_storage(owner, size)
+
+    for owner in sweep:
+        schedule_orphan_sweep(owner)
+
+
+@app.route("/api/upload/initiate", methods=["POST"])
+def initiate_upload():
+    info = request.get_json()
+
+    if not info:
+        return jsonify({"error": "No data"}), 400
+
+    # local storage has nothing for the browser to send to but Flask
+    if not DIRECT_UPLOADS or STORAGE_BACKEND != "s3":
+        return jsonify({"mode": "proxy"})
+
+    path = info.get("path")
+    filename = secure_filename(info.get("name") or "")
+
+    try:
+        size = int(info.get("size"))
+    except (TypeError, ValueError):
+        size = -1
+
+    if not filename or not path or size < 0:
+        return jsonify({"error": "Invalid data"}), 400
+
+    mime = (
+        info.get("type")
+        or mimetypes.guess_type(filename)[0]
+        or "application/octet-stream"
+    )
+
+    username = session["user"]
+
+    # the browser may send the file's SHA-256. Its own word is only taken
+    # for blobs its own files already point at (nothing new is revealed),
+    # anything else stored already is sent through the server to be checked
+    sha256 = str(info.get("sha256") or "").lower()
+
+    if re.fullmatch(r"[0-9a-f]{64}", sha256) and blob_state(sha256) == "live":
+        db = get_db()
+        owned = db.execute(
+            """
+            SELECT b.size FROM blobs b
+            WHERE b.sha256 = ? AND EXISTS (
+                SELECT 1 FROM nodes WHERE owner = ? AND s3_key = ?
+            )
+            """,
+            (sha256, username, blob_key(sha256))
+        ).fetchone()
+        db.close()
+
+        if not owned:
+            return jsonify({"mode": "proxy"})
+
+        try:
+            return finish_upload(
+                username, path, filename, owned[0], mime,
+                blob_key(sha256), 0, blob=(sha256, False), extra={"mode": "linked"}
+            )
+        except BlobCollected:
+            pass
+
+    s3_key = new_object_key(username)
+
+    #  Global Storage Limit Check
+    if not reserve_storage(username, size):
+        return jsonify({
+            "error": "MINIDRIVE_STORAGE_FULL",
+            "message": "MiniDrive total storage limit (3GB) reached"
+        }), 403
+
+    upload_id = secrets.token_urlsafe(16)
+
+    try:
+        if size < DIRECT_MULTIPART_THRESHOLD:
+            multipart_id = None
+
+            ticket = s3.generate_presigned_post(
+                Bucket=BUCKET_NAME,
+                Key=s3_key,
+                Fields={
+                    "Content-Type": mime,
+                    "Content-Disposition": "inline"
+                },
+                Conditions=[
+                    {"Content-Type": mime},
+                    {"Content-Disposition": "inline"},
+                    ["content-length-range", size, size]
+                ],
+                ExpiresIn=PRESIGN_EXPIRY
+            )
+
+            body = {"mode": "post", "url": ticket["url"], "fields": ticket["fields"]}
+
+        else:
+            multipart_id = s3.create_multipart_upload(
+                Bucket=BUCKET_NAME,
+                Key=s3_key,
+                ContentType=mime,
+                ContentDisposition="inline"
+            )["UploadId"]
+
+            # S3 allows at most 10,000 parts
+            part_size = max(UPLOAD_PART_SIZE, -(-size // 10000))
+            part_count = max(1, -(-size // part_size))
+
+            urls = [
+                s3.generate_presigned_url(
+                    "upload_part",
+                    Params={
+                        "Bucket": BUCKET_NAME,
+                        "Key": s3_key,
+                        "UploadId": multipart_id,
+                        "PartNumber": n
+                    },
+                    ExpiresIn=PRESIGN_EXPIRY
+                )
+                for n in range(1, part_count + 1)
+            ]
+
+            body = {"mode": "multipart", "part_size": part_size, "urls": urls}
+
+    except Exception as e:
+        print("S3 error:", e)
+        release_storage(username, size)
+        return jsonify({"error": "S3 failed"}), 500
+
+    db = get_db()
+    db.execute(
+        """
+        INSERT INTO pending_uploads
+            (id, owner, s3_key, path, name, size, mime, multipart_id, created)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (upload_id, username, s3_key, json.dumps(path), filename, size,
+         mime, multipart_id, time.time())
+    )
+    db.commit()
+    db.close()
+
+    body["upload_id"] = upload_id
+    return jsonify(body)
+
+
+@app.route("/api/upload/complete", methods=["POST"])
+def complete_upload():
+    info = request.get_json() or {}
+    username = session["user"]
+
+    db = get_db()
+    pending = get_pending_upload(db, info.get("upload_id"), username)
+    db.close()
+
+    if not pending:
+        return jsonify({"error": "unknown upload"}), 404
+
+    upload_id, s3_key, path, filename, size, mime, multipart_id = pending
+
+    try:
+        if multipart_id:
+            parts = sorted(
+                (
+                    {"PartNumber": int(p["PartNumber"]), "ETag": p["ETag"]}
+                    for p in info.get("parts") or []
+                ),
+                key=lambda p: p["PartNumber"]
+            )
+
+            s3.complete_multipart_upload(
+                Bucket=BUCKET_NAME,
+                Key=s3_key,
+                UploadId=multipart_id,
+                MultipartUpload={"Parts": parts}
+            )
+
+        actual = s3.head_object(Bucket=BUCKET_NAME, Key=s3_key)["ContentLength"]
+
+    except Exception as e:
+        print("Complete upload error:", e)
+        return jsonify({"error": "UPLOAD_NOT_FOUND"}), 400
+
+    if not drop_pending_upload(upload_id):
+        return jsonify({"error": "unknown upload"}), 404
+
+    # multipart sizes can't be enforced by S3, charge what really arrived
+    if actual > size and not reserve_storage(username, actual - size):
+        s3.delete_object(Bucket=BUCKET_NAME, Key=s3_key)
+        release_storage(username, size)
+        return jsonify({
+            "error": "MINIDRIVE_STORAGE_FULL",
+            "message": "MiniDrive total storage limit (3GB) reached"
+        }), 403
+
+    resp = finish_upload(
+        username, json.loads(path), filename, actual, mime, s3_key, max(size, actual),
+        thumbnail=False
+    )
+
+    # hashed after the fact, and moved into the blob store, which queues
+    # the thumbnails for the key it ends up at (errors come back as a
+    # (body, status) tuple)
+    if not isinstance(resp, tuple):
+        enqueue_job("absorb_upload", {"owner": username, "s3_key": s3_key}, owner=username)
+
+    return resp
+
+
+@app.route("/api/upload/abort", methods=["POST"])
+def abort_upload():
+    info = request.get_json() or {}
+    username = session["user"]
+
+    db = get_db()
+    pending = get_pending_upload(db, info.get("upload_id"), username)
+    db.close()
+
+    if not pending:
+        return jsonify({"error": "unknown upload"}), 404
+
+    upload_id, s3_key, _, _, size, _, multipart_id = pending
+
+    if multipart_id:
+        try:
+            s3.abort_multipart_upload(
+                Bucket=BUCKET_NAME, Key=s3_key, UploadId=multipart_id
+            )
+        except Exception as e:
+            print("Abort multipart error:", e)
+
+    if drop_pending_upload(upload_id):
+        release_storage(username, size)
+
+    return jsonify({"status": "aborted"})
+
+
+
+# BATCH (FOLDER) UPLOAD
+#
+# One request carries many files plus their relative paths. S3 puts run
+# through a bounded pool, then every node is written in one transaction
+# and the ledger is settled once. Each file gets its own result so a
+# partial failure doesn't hide the files that made it.
+
+BATCH_UPLOAD_WORKERS = int(os.environ.get("MINIDRIVE_BATCH_UPLOAD_WORKERS", "8"))
+
+
+def stream_size(stream):
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+
+@app.route("/api/upload-batch", methods=["POST"])
+def upload_batch():
+    files = request.files.getlist("files")
+    rel_paths = request.form.getlist("paths")
+    base = json.loads(request.form.get("path") or '["root"]')
+
+    if not files or len(files) != len(rel_paths):
+        return jsonify({"error": "Invalid data"}), 400
+
+    username = session["user"]
+
+    results = []
+    jobs = []
+
+    for file, rel in zip(files, rel_paths):
+
+        parts = [p for p in rel.split("/") if p not in ("", ".", "..")]
+        filename = secure_filename(parts[-1]) if parts else ""
+
+        result = {"path": rel}
+        results.append(result)
+
+        if not filename:
+            result["error"] = "invalid path"
+            continue
+
+        jobs.append({
+            "result": result,
+            "file": file,
+            "folders": base[1:] + parts[:-1],
+            "filename": filename,
+            "size": stream_size(file.stream)
+        })
+
+    # hash everything first, known content (also twice in one batch) is
+    # only linked and never reserved or sent
+    with ThreadPoolExecutor(max_workers=BATCH_UPLOAD_WORKERS) as pool:
+        for job, sha256 in zip(jobs, pool.map(lambda j: hash_stream(j["file"].stream), jobs)):
+            job["sha256"] = sha256
+
+    shas = sorted({job["sha256"] for job in jobs})
+    states = {}
+
+    db = get_db()
+    for i in range(0, len(shas), 500):
+        chunk = shas[i:i + 500]
+        states.update(db.execute(
+            f"SELECT sha256, state FROM blobs WHERE sha256 IN ({','.join('?' * len(chunk))})",
+            chunk
+        ).fetchall())
+    db.close()
+
+    writers = {}
+    reserved = 0
+
+    for job in jobs:
+        sha256 = job["sha256"]
+        state = states.get(sha256)
+
+        if state == "live" or sha256 in writers:
+            job["s3_key"] = blob_key(sha256)
+            continue
+
+        if not reserve_storage(username, job["size"]):
+            job["result"]["error"] = "MINIDRIVE_STORAGE_FULL"
+            continue
+
+        reserved += job["size"]
+        job["push"] = True
+
+        if state is None:
+            writers[sha256] = job
+            job["s3_key"] = blob_key(sha256)
+        else:
+            job["s3_key"] = new_object_key(username)
+
+    def push(job):
+        return stream_to_s3(job["file"].stream, job["s3_key"], job["file"].mimetype)
+
+    pushed = [job for job in jobs if job.get("push")]
+
+    with ThreadPoolExecutor(max_workers=BATCH_UPLOAD_WORKERS) as pool:
+        for job, future in [(job, pool.submit(push, job)) for job in pushed]:
+            try:
+                future.result()
+            except Exception as e:
+                print("S3 error:", e)
+                job["result"]["error"] = "S3 failed"
+
+    used = gained = 0
+
+    # all metadata in one transaction
+    db = get_db()
+
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        folder_ids = {}
+
+        for job in jobs:
+            result, s3_key, size = job["result"], job.get("s3_key"), job["size"]
+
+            if not s3_key or "error" in result:
+                continue
+
+            if is_blob_key(s3_key):
+                writer = writers.get(job["sha256"])
+
+                if writer is not None and "error" in writer["result"]:
+                    result["error"] = "S3 failed"
+                    continue
+
+                claimed = claim_blob(db, job["sha256"], size, writer is job)
+
+                if claimed is None:
+                    result["error"] = "busy, try again"
+                    continue
+
+                gained += claimed
+
+            key = tuple(job["folders"])
+            if key not in folder_ids:
+                folder_ids[key] = resolve_folder(db, username, job["folders"], create=True)
+
+            if folder_ids[key] is None:
+                result["error"] = "invalid path"
+                if not is_blob_key(s3_key):
+                    s3.delete_object(Bucket=BUCKET_NAME, Key=s3_key)
+                continue
+
+            if not put_file_node(
+                db, username, folder_ids[key], job["filename"],
+                size, job["file"].mimetype, s3_key
+            ):
+                result["error"] = "a folder with that name exists"
+                orphan_upload(db, username, s3_key)
+                continue
+
+            if not is_blob_key(s3_key):
+                used += size
+
+            result.update({
+                "name": job["filename"],
+                "size": to_mb(size),
+                "url": s3_url(s3_key),
+                "type": job["file"].mimetype
+            })
+
+        db.commit()
+
+    except Exception:
+        db.rollback()
+        release_storage(username, reserved)
+        raise
+
+    finally:
+        db.close()
+
+    commit_storage(username, reserved, used)
+    adjust_usage(BLOB_OWNER, gained)
+
+    # files replaced under the same name give their objects back
+    schedule_orphan_sweep(username)
+
+    queue_thumbnails([
+        (job["s3_key"], job["file"].mimetype, job["size"])
+        for job in jobs
+        if job.get("s3_key") and "error" not in job["result"]
+    ])
+
+    return jsonify({"results": results})
+
+
+
+def owned_file(username, node_id):
+    """(name, s3_key) of one of the user's files, or None."""
+
+    db = get_db()
+    row = db.execute(
+        "SELECT name, s3_key FROM nodes WHERE id=? AND owner=? AND kind='file'",
+        (node_id, username)
+    ).fetchone()
+    db.close()
+
+    return row
+
+
+#download file
+@app.route("/api/download")
+def download_file():
+
+    # files are addressed by node id, the key is looked up (and is the
+    # user's own) rather than taken from the client
+    file = owned_file(session["user"], request.args.get("id", type=int))
+    if not file:
+        return jsonify({"error": "not found"}), 404
+
+    filename, key = file
+
+    url = s3.generate_presigned_url(
+        "get_object",
+        Params={
+            "Bucket": BUCKET_NAME,
+            "Key": key,
+            "ResponseContentDisposition": f'attachment; filename="{secure_filename(filename)}"'
+        },
+        ExpiresIn=300
+    )
+
+    return jsonify({"url": url})
+
+
+# ZIP DOWNLOADS
+#
+# /api/download-zip?path=root/docs[&path=root/a.txt...]
+#
+# The archive is written while the objects are read: each GetObject body
+# goes through zipfile into a small buffer that is sent as soon as it
+# fills, so neither the server's memory nor its disk ever holds more than
+# a few chunks whatever the folder size. The next ZIP_PREFETCH objects are
+# opened (small ones read whole) ahead of time, which hides the S3 latency
+# that dominates folders of many small files. zipfile switches to ZIP64 by
+# itself once sizes or the entry count need it. An object that can't be read
+# breaks the download off, there is no status code left to change by then.
+
+ZIP_CHUNK = 1 * MB
+ZIP_PREFETCH = int(os.environ.get("MINIDRIVE_ZIP_PREFETCH", "8"))
+ZIP_PREFETCH_BYTES = 1 * MB       # objects up to this size are read whole ahead
+
+# compressing these again costs CPU and gains nothing
+ZIP_STORED_TYPES = (
+    "image/jpeg", "image/png", "image/gif", "image/webp", "image/heic", "image/avif",
+    "video/", "audio/",
+    "application/zip", "application/gzip", "application/x-gzip",
+    "application/x-7z-compressed", "application/x-rar-compressed", "application/vnd.rar",
+    "application/x-bzip2", "application/x-xz", "application/zstd",
+    "application/epub+zip", "application/vnd.openxmlformats-officedocument.",
+)
+
+
+class ZipSink:
+    """Write-only, unseekable file object for zipfile: keeps what is
+    written until the response generator takes it."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def zip_entries(db, username, path):
+    """(arcname, kind, size, mime, s3_key, modified) for a node and
+    everything below it. A bare area ("root") contributes its contents.
+    Trash items that are gone for the user (see trash_cutoff) are left
+    out, or None if one was asked for."""
+
+    if len(path) == 1:
+        node_id, prefix = get_drive_roots(db, username)[path[0]], ""
+    else:
+        node = find_node(db, username, path)
+        if not node:
+            return None
+        node_id, prefix = node[0], node[2]
+
+        if trash_path_expired(db, username, path):
+            return None
+
+    # `trash` only has top level items, which is where the walk skips them
+    return db.execute(
+        """
+        WITH RECURSIVE walk(id, path) AS (
+            SELECT ?, ?
+            UNION ALL
+            SELECT n.id, CASE WHEN w.path = '' THEN n.name ELSE w.path || '/' || n.name END
+            FROM nodes n JOIN walk w ON n.parent_id = w.id
+            WHERE n.owner = ?
+              AND n.id NOT IN (SELECT node_id FROM trash WHERE owner = ? AND deleted_at <= ?)
+        )
+        SELECT w.path, n.kind, n.size, n.mime, n.s3_key, n.modified
+        FROM walk w JOIN nodes n ON n.id = w.id
+        WHERE w.path <> ''
+        ORDER BY w.path
+        """,
+        (node_id, prefix, username, username, trash_cutoff())
+    ).fetchall()
+
+
+def open_zip_member(s3_key, size):
+    """Start reading one object; returns an iterable of chunks."""
+
+    body = s3.get_object(Bucket=BUCKET_NAME, Key=s3_key)["Body"]
+
+    if (size or 0) <= ZIP_PREFETCH_BYTES:
+        return [body.read()]
+
+    return body.iter_chunks(ZIP_CHUNK)
+
+
+def zip_info(name, kind, size, mime, modified):
+
+    try:
+        date_time = datetime.strptime(modified or "", "%Y-%m-%d %H:%M:%S").timetuple()[:6]
+    except ValueError:
+        date_time = (1980, 1, 1, 0, 0, 0)
+
+    if kind != "file":
+        info = zipfile.ZipInfo(name + "/", date_time)
+        info.external_attr = 0o40755 << 16 | 0x10
+        return info
+
+    info = zipfile.ZipInfo(name, date_time)
+    info.external_attr = 0o644 << 16
+
+    # the size picks ZIP64 for this entry before any byte is written
+    info.file_size = size or 0
+
+    mime = mime or mimetypes.guess_type(name)[0] or ""
+    info.compress_type = (
+        zipfile.ZIP_STORED if mime.startswith(ZIP_STORED_TYPES) else zipfile.ZIP_DEFLATED
+    )
+
+    return info
+
+
+def stream_zip(entries):
+    """Yield the archive of `entries` chunk by chunk."""
+
+    sink = ZipSink()
+    files = iter([e for e in entries if e[1] == "file"])
+    ahead = deque()
+
+    def prefetch():
+        while len(ahead) < ZIP_PREFETCH:
+            entry = next(files, None)
+            if entry is None:
+                return
+            ahead.append(pool.submit(open_zip_member, entry[4], entry[2]))
+
+    with ThreadPoolExecutor(max_workers=ZIP_PREFETCH) as pool:
+        try:
+            with zipfile.ZipFile(sink, "w", allowZip64=True) as archive:
+                for name, kind, size, mime, s3_key, modified in entries:
+
+                    info = zip_info(name, kind, size, mime, modified)
+
+                    if kind != "file":
+                        archive.writestr(info, b"")
+                        continue
+
+                    prefetch()
+
+                    # a missing member fails the download: the response
+                    # ends without its last chunk, so the client sees a
+                    # broken transfer rather than an archive that is
+                    # quietly short of a file
+                    try:
+                        chunks = ahead.popleft().result()
+                    except Exception as e:
+                        print("Zip error:", s3_key, e)
+                        raise
+
+                    with archive.open(info, "w") as member:
+                        for chunk in chunks:
+                            member.write(chunk)
+
+                            if len(sink.buffer) >= ZIP_CHUNK:
+                                yield sink.take()
+
+                    if len(sink.buffer) >= ZIP_CHUNK:
+                        yield sink.take()
+
+            # central directory
+            yield sink.take()
+
+        finally:
+            for future in ahead:
+                future.cancel()
+
+
+@app.route("/api/download-zip")
+def download_zip():
+
+    username = session["user"]
+
+    paths = [
+        [p for p in value.split("/") if p]
+        for value in request.args.getlist("path")
+    ]
+
+    if not paths or any(not p or p[0] not in ("root", "trash") for p in paths):
+        return jsonify({"error": "invalid path"}), 400
+
+    # two selections with the same name would collide in the archive
+    tops = [p[-1] for p in paths if len(p) > 1]
+    if len(set(tops)) != len(tops) or (len(paths) > 1 and len(tops) != len(paths)):
+        return jsonify({"error": "invalid path"}), 400
+
+    db = get_db()
+    entries = []
+
+    try:
+        for path in paths:
+            found = zip_entries(db, username, path)
+            if found is None:
+                return jsonify({"error": "not found"}), 404
+            entries += found
+    finally:
+        db.close()
+
+    if len(paths) == 1:
+        name = "My Drive" if paths[0] == ["root"] else paths[0][-1]
+    else:
+        name = "MiniDrive"
+
+    filename = secure_filename(name) or "download"
+
+    return Response(
+        stream_zip(entries),
+        mimetype="application/zip",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}.zip"',
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+# THUMBNAILS
+#
+# Images get two WebP renditions, THUMB_SIZES pixels on the long side: the
+# small one for the grid, the large one is what opening an image shows
+# instead of the original. They are rendered by the "thumbnails" job after
+# the upload has answered, THUMB_WORKERS images at a time, and stored
+# under _thumbs/<object key>/<size>.webp. An object key never gets new
+# content (keys are opaque or content-addressed), so /api/thumb URLs carry
+# a version of the key and are cached by the browser for good; blobs
+# shared by many files share their thumbnails too.
+#
+# `thumbs` has one row per object key: 'queued', 'ready' or 'failed' (not
+# an image Pillow can read). Thumbnail bytes are charged to the
+# THUMB_OWNER ledger row and deleted together with their object. Images
+# uploaded before this existed are queued when their folder is listed.
+
+THUMB_OWNER = "_thumbs"
+THUMB_PREFIX = THUMB_OWNER + "/"
+THUMB_SIZES = (256, 1024)
+THUMB_QUALITY = 80
+THUMB_WORKERS = int(os.environ.get("MINIDRIVE_THUMB_WORKERS", "4"))
+
+# bigger files / images are left without thumbnails. Pillow refuses to
+# open anything over twice its own limit (decompression bombs) by itself.
+THUMB_MAX_BYTES = int(os.environ.get("MINIDRIVE_THUMB_MAX_MB", "50")) * MB
+THUMB_MAX_PIXELS = 80_000_000
+Image.MAX_IMAGE_PIXELS = THUMB_MAX_PIXELS
+
+# the source is spooled to a temp file past this, Pillow reads it from there
+THUMB_SPOOL_BYTES = 1 * MB
+
+THUMB_TYPES = (
+    "image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp", "image/tiff",
+)
+
+
+def thumb_key(s3_key, size):
+    return f"{THUMB_PREFIX}{s3_key}/{size}.webp"
+
+
+def thumb_version(s3_key):
+    return hashlib.sha1(s3_key.encode()).hexdigest()[:12]
+
+
+def thumb_url(node_id, s3_key):
+    return f"/api/thumb/{node_id}?v={thumb_version(s3_key)}"
+
+
+def wants_thumbnail(mime, size):
+    return mime in THUMB_TYPES and 0 < (size or 0) <= THUMB_MAX_BYTES
+
+
+def queue_thumbnails(files):
+    """Queue thumbnails for the (s3_key, mime, size) of stored files.
+
+    Keys that already have a row (ready, queued or failed) are skipped, so
+    content uploaded again costs nothing. Call it after the transaction
+    that recorded the files has committed. Returns the job id or None.
+    """
+
+    keys = sorted({key for key, mime, size in files if key and wants_thumbnail(mime, size)})
+
+    if not keys:
+        return None
+
+    db = get_db()
+    new = [
+        key for key in keys
+        if db.execute(
+            "INSERT OR IGNORE INTO thumbs (s3_key, created) VALUES (?, ?)",
+            (key, timestamp())
+        ).rowcount
+    ]
+    db.commit()
+    db.close()
+
+    if not new:
+        return None
+
+    return enqueue_job("thumbnails", {"keys": new}, max_attempts=3)
+
+
+def render_thumbnails(source):
+    """({size: webp bytes}, width, height) for one image file (a seekable
+    file object). Only the header is read before the size is checked."""
+
+    with Image.open(source) as original:
+        width, height = original.size
+
+        if width * height > THUMB_MAX_PIXELS:
+            raise ValueError(f"{width}x{height} is too big")
+
+        # JPEGs are decoded at a fraction of their size, as far as the
+        # largest thumbnail allows
+        original.draft("RGB", (max(THUMB_SIZES), max(THUMB_SIZES)))
+
+        # phone photos are stored sideways with an orientation tag
+        image = ImageOps.exif_transpose(original)
+
+    image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+    rendered = {}
+
+    # each size is scaled down from the one before it
+    for size in sorted(THUMB_SIZES, reverse=True):
+        image.thumbnail((size, size), Image.LANCZOS)
+
+        out = io.BytesIO()
+        image.save(out, "WEBP", quality=THUMB_QUALITY, method=4)
+        rendered[size] = out.getvalue()
+
+    return rendered, width, height
+
+
+def make_thumbnails(s3_key):
+    """Render and store the thumbnails of one queued object key. Returns
+    the bytes stored. Unreadable images are marked 'failed' for good,
+    S3 errors are raised so the job is retried."""
+
+    db = get_db()
+    wanted = db.execute(
+        """
+        SELECT 1 FROM thumbs
+        WHERE s3_key=? AND state='queued'
+          AND EXISTS (SELECT 1 FROM nodes WHERE s3_key=?)
+        """,
+        (s3_key, s3_key)
+    ).fetchone()
+    db.close()
+
+    # done already, or the file went again (its row goes with the object)
+    if not wanted:
+        return 0
+
+    try:
+        obj = s3.get_object(Bucket=BUCKET_NAME, Key=s3_key)
+
+        if obj["ContentLength"] > THUMB_MAX_BYTES:
+            obj["Body"].close()
+            raise ValueError(f"{obj['ContentLength']} bytes is too big")
+
+        with tempfile.SpooledTemporaryFile(max_size=THUMB_SPOOL_BYTES) as source:
+            for chunk in obj["Body"].iter_chunks(MB):
+                source.write(chunk)
+
+            source.seek(0)
+            rendered, width, height = render_thumbnails(source)
+
+    except s3.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            raise
+        rendered = None
+
+    except Exception as e:
+        print("Thumbnail error:", s3_key, e)
+        rendered = None
+
+    if rendered is None:
+        db = get_db()
+        db.execute("UPDATE thumbs SET state='failed' WHERE s3_key=? AND state='queued'", (s3_key,))
+        db.commit()
+        db.close()
+        return 0
+
+    for size, body in rendered.items():
+        s3.put_object(
+            Bucket=BUCKET_NAME,
+            Key=thumb_key(s3_key, size),
+            Body=body,
+            ContentType="image/webp"
+        )
+
+    stored = sum(len(body) for body in rendered.values())
+
+    db = get_db()
+    recorded = db.execute(
+        """
+        UPDATE thumbs SET state='ready', bytes=?, width=?, height=?
+        WHERE s3_key=? AND state='queued'
+        """,
+        (stored, width, height, s3_key)
+    ).rowcount
+    db.commit()
+    db.close()
+
+    # the object (and its row) was deleted while this one was rendering
+    if not recorded:
+        delete_s3_keys([thumb_key(s3_key, size) for size in rendered])
+        return 0
+
+    adjust_usage(THUMB_OWNER, stored)
+    return stored
+
+
+def drop_thumbnails(keys):
+    """Delete the thumbnails of objects that were deleted."""
+
+    if not keys:
+        return
+
+    ready = []
+    db = get_db()
+
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        ready += db.execute(
+            f"""
+            DELETE FROM thumbs WHERE s3_key IN ({','.join('?' * len(chunk))})
+            RETURNING s3_key, state, bytes
+            """,
+            chunk
+        ).fetchall()
+
+    db.commit()
+    db.close()
+
+    ready = [(key, size) for key, state, size in ready if state == "ready"]
+
+    if ready:
+        delete_s3_keys([thumb_key(key, size) for key, _ in ready for size in THUMB_SIZES])
+        adjust_usage(THUMB_OWNER, -sum(size for _, size in ready))
+
+
+@app.route("/api/thumb/<int:node_id>")
+def get_thumbnail(node_id):
+
+    size = request.args.get("size", THUMB_SIZES[0], type=int)
+
+    if size not in THUMB_SIZES:
+        return jsonify({"error": "invalid size"}), 400
+
+    db = get_db()
+    row = db.execute(
+        """
+        SELECT n.s3_key FROM nodes n JOIN thumbs t ON t.s3_key = n.s3_key
+        WHERE n.id=? AND n.owner=? AND t.state='ready'
+        """,
+        (node_id, session["user"])
+    ).fetchone()
+    db.close()
+
+    if not row:
+        return jsonify({"error": "not found"}), 404
+
+    version = thumb_version(row[0])
+    etag = f"{version}-{size}"
+
+    if etag in request.if_none_match:
+        resp = app.response_class(status=304)
+    else:
+        try:
+            body = s3.get_object(
+                Bucket=BUCKET_NAME, Key=thumb_key(row[0], size)
+            )["Body"].read()
+        except s3.exceptions.ClientError:
+            return jsonify({"error": "not found"}), 404
+
+        resp = app.response_class(body, mimetype="image/webp")
+
+    resp.set_etag(etag)
+
+    # the URL names the object the thumbnail was made from: while it does,
+    # the image can't change
+    if request.args.get("v") == version:
+        resp.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    else:
+        resp.headers["Cache-Control"] = "private, no-cache"
+
+    return resp
+
+
+#  Delete from s3
+@app.route("/api/delete", methods=["POST"])
+def delete_file():
+    """Kept for older clients. Objects now go with their nodes (removing a
+    file or folder queues them in `orphans`), so this only deletes an
+    object of the user's that no node points at."""
+
+    info = request.json
+
+    url = info.get("url")
+    key = info.get("key")
+
+    username = session["user"]
+
+    # file delete
+    if url:
+        s3_key = key_from_url(url)
+        if s3_key is None:
+            return jsonify({"error": "invalid url"}), 400
+
+        db = get_db()
+        in_use = db.execute(
+            "SELECT 1 FROM nodes WHERE s3_key=? LIMIT 1", (s3_key,)
+        ).fetchone()
+        db.close()
+
+        if in_use or not s3_key.startswith(username + "/"):
+            return jsonify({"status": "file deleted"})
+
+        size = get_object_size(s3_key)
+        s3.delete_object(Bucket=BUCKET_NAME, Key=s3_key)
+        adjust_usage(username, -size)
+        return jsonify({"status": "file deleted"})
+
+    # folder delete: its files' objects follow the removed nodes
+    if key:
+        return jsonify({"status": "folder deleted"})
+
+
+    return jsonify({"error": "no target"}), 400
+
+
+
+
+# SERVER SIDE COPIES
+#
+# Object keys are opaque (see new_object_key), renames don't move any
+# objects. Copies are left for moving direct uploads into the blob store;
+# objects above the single copy limit are copied with UploadPartCopy.
+
+COPY_SINGLE_LIMIT = 5 * 1024 * MB    # biggest object copy_object accepts
+COPY_PART_SIZE = 512 * MB
+DELETE_BATCH = 1000
+
+
+def copy_s3_object(src_key, dst_key, size, content_type=None, if_match=None):
+    """Server side copy. if_match (an ETag) makes S3 refuse the copy when
+    the source has changed since it was read."""
+
+    content_type = (
+        content_type
+        or mimetypes.guess_type(dst_key)[0]
+        or "application/octet-stream"
+    )
+    condition = {"CopySourceIfMatch": if_match} if if_match else {}
+
+    if size <= COPY_SINGLE_LIMIT:
+        s3.copy_object(
+            Bucket=BUCKET_NAME,
+            CopySource={"Bucket": BUCKET_NAME, "Key": src_key},
+            Key=dst_key,
+            MetadataDirective="COPY",
+            ContentType=content_type,
+            ContentDisposition="inline",
+            **condition
+        )
+        return
 
-    if username == session["user"]:
-        return "Admin cannot delete himself!"
+    upload_id = s3.create_multipart_upload(
+        Bucket=BUCKET_NAME,
+        Key=dst_key,
+        ContentType=content_type,
+        ContentDisposition="inline"
+    )["UploadId"]
 
-    try:
-        db = get_db()
-        cursor = db.cursor()
+    def copy_part(part):
+        number, start = part
+        end = min(start + COPY_PART_SIZE, size) - 1
 
-        # confirm user exists
-        cursor.execute("SELECT * FROM users WHERE username=?", (username,))
-        user = cursor.fetchone()
+        resp = s3.upload_part_copy(
+            Bucket=BUCKET_NAME,
+            Key=dst_key,
+            UploadId=upload_id,
+            PartNumber=number,
+            CopySource={"Bucket": BUCKET_NAME, "Key": src_key},
+            CopySourceRange=f"bytes={start}-{end}",
+            **condition
+        )
+        return {"PartNumber": number, "ETag": resp["CopyPartResult"]["ETag"]}
 
-        if not user:
-            return "User not found", 404
+    try:
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            parts = list(pool.map(
+                copy_part,
+                enumerate(range(0, size, COPY_PART_SIZE), start=1)
+            ))
 
-        # Delete S3 first
-        delete_user_s3_folder(username)
+        s3.complete_multipart_upload(
+            Bucket=BUCKET_NAME,
+            Key=dst_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts}
+        )
 
-    
-        cursor.execute("DELETE FROM users WHERE username=?", (username,))
-        cursor.execute("DELETE FROM drive WHERE username=?", (username,))
+    except BaseException:
+        s3.abort_multipart_upload(
+            Bucket=BUCKET_NAME, Key=dst_key, UploadId=upload_id
+        )
+        raise
 
-        db.commit()
 
-    except Exception as e:
-        print("Delete error:", e)
-        return "Failed to delete user", 500
+def delete_s3_keys(keys):
+    """delete_objects in batches of 1,000 (the S3 maximum), sent together."""
 
-    finally:
-        db.close()
+    batches = [
+        s3.submit(
+            "delete_objects",
+            Bucket=BUCKET_NAME,
+            Delete={
+                "Objects": [{"Key": k} for k in keys[i:i + DELETE_BATCH]],
+                "Quiet": True
+            }
+        )
+        for i in range(0, len(keys), DELETE_BATCH)
+    ]
 
-    return redirect(url_for("admin_panel"))
+    for batch in batches:
+        resp = s3.result(batch)
 
+        if resp.get("Errors"):
+            raise RuntimeError(f"delete_objects failed for {len(resp['Errors'])} keys")
 
 
+# rename file and folder
 
-# Drive APi
+def move_node(db, username, old_key, new_key):
+    """Point the node at old_key ("a/b/c", relative to My Drive) at new_key.
 
-@app.route("/api/drive", methods=["GET"])
-def get_drive():
+    Object keys don't depend on the path and the search index doesn't
+    store paths, so this is one row update for a file or a folder of any
+    size, and S3 is never touched. Raises
+    sqlite3.IntegrityError when new_key is taken, DriveOpError when old_key
+    or new_key's folder doesn't exist, or new_key is inside old_key.
+    """
 
-    if "user" not in session:
-        return jsonify({"error":"unauthorized"}),401
+    old_parts = old_key.strip("/").split("/")
+    new_parts = new_key.strip("/").split("/")
 
-    data = load_data()
-    return jsonify(data)
+    old_parent = resolve_folder(db, username, old_parts[:-1])
+    node = old_parent and find_child(db, username, old_parent, old_parts[-1])
 
+    if not node:
+        raise DriveOpError("not found")
 
+    new_parent = resolve_folder(db, username, new_parts[:-1])
 
-@app.route("/api/drive", methods=["POST"])
-def save_drive():
+    if new_parent is None:
+        raise DriveOpError("no such folder")
 
-    if "user" not in session:
-        return jsonify({"error":"unauthorized"}),401
+    if is_inside(db, new_parent, node[0]):
+        raise DriveOpError("cannot move a folder into itself")
 
-    save_data(request.json)
-    return jsonify({"status":"ok"})
+    db.execute(
+        "UPDATE nodes SET parent_id=?, name=?, modified=? WHERE id=?",
+        (new_parent, new_parts[-1], timestamp(), node[0])
+    )
 
 
+@app.route("/api/rename", methods=["POST"])
+def rename_item():
+    info = request.json
 
-#  create folder
+    old_key = info.get("old_key")
+    new_key = info.get("new_key")
 
-@app.route("/api/create-folder", methods=["POST"])
-def create_folder():
+    if not old_key or not new_key:
+        return jsonify({"error": "invalid data"}), 400
 
-    info = request.get_json()
+    # Required fix
+    username = session["user"]
 
-    if not info:
-        return jsonify({"error": "No data"}), 400
+    # files and folders alike: only the node changes, objects stay put
+    db = get_db()
+    try:
+        move_node(db, username, old_key, new_key)
+        db.commit()
 
-    name = info.get("name")
-    path = info.get("path")
+    except DriveOpError as e:
+        return jsonify({"error": str(e)}), 404 if str(e) == "not found" else 400
 
-    if not name or not path:
-        return jsonify({"error": "Invalid data"}), 400
+    except sqlite3.IntegrityError:
+        return jsonify({"error": "exists"}), 409
 
+    finally:
+        db.close()
 
-    data = load_data()
+    return jsonify({"status": "renamed"})
 
-    # SAFE traversal
-    ref = data["root"]
 
-    for folder in path[1:]:
-        if folder not in ref:
-            ref[folder] = {}
-        ref = ref[folder]
+# Files Share
+@app.route("/api/share", methods=["POST"])
+def share_file():
+    if "user" not in session:
+        return jsonify({"error": "unauthorized"}), 401
 
+    file = owned_file(session["user"], (request.json or {}).get("id"))
+    if not file:
+        return jsonify({"error": "not found"}), 404
 
-    if name in ref:
-        return jsonify({"error": "exists"}), 400
+    key = file[1]
 
+    # Generate secure temporary link
+    url = s3.generate_presigned_url(
+        "get_object",
+        Params={
+            "Bucket": BUCKET_NAME,
+            "Key": key,
+            "ResponseContentDisposition": "inline"
+        },
+        ExpiresIn=3600   # 1 hour
+    )
 
-    # store metadata
-    from datetime import datetime
+    return jsonify({
+        "share_url": url,
+        "expires_in": 3600
+    })
 
-    ref[name] = {
-        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "owner": "Me"
-    }
 
-    # create S3 folder safely
-    try:
-        username = session["user"]
+# Storage Info 
 
-        s3_key = "/".join(
-            [username] + path[1:] + [name]
-        ) + "/"
+@app.route("/api/storage")
+def storage():
+    username = session.get("user")
+    if not username:
+        return jsonify({"error": "unauthorized"}), 401
 
-        s3.put_object(Bucket=BUCKET_NAME, Key=s3_key)
+    used_mb = get_user_storage(username)
+    return jsonify({"used_mb": used_mb})
 
 
+# Metrics (see METRICS): the gauges are read now, the rest is kept as it happens
+@app.route("/metrics")
+def metrics():
 
+    if not metrics_token_valid() and session.get("role") != "admin":
+        return "Access Denied", 403
 
-    except Exception as e:
-        print("S3 error:", e)
-        return jsonify({"error": "S3 failed"}), 500
+    db = get_db()
+    jobs = db.execute(
+        """
+        SELECT kind, state, COUNT(*) FROM jobs
+        WHERE state IN ('queued', 'running')
+        GROUP BY kind, state
+        """
+    ).fetchall()
+    pool = db.execute(
+        "SELECT used_bytes, reserved_bytes FROM storage_pool WHERE id = 1"
+    ).fetchone()
+    db.close()
 
+    jobs_waiting.clear()
+    for kind, state, count in jobs:
+        jobs_waiting.set(count, kind, state)
 
-    save_data(data)
+    storage_bytes.set(pool[0], "used")
+    storage_bytes.set(pool[1], "reserved")
 
-    return jsonify({"status": "created"})
+    stats = s3.stats()
+    s3_in_flight.set(stats["in_flight"])
+    s3_timeouts.set(stats["timeouts"])
 
+    db_pool_idle.set(db_pool.qsize())
+    drive_cache_size.set(drive_cache_bytes)
 
+    return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
-# FILE UPLOAD WITH PATH SUPPORT
 
-MINIDRIVE_LIMIT_MB = 3 * 1024   # 3 GB
+# BACKGROUND JOBS
+#
+# Long running work (recursive deletes, folder moves, user removal) is
+# queued in the `jobs` table and picked up by worker threads, either
+# inside the web process (MINIDRIVE_JOB_WORKERS) or in a separate
+# `python app.py worker` process. Failed jobs are retried with
+# exponential backoff, up to max_attempts. While a handler runs, its worker
+# renews the job's lease every JOB_HEARTBEAT seconds (whether or not the
+# handler reports progress), so only jobs of a dead worker are picked up
+# again, and those count as a failed attempt.
 
-def get_total_minidrive_storage():
-    total_bytes = 0
-    paginator = s3.get_paginator("list_objects_v2")
+JOB_WORKERS = int(os.environ.get("MINIDRIVE_JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = 5
+JOB_LEASE = 600          # seconds without a heartbeat before a job is reclaimed
+JOB_HEARTBEAT = 60
+JOB_POLL_INTERVAL = 1.0
 
-    for page in paginator.paginate(Bucket=BUCKET_NAME):
-        if "Contents" in page:
-            for obj in page["Contents"]:
-                total_bytes += obj["Size"]
+JOB_HANDLERS = {}
+job_wakeup = threading.Event()
 
-    return round(total_bytes / (1024 * 1024), 2)  # MB
 
-@app.route("/api/upload", methods=["POST"])
-def upload_file():
-    file = request.files.get("file")
-    path = json.loads(request.form.get("path"))
+def job_handler(kind):
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
 
-    if not file:
-        return jsonify({"error": "no file"}), 400
 
-    filename = secure_filename(file.filename)
+def enqueue_job(kind, payload, owner=None, max_attempts=JOB_MAX_ATTEMPTS, delay=0):
 
-    # Read file into memory
-    file_bytes = file.read()
-    size_mb = round(len(file_bytes) / (1024 * 1024), 2)
+    db = get_db()
+    job_id = db.execute(
+        """
+        INSERT INTO jobs (owner, kind, payload, max_attempts, run_after, created, updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (owner, kind, json.dumps(payload), max_attempts, time.time() + delay,
+         timestamp(), timestamp())
+    ).lastrowid
+    db.commit()
+    db.close()
 
-    #  Global Storage Limit Check
-    total_used_mb = get_total_minidrive_storage()
+    job_wakeup.set()
+    return job_id
 
-    if total_used_mb + size_mb > MINIDRIVE_LIMIT_MB:
-        return jsonify({
-            "error": "MINIDRIVE_STORAGE_FULL",
-            "message": "MiniDrive total storage limit (3GB) reached"
-        }), 403
-    
 
-    # build S3 key
-    username = session["user"]
+def claim_job(worker):
+    """Atomically take the oldest runnable job (or one whose lease ran out,
+    unless that was its last attempt: it is failed instead)."""
 
-    s3_key = "/".join(
-        [username] + path[1:] + [filename]
-    )
+    now = time.time()
+    db = get_db()
 
-    # upload using bytes
-    s3.put_object(
-        Bucket=BUCKET_NAME,
-        Key=s3_key,
-        Body=file_bytes,
-        ContentType=file.mimetype,
-        ContentDisposition="inline"
-    )
+    try:
+        db.execute("BEGIN IMMEDIATE")
+
+        db.execute(
+            """
+            UPDATE jobs
+            SET state='failed', error='worker lost', locked_by=NULL, updated=?
+            WHERE state = 'running' AND locked_at < ? AND attempts >= max_attempts
+            """,
+            (timestamp(), now - JOB_LEASE)
+        )
 
-    url = f"https://{BUCKET_NAME}.s3.{REGION}.amazonaws.com/{s3_key}"
-
-    #save file info database structure
-    data = load_data()
-
-    ref = data["root"]
-    for i in range(1, len(path)):
-        folder = path[i]
-        if folder not in ref:
-           ref[folder] = {
-               "created": None,
-               "owner": "Me"
-           }
-        ref = ref[folder]    
-
-    ref[filename] = {
-        "size": size_mb,
-        "url": url,
-        "type": file.mimetype
-    }
+        row = db.execute(
+            """
+            SELECT id, kind, payload, attempts, max_attempts FROM jobs
+            WHERE (state = 'queued' AND run_after <= ?)
+               OR (state = 'running' AND locked_at < ?)
+            ORDER BY run_after
+            LIMIT 1
+            """,
+            (now, now - JOB_LEASE)
+        ).fetchone()
 
-    save_data(data)
+        if row:
+            db.execute(
+                """
+                UPDATE jobs
+                SET state='running', attempts=attempts + 1,
+                    locked_by=?, locked_at=?, updated=?
+                WHERE id=?
+                """,
+                (worker, now, timestamp(), row[0])
+            )
 
-    return jsonify({
-        "name": filename,
-        "size": size_mb,
-        "url": url,
-        "type": file.mimetype
-    })
+        db.commit()
 
+    finally:
+        db.close()
 
+    if not row:
+        return None
 
-#download file
-@app.route("/api/download")
-def download_file():
+    job_id, kind, payload, attempts, max_attempts = row
+    return job_id, kind, json.loads(payload), attempts + 1, max_attempts
 
-    key = request.args.get("key")
-    if not key:
-        return jsonify({"error": "missing key"}), 400
 
-    filename = key.split("/")[-1]
+def update_job(job_id, **fields):
+    fields["updated"] = timestamp()
 
-    url = s3.generate_presigned_url(
-        "get_object",
-        Params={
-            "Bucket": BUCKET_NAME,
-            "Key": key,
-            "ResponseContentDisposition": f'attachment; filename="{filename}"'
-        },
-        ExpiresIn=300
+    db = get_db()
+    db.execute(
+        f"UPDATE jobs SET {', '.join(f'{k}=?' for k in fields)} WHERE id=?",
+        (*fields.values(), job_id)
     )
-
-    return jsonify({"url": url})
+    db.commit()
+    db.close()
 
 
-#  Delete from s3
-@app.route("/api/delete", methods=["POST"])
-def delete_file():
-    info = request.json
+def run_next_job(worker):
 
-    url = info.get("url")
-    key = info.get("key")
+    job = claim_job(worker)
+    if not job:
+        return False
 
-    # file delete
-    if url:
-        s3_key = url.split(".amazonaws.com/")[1]
-        s3.delete_object(Bucket=BUCKET_NAME, Key=s3_key)
-        return jsonify({"status": "file deleted"})
+    job_id, kind, payload, attempts, max_attempts = job
 
-    # folder delete recursive
-    if key:
-        username = session["user"]
+    def progress(done, total=None):
+        fields = {"progress_done": done, "locked_at": time.time()}
+        if total is not None:
+            fields["progress_total"] = total
+        update_job(job_id, **fields)
 
-        prefix = f"{username}/{key.rstrip('/')}/"
+    finished = threading.Event()
 
-        paginator = s3.get_paginator("list_objects_v2")
+    def heartbeat():
+        while not finished.wait(JOB_HEARTBEAT):
+            try:
+                update_job(job_id, locked_at=time.time())
+            except Exception as e:
+                print(f"Job {job_id} heartbeat failed:", e)
 
-        for page in paginator.paginate(
-            Bucket=BUCKET_NAME,
-            Prefix=prefix
-        ):
-            if "Contents" in page:
-                objects = [{"Key": obj["Key"]} for obj in page["Contents"]]
+    threading.Thread(target=heartbeat, name=f"job-heartbeat-{job_id}", daemon=True).start()
 
-                s3.delete_objects(
-                    Bucket=BUCKET_NAME,
-                    Delete={"Objects": objects}
-                )
+    try:
+        result = JOB_HANDLERS[kind](payload, progress)
+        update_job(job_id, state="done", result=json.dumps(result), error=None)
 
-        return jsonify({"status": "folder deleted"})
+    except Exception as e:
+        print(f"Job {job_id} ({kind}) attempt {attempts} failed:", e)
 
+        if attempts >= max_attempts:
+            update_job(job_id, state="failed", error=str(e))
+        else:
+            backoff = min(2 ** attempts, 300) * (1 + random.random())
+            update_job(
+                job_id,
+                state="queued",
+                run_after=time.time() + backoff,
+                error=str(e)
+            )
 
-    return jsonify({"error": "no target"}), 400
+    finally:
+        finished.set()
 
+    return True
 
 
+def job_worker_loop(worker):
+    while True:
+        try:
+            if run_next_job(worker):
+                continue
+        except Exception as e:
+            print("Job worker error:", e)
 
-# rename file and folder
+        job_wakeup.wait(JOB_POLL_INTERVAL)
+        job_wakeup.clear()
 
-def rename_in_drive(data, old_name, new_name, new_s3_key=None):
-    def walk(folder):
-        for key in list(folder.keys()):
-            if key == old_name:
-                item = folder.pop(key)
 
-                # update URL if file
-                if isinstance(item, dict) and new_s3_key:
-                    item["url"] = (
-                        f"https://{BUCKET_NAME}.s3.{REGION}.amazonaws.com/{new_s3_key}"
-                    )
+def start_job_workers(count):
+    for i in range(count):
+        threading.Thread(
+            target=job_worker_loop,
+            args=(f"{os.getpid()}-{i}",),
+            name=f"job-worker-{i}",
+            daemon=True
+        ).start()
 
-                folder[new_name] = item
-                return True
 
-            if isinstance(folder[key], dict):
-                if walk(folder[key]):
-                    return True
-        return False
+@job_handler("delete_prefix")
+def delete_prefix_job(payload, progress):
+    deleted = delete_prefix_objects(payload["owner"], payload["prefix"], progress)
+    return {"deleted": deleted}
 
-    walk(data["root"])
 
-def update_urls_recursively(folder, old_prefix, new_prefix):
-    for key, item in folder.items():
-        if isinstance(item, dict):
-            # file
-            if "url" in item:
-                item["url"] = item["url"].replace(old_prefix, new_prefix)
-            # subfolder
-            else:
-                update_urls_recursively(item, old_prefix, new_prefix)
+@job_handler("delete_orphans")
+def delete_orphans_job(payload, progress):
+    return {"deleted": delete_orphans(payload["owner"], progress)}
 
 
+@job_handler("delete_user_files")
+def delete_user_files_job(payload, progress):
+    username = payload["username"]
+    deleted = delete_user_s3_folder(username, progress)
 
-@app.route("/api/rename", methods=["POST"])
-def rename_item():
-    info = request.json
+    # whatever the ledger still holds for this user is gone now
+    db = get_db()
+    forget_user_usage(db.cursor(), username)
+    db.commit()
+    db.close()
 
-    old_key = info.get("old_key")
-    new_key = info.get("new_key")
-    is_folder = info.get("is_folder")
+    return {"deleted": deleted}
 
-    if not old_key or not new_key:
-        return jsonify({"error": "invalid data"}), 400
 
-    # Required fix
-    username = session["user"]
+@job_handler("reconcile_storage")
+def reconcile_storage_job(payload, progress):
+    return {"drift": reconcile_storage()}
 
-    #  file rename
-    if not is_folder:
-        content_type = mimetypes.guess_type(new_key)[0] or "application/octet-stream"
 
-        old_s3_key = f"{username}/{old_key}"
-        new_s3_key = f"{username}/{new_key}"
+@job_handler("purge_trash")
+def purge_trash_job(payload, progress):
+    items, objects = purge_trash(progress)
+    return {"items": items, "deleted": objects}
 
-        s3.copy_object(
-            Bucket=BUCKET_NAME,
-            CopySource={"Bucket": BUCKET_NAME, "Key": old_s3_key},
-            Key=new_s3_key,
-            MetadataDirective="COPY",
-            ContentType=content_type,
-            ContentDisposition="inline"
-        )
 
-        s3.delete_object(Bucket=BUCKET_NAME, Key=old_s3_key)
+@job_handler("absorb_upload")
+def absorb_upload_job(payload, progress):
+    return {"deleted": absorb_upload(payload["owner"], payload["s3_key"])}
 
-        # update database
-        data = load_data()
-        old_name = old_key.split("/")[-1]
-        new_name = new_key.split("/")[-1]
-        rename_in_drive(data, old_name, new_name, new_s3_key=new_s3_key)
-        save_data(data)
 
-        return jsonify({"status": "file renamed"})
+@job_handler("thumbnails")
+def thumbnails_job(payload, progress):
+    keys = payload["keys"]
+    stored = done = 0
 
-    # folder rename
-    old_prefix = f"{username}/{old_key.rstrip('/')}/"
-    new_prefix = f"{username}/{new_key.rstrip('/')}/"
+    # a failure raises out of map and the job is retried; keys that are
+    # done by then aren't 'queued' any more and are skipped
+    with ThreadPoolExecutor(max_workers=THUMB_WORKERS) as pool:
+        for size in pool.map(make_thumbnails, keys):
+            stored += size
+            done += 1
 
-    resp = s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=old_prefix)
+            if done % 10 == 0:
+                progress(done, len(keys))
 
-    if "Contents" in resp:
-        for obj in resp["Contents"]:
-            old_obj_key = obj["Key"]
-            new_obj_key = old_obj_key.replace(old_prefix, new_prefix, 1)
+    return {"thumbnails": len(keys), "bytes": stored}
 
-            content_type = (
-                mimetypes.guess_type(new_obj_key)[0]
-                or "application/octet-stream"
-            )
 
-            s3.copy_object(
-                Bucket=BUCKET_NAME,
-                CopySource={"Bucket": BUCKET_NAME, "Key": old_obj_key},
-                Key=new_obj_key,
-                MetadataDirective="COPY",
-                ContentType=content_type,
-                ContentDisposition="inline"
-            )
+@app.route("/api/jobs/<int:job_id>")
+def job_status(job_id):
 
-            s3.delete_object(Bucket=BUCKET_NAME, Key=old_obj_key)
+    db = get_db()
+    row = db.execute(
+        """
+        SELECT id, owner, kind, state, attempts, progress_done, progress_total,
+               result, error, created, updated
+        FROM jobs WHERE id=?
+        """,
+        (job_id,)
+    ).fetchone()
+    db.close()
 
-    # UPDATE DB (folder name only)
-    data = load_data()
+    if not row or (row[1] != session["user"] and session.get("role") != "admin"):
+        return jsonify({"error": "not found"}), 404
 
-    old_name = old_key.rstrip("/").split("/")[-1]
-    new_name = new_key.rstrip("/").split("/")[-1]
+    return jsonify({
+        "id": row[0],
+        "kind": row[2],
+        "state": row[3],
+        "attempts": row[4],
+        "progress": {"done": row[5], "total": row[6]},
+        "result": json.loads(row[7]) if row[7] else None,
+        "error": row[8],
+        "created": row[9],
+        "updated": row[10]
+    })
 
-    # rename folder node
-    rename_in_drive(data, old_name, new_name)
 
-    # update child file URLs
-    old_url_prefix = f"https://{BUCKET_NAME}.s3.{REGION}.amazonaws.com/{old_prefix}"
-    new_url_prefix = f"https://{BUCKET_NAME}.s3.{REGION}.amazonaws.com/{new_prefix}"
 
-    # locate renamed folder in DB
-    def find_folder(folder):
-        for k, v in folder.items():
-            if k == new_name and isinstance(v, dict):
-                return v
-            if isinstance(v, dict):
-                found = find_folder(v)
-                if found:
-                    return found
-        return None
+#  RUN 
+#
+# Importing the app only opens the database. The data migrations run once
+# per database; the background threads (job workers, ledger reconcile,
+# trash purge) run in `python app.py worker`, in the development server,
+# or in a web process started with MINIDRIVE_BACKGROUND=1. Off by default
+# there, since every worker of a multi-process server would start its own.
 
-    renamed_folder = find_folder(data["root"])
-    if renamed_folder:
-        update_urls_recursively(
-            renamed_folder,
-            old_url_prefix,
-            new_url_prefix
-        )
+BACKGROUND = os.environ.get("MINIDRIVE_BACKGROUND", "0") == "1"
 
-    save_data(data)
+MIGRATIONS = (
+    ("drive_blobs", migrate_drive_blobs),
+    ("recent_lists", migrate_recent_lists),
+)
 
 
-    return jsonify({"status": "folder renamed"})
+def run_migrations():
+    """Run the migrations not recorded in `migrations` yet, in order.
 
-# Files Share
-@app.route("/api/share", methods=["POST"])
-def share_file():
-    if "user" not in session:
-        return jsonify({"error": "unauthorized"}), 401
+    Each is safe to run twice, so two processes starting at once on an
+    old database only do some work for nothing.
+    """
 
-    key = request.json.get("key")
-    if not key:
-        return jsonify({"error": "missing key"}), 400
+    db = get_db()
+    done = {r[0] for r in db.execute("SELECT name FROM migrations").fetchall()}
+    db.close()
 
-    # Generate secure temporary link
-    url = s3.generate_presigned_url(
-        "get_object",
-        Params={
-            "Bucket": BUCKET_NAME,
-            "Key": key,
-            "ResponseContentDisposition": "inline"
-        },
-        ExpiresIn=3600   # 1 hour
-    )
+    for name, migrate in MIGRATIONS:
+        if name in done:
+            continue
 
-    return jsonify({
-        "share_url": url,
-        "expires_in": 3600
-    })
+        migrate()
 
+        db = get_db()
+        db.execute(
+            "INSERT OR IGNORE INTO migrations (name, done) VALUES (?, ?)",
+            (name, time.time())
+        )
+        db.commit()
+        db.close()
 
-# Storage Info 
+        print("Migration done:", name)
 
-@app.route("/api/storage")
-def storage():
-    username = session.get("user")
-    if not username:
-        return jsonify({"error": "unauthorized"}), 401
 
-    total_bytes = 0
-    paginator = s3.get_paginator("list_objects_v2")
+def start_background(job_workers):
+    if RECONCILE_INTERVAL > 0:
+        start_storage_reconciler()
 
-    for page in paginator.paginate(
-        Bucket=BUCKET_NAME,
-        Prefix=f"{username}/"
-    ):
-        if "Contents" in page:
-            for obj in page["Contents"]:
-                total_bytes += obj["Size"]
+    if TRASH_PURGE_INTERVAL > 0:
+        start_trash_purger()
 
-    used_mb = round(total_bytes / (1024 * 1024), 2)
-    return jsonify({"used_mb": used_mb})
+    if job_workers > 0:
+        start_job_workers(job_workers)
 
 
+run_migrations()
 
-#  RUN 
+if __name__ == "__main__" and sys.argv[1:2] == ["worker"]:
+    # standalone worker: python app.py worker
+    start_background(max(JOB_WORKERS, 1))
+    while True:
+        time.sleep(3600)
 
 if __name__ == "__main__":
+    # with the reloader on, only its child process serves requests
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background(JOB_WORKERS)
+
     app.run(host="0.0.0.0", port=5000, debug=True)
+
+elif BACKGROUND:
+    start_background(JOB_WORKERS)
@@ -0,0 +1,41 @@
+"""Setup shared by the benchmark scripts."""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_app(workdir, endpoint=None, local=False):
+    """Import the app with its database in workdir and no background
+    threads. S3 is moto in-process, unless endpoint names an S3 server or
+    local picks the local-disk backend."""
+
+    os.chdir(workdir)
+    os.environ["MINIDRIVE_RECONCILE_INTERVAL"] = "0"
+    os.environ["MINIDRIVE_JOB_WORKERS"] = "0"
+    os.environ["MINIDRIVE_TRASH_PURGE_INTERVAL"] = "0"
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+
+    if local:
+        os.environ["MINIDRIVE_STORAGE"] = "local"
+        os.environ["MINIDRIVE_STORAGE_DIR"] = os.path.join(workdir, "storage")
+    elif endpoint:
+        os.environ["AWS_ENDPOINT_URL_S3"] = endpoint
+    else:
+        from moto import mock_aws
+        mock_aws().start()
+
+    sys.path.insert(0, ROOT)
+    import app as minidrive
+
+    try:
+        minidrive.s3.create_bucket(
+            Bucket=minidrive.BUCKET_NAME,
+            CreateBucketConfiguration={"LocationConstraint": minidrive.REGION}
+        )
+    except minidrive.s3.exceptions.ClientError:
+        pass    # a server that has the bucket already
+
+    return minidrive
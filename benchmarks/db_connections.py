@@ -0,0 +1,133 @@
+"""Requests/sec of the DB-heavy endpoints, old get_db() vs pooled connections.
+
+"before" swaps get_db() back to a fresh sqlite3.connect() per call on a
+rollback-journal database, "after" is the per-request connection + WAL.
+S3 is replaced by moto, the database lives in a temporary directory.
+
+    pip install moto
+    python benchmarks/db_connections.py --requests 2000 --threads 8
+"""
+
+import argparse
+import sqlite3
+import tempfile
+import threading
+import time
+
+from _common import setup_app
+
+
+def seed(minidrive, users, files):
+    db = minidrive.get_db()
+
+    for u in range(users):
+        username = f"bench{u}"
+        db.execute("INSERT INTO users (username, password) VALUES (?, 'x')", (username,))
+        db.execute("INSERT INTO drive (username, data) VALUES (?, '{\"recent\": []}')", (username,))
+
+        folder = minidrive.resolve_folder(db, username, ["docs"], create=True)
+        for i in range(files):
+            minidrive.put_file_node(
+                db, username, folder, f"file{i}.txt", 1024, "text/plain",
+                f"{username}/docs/file{i}.txt"
+            )
+
+    db.commit()
+    db.close()
+
+
+def client_for(minidrive, username):
+    client = minidrive.app.test_client()
+    with client.session_transaction() as sess:
+        sess["user"] = username
+        sess["role"] = "user"
+    return client
+
+
+def hammer(minidrive, users, requests, threads, make_request):
+    errors = []
+    per_thread = requests // threads
+
+    def worker(n):
+        client = client_for(minidrive, f"bench{n % users}")
+        for i in range(per_thread):
+            try:
+                resp = make_request(client, n, i)
+                if resp.status_code >= 500:
+                    errors.append(resp.status_code)
+            except sqlite3.OperationalError as e:
+                errors.append(str(e))
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    return per_thread * threads / elapsed, len(errors)
+
+
+SCENARIOS = {
+    "GET /api/storage": lambda c, n, i: c.get("/api/storage"),
+    "GET /api/drive": lambda c, n, i: c.get("/api/drive"),
+    "POST /api/create-folder": lambda c, n, i: c.post(
+        "/api/create-folder",
+        json={"name": f"f-{n}-{i}-{time.time_ns()}", "path": ["root"]}
+    ),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--files", type=int, default=200)
+    args = parser.parse_args()
+
+    minidrive = setup_app(tempfile.mkdtemp(prefix="minidrive-bench-"))
+    seed(minidrive, args.users, args.files)
+
+    pooled_get_db = minidrive.get_db
+
+    def legacy_get_db():
+        return sqlite3.connect(minidrive.DB_FILE)
+
+    results = {}
+
+    for label, get_db, journal in (
+        ("before", legacy_get_db, "DELETE"),
+        ("after", pooled_get_db, "WAL"),
+    ):
+        # the journal mode can only change with no other connection open
+        while not minidrive.db_pool.empty():
+            minidrive.db_pool.get_nowait().close()
+
+        conn = sqlite3.connect(minidrive.DB_FILE)
+        conn.execute(f"PRAGMA journal_mode={journal}")
+        conn.close()
+
+        minidrive.get_db = get_db
+
+        for name, make_request in SCENARIOS.items():
+            rps, errors = hammer(
+                minidrive, args.users, args.requests, args.threads, make_request
+            )
+            results.setdefault(name, {})[label] = (rps, errors)
+
+    minidrive.get_db = pooled_get_db
+
+    print(f"{args.requests} requests, {args.threads} threads, "
+          f"{args.users} users x {args.files} files\n")
+    print(f"{'endpoint':<26}{'before req/s':>14}{'after req/s':>14}{'speedup':>9}   errors (before/after)")
+
+    for name, runs in results.items():
+        (before, before_errors), (after, after_errors) = runs["before"], runs["after"]
+        print(f"{name:<26}{before:>14.0f}{after:>14.0f}{after / before:>8.2f}x   "
+              f"{before_errors}/{after_errors}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""Latency, throughput and S3 calls of the main endpoints as the data grows.
+
+Seeds synthetic drives in steps (FILESxUSERS: 1k files / 10 users, 10k /
+100, 100k / 1,000 by default). "bench0" owns FILES files in nested
+folders, the other users a few files each. After each step every endpoint
+is hit from --threads clients at once and reports p50/p95/p99 latency,
+requests per second, and the S3 calls each request made, counted by the
+app's own S3 wrapper. Background jobs are not run, so S3 work they'd do
+later (thumbnails, orphan deletes) isn't counted.
+
+S3 is moto in-process by default. --endpoint sends the calls to an S3
+server instead (moto_server, MinIO), --local uses the local-disk backend.
+The database lives in a temporary directory. Results are written as JSON;
+--baseline compares them with an earlier run of this script. It counts S3
+calls with the app's S3 wrapper, so it can't be pointed at a tree from
+before the wrapper existed.
+
+    pip install moto
+    python benchmarks/endpoints.py --out before.json
+    python benchmarks/endpoints.py --baseline before.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from _common import ROOT, setup_app
+
+USER = "bench0"
+ADMIN = "benchadmin"
+
+FOLDER_FILES = 100          # files per folder in the big drive
+SMALL_DRIVE = 20            # files each other user has
+UPLOAD_BYTES = 64 * 1024
+
+
+
+def parse_datasets(text):
+    datasets = []
+    for step in text.split(","):
+        files, users = step.lower().split("x")
+        datasets.append((int(files), int(users)))
+    return sorted(datasets)
+
+
+def add_user(db, username, role="user"):
+    db.execute(
+        "INSERT INTO users (username, password, role) VALUES (?, 'x', ?)",
+        (username, role)
+    )
+    db.execute("INSERT INTO drive (username, data) VALUES (?, '{}')", (username,))
+
+
+def folder_of(i):
+    """The folder (relative to My Drive) file i goes in: FOLDER_FILES files
+    per folder, two levels deep."""
+
+    folder = i // FOLDER_FILES
+    return [f"dir{folder // 10}", f"sub{folder % 10}"]
+
+
+def add_files(minidrive, db, username, start, count, rng):
+    now = minidrive.timestamp()
+    rows = []
+    parent = None
+
+    for i in range(start, start + count):
+        if parent is None or i % FOLDER_FILES == 0:
+            parent = minidrive.resolve_folder(db, username, folder_of(i), create=True)
+
+        rows.append((
+            username, parent, f"file{i}.txt", rng.randint(1, 4096) * 1024,
+            "text/plain", minidrive.new_object_key(username), now, now
+        ))
+
+    db.executemany(
+        """
+        INSERT INTO nodes (owner, parent_id, name, kind, size, mime, s3_key, created, modified)
+        VALUES (?, ?, ?, 'file', ?, ?, ?, ?, ?)
+        """,
+        rows
+    )
+
+
+def grow(minidrive, have, files, users, rng):
+    """Top the data up from have = (files, users) to (files, users)."""
+
+    db = minidrive.get_db()
+
+    if have == (0, 0):
+        add_user(db, USER)
+        add_user(db, ADMIN, role="admin")
+        have = (0, 1)
+
+    add_files(minidrive, db, USER, have[0], files - have[0], rng)
+
+    for u in range(have[1], users):
+        username = f"bench{u}"
+        add_user(db, username)
+        add_files(minidrive, db, username, 0, SMALL_DRIVE, rng)
+
+    db.commit()
+    db.close()
+
+
+def client_for(minidrive, username, role="user"):
+    client = minidrive.app.test_client()
+    with client.session_transaction() as sess:
+        sess["user"] = username
+        sess["role"] = role
+    return client
+
+
+def upload(minidrive):
+    client = client_for(minidrive, USER)
+
+    def request(thread, i):
+        body = os.urandom(UPLOAD_BYTES)     # distinct bytes, no dedup
+        return client.post(
+            "/api/upload",
+            data={
+                "file": (io.BytesIO(body), f"up-{thread}-{i}-{time.time_ns()}.bin"),
+                "path": json.dumps(["root", "uploads"])
+            },
+            content_type="multipart/form-data"
+        )
+
+    return request
+
+
+def drive(minidrive, cached=True):
+    client = client_for(minidrive, USER)
+
+    def request(thread, i):
+        if not cached:
+            minidrive.drop_cached_drive(USER)
+        return client.get("/api/drive")
+
+    return request
+
+
+def rename(minidrive):
+    """Each thread renames its own file back and forth."""
+
+    client = client_for(minidrive, USER)
+    renamed = set()
+
+    def request(thread, i):
+        folder = "/".join(folder_of(thread))
+        names = [f"{folder}/file{thread}.txt", f"{folder}/renamed{thread}.txt"]
+        if thread in renamed:
+            names.reverse()
+
+        resp = client.post("/api/rename", json={"old_key": names[0], "new_key": names[1]})
+        if resp.status_code == 200:
+            renamed.symmetric_difference_update({thread})
+        return resp
+
+    return request
+
+
+def admin(minidrive):
+    client = client_for(minidrive, ADMIN, role="admin")
+    return lambda thread, i: client.get("/admin")
+
+
+def storage(minidrive):
+    client = client_for(minidrive, USER)
+    return lambda thread, i: client.get("/api/storage")
+
+
+ENDPOINTS = {
+    "POST /api/upload": upload,
+    "GET /api/drive": drive,
+    "GET /api/drive (rebuilt)": lambda minidrive: drive(minidrive, cached=False),
+    "POST /api/rename": rename,
+    "GET /admin": admin,
+    "GET /api/storage": storage,
+}
+
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def s3_calls(minidrive):
+    return {op: stat[0] for op, stat in minidrive.s3.stats()["ops"].items()}
+
+
+def hammer(minidrive, make_request, requests, threads):
+    """requests spread over threads; latency of each, rps of the lot."""
+
+    samples = []
+    errors = []
+    lock = threading.Lock()
+    per_thread = max(1, requests // threads)
+
+    def worker(thread):
+        for i in range(per_thread):
+            started = time.perf_counter()
+            try:
+                status = make_request(thread, i).status_code
+            except Exception as e:
+                status = repr(e)
+            took = (time.perf_counter() - started) * 1000
+
+            with lock:
+                samples.append(took)
+                if status != 200:
+                    errors.append(status)
+
+    before = s3_calls(minidrive)
+    started = time.perf_counter()
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+    elapsed = time.perf_counter() - started
+    after = s3_calls(minidrive)
+
+    samples.sort()
+    done = len(samples)
+
+    return {
+        "requests": done,
+        "errors": len(errors),
+        "rps": round(done / elapsed, 1),
+        "mean_ms": round(sum(samples) / done, 3),
+        "p50_ms": round(percentile(samples, 50), 3),
+        "p95_ms": round(percentile(samples, 95), 3),
+        "p99_ms": round(percentile(samples, 99), 3),
+        "s3_calls": {
+            op: round((after[op] - before.get(op, 0)) / done, 2)
+            for op in sorted(after)
+            if after[op] != before.get(op, 0)
+        }
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def change(new, old):
+    return f"{(new - old) / old * 100:+.0f}%" if old else ""
+
+
+def report(result, baseline):
+    """One table per dataset, with the change from the baseline run."""
+
+    old = {}
+    if baseline:
+        for step in baseline["datasets"]:
+            old[step["name"]] = step["endpoints"]
+
+    print(f"\n{result['name']}: {result['files']} files, {result['users']} users "
+          f"(seeded in {result['seed_seconds']}s)\n")
+    print(f"{'endpoint':<26}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}"
+          f"{'errors':>8}  s3 calls / request")
+
+    for name, stats in result["endpoints"].items():
+        calls = ", ".join(f"{op} {n:g}" for op, n in stats["s3_calls"].items()) or "-"
+        print(f"{name:<26}{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}"
+              f"{stats['p99_ms']:>9.2f}{stats['rps']:>9.1f}{stats['errors']:>8}  {calls}")
+
+        before = old.get(result["name"], {}).get(name)
+        if before:
+            print(f"{'  vs baseline':<26}{change(stats['p50_ms'], before['p50_ms']):>9}"
+                  f"{change(stats['p95_ms'], before['p95_ms']):>9}"
+                  f"{change(stats['p99_ms'], before['p99_ms']):>9}"
+                  f"{change(stats['rps'], before['rps']):>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--datasets", default="1000x10,10000x100,100000x1000",
+                        help="FILESxUSERS steps, smallest first")
+    parser.add_argument("--requests", type=int, default=200, help="per endpoint and step")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--endpoint", help="S3 server URL instead of in-process moto")
+    parser.add_argument("--local", action="store_true", help="local-disk storage backend")
+    parser.add_argument("--only", action="append", help="endpoint name, repeatable")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="result JSON (default endpoints-<commit>.json)")
+    parser.add_argument("--baseline", help="result JSON of an earlier run to compare with")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    out = os.path.abspath(args.out or f"endpoints-{commit or 'worktree'}.json")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    minidrive = setup_app(
+        tempfile.mkdtemp(prefix="minidrive-bench-"), args.endpoint, args.local
+    )
+    rng = random.Random(args.seed)
+
+    endpoints = {
+        name: make for name, make in ENDPOINTS.items()
+        if not args.only or name in args.only
+    }
+
+    result = {
+        "commit": commit,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "storage": "local" if args.local else args.endpoint or "moto",
+        "requests": args.requests,
+        "threads": args.threads,
+        "datasets": []
+    }
+
+    have = (0, 0)
+
+    for files, users in parse_datasets(args.datasets):
+        started = time.perf_counter()
+        grow(minidrive, have, files, users, rng)
+        have = (files, users)
+
+        step = {
+            "name": f"{files}x{users}",
+            "files": files,
+            "users": users,
+            "seed_seconds": round(time.perf_counter() - started, 1),
+            "endpoints": {}
+        }
+
+        for name, make in endpoints.items():
+            step["endpoints"][name] = hammer(
+                minidrive, make(minidrive), args.requests, args.threads
+            )
+
+        result["datasets"].append(step)
+        report(step, baseline)
+
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print(f"\nwritten to {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""Path-addressed lookups and renames on one big drive (100k nodes default).
+
+"tree walk" is the old way: load the whole tree and search it recursively
+for the first item with the name. "by path" resolves the exact path one
+indexed (owner, parent_id, name) probe per level, which is what rename,
+move and /api/drive/ops do now. S3 is replaced by moto, the database lives
+in a temporary directory.
+
+    pip install moto
+    python benchmarks/path_lookups.py --folders 100 --subfolders 10 --files 99
+"""
+
+import argparse
+import random
+import statistics
+import tempfile
+import time
+
+from _common import setup_app
+
+USER = "bench"
+
+
+
+def seed(minidrive, folders, subfolders, files):
+    """root/f<i>/s<j>/file<k>.txt; returns every file path."""
+
+    db = minidrive.get_db()
+    db.execute("INSERT INTO users (username, password) VALUES (?, 'x')", (USER,))
+    db.execute("INSERT INTO drive (username, data) VALUES (?, '{\"recent\": []}')", (USER,))
+
+    now = minidrive.timestamp()
+    paths = []
+
+    for i in range(folders):
+        for j in range(subfolders):
+            sub = minidrive.resolve_folder(db, USER, [f"f{i}", f"s{j}"], create=True)
+
+            db.executemany(
+                """
+                INSERT INTO nodes (owner, parent_id, name, kind, size, mime, s3_key, created, modified)
+                VALUES (?, ?, ?, 'file', 1024, 'text/plain', ?, ?, ?)
+                """,
+                [
+                    (USER, sub, f"file{k}.txt", f"{USER}/f{i}/s{j}/file{k}.txt", now, now)
+                    for k in range(files)
+                ]
+            )
+            paths += [["root", f"f{i}", f"s{j}", f"file{k}.txt"] for k in range(files)]
+
+    db.commit()
+    count = db.execute("SELECT COUNT(*) FROM nodes WHERE owner=?", (USER,)).fetchone()[0]
+    db.close()
+
+    return paths, count
+
+
+def tree_walk(minidrive, name):
+    """The old lookup: whole tree in, first match by bare name out."""
+
+    db = minidrive.get_db()
+    tree = minidrive.build_tree(db, USER)
+    db.close()
+
+    def search(folder):
+        for key, item in folder.items():
+            if key == name:
+                return item
+            if "url" not in item:
+                found = search(item)
+                if found is not None:
+                    return found
+        return None
+
+    return search(tree["root"])
+
+
+def by_path(minidrive, path):
+    db = minidrive.get_db()
+    node = minidrive.find_node(db, USER, path)
+    db.close()
+    return node
+
+
+def timed(fn, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.mean(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--folders", type=int, default=100)
+    parser.add_argument("--subfolders", type=int, default=10)
+    parser.add_argument("--files", type=int, default=99)
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--walk-runs", type=int, default=5)
+    args = parser.parse_args()
+
+    minidrive = setup_app(tempfile.mkdtemp(prefix="minidrive-bench-"))
+    paths, count = seed(minidrive, args.folders, args.subfolders, args.files)
+
+    client = minidrive.app.test_client()
+    with client.session_transaction() as sess:
+        sess["user"] = USER
+        sess["role"] = "user"
+
+    version = client.get("/api/drive").get_json()["version"]
+    pick = lambda: random.choice(paths)
+
+    # one path per run, the file last in the drive is the walk's worst case
+    last = paths[-1]
+
+    results = {
+        "lookup, tree walk": timed(lambda: tree_walk(minidrive, last[-1]), args.walk_runs),
+        "lookup, by path": timed(lambda: by_path(minidrive, pick()), args.runs),
+    }
+
+    def rename_file():
+        nonlocal version
+        path = pick()
+        renamed = path[:-1] + ["renamed-" + path[-1]]
+        resp = client.post("/api/drive/ops", json={
+            "base_version": version,
+            "ops": [{"op": "move", "from": path, "to": renamed}]
+        })
+        version = resp.get_json()["version"]
+        paths[paths.index(path)] = renamed
+
+    def rename_folder():
+        i = random.randrange(args.folders)
+        db = minidrive.get_db()
+        minidrive.move_node(db, USER, f"f{i}", f"f{i}-tmp")
+        minidrive.move_node(db, USER, f"f{i}-tmp", f"f{i}")
+        db.commit()
+        db.close()
+
+    results["rename file (/api/drive/ops)"] = timed(rename_file, args.runs)
+    results["rename folder x2 (metadata)"] = timed(rename_folder, args.runs)
+
+    print(f"{count} nodes ({args.folders} x {args.subfolders} folders, "
+          f"{args.files} files each)\n")
+    print(f"{'operation':<32}{'mean ms':>10}{'p95 ms':>10}")
+
+    for name, (mean, p95) in results.items():
+        print(f"{name:<32}{mean:>10.3f}{p95:>10.3f}")
+
+    walk = results["lookup, tree walk"][0]
+    path = results["lookup, by path"][0]
+    print(f"\nby path is {walk / path:.0f}x faster than the tree walk")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""/api/search latency on one big drive (100k entries default).
+
+Seeds a drive of folders full of files with mixed names and mime types,
+then times a few typical queries through the endpoint, next to the only
+option there was before: load the whole tree and filter it client side.
+Also times folder renames, which should cost the same whatever is inside
+the folder (one top folder of the seeded drive, then --big-folder files in
+a single folder).
+S3 is replaced by moto, the database lives in a temporary directory.
+
+    pip install moto
+    python benchmarks/search.py --folders 100 --subfolders 10 --files 99 --big-folder 100000
+"""
+
+import argparse
+import random
+import statistics
+import tempfile
+import time
+
+from _common import setup_app
+
+USER = "bench"
+
+WORDS = ["report", "invoice", "photo", "holiday", "budget", "notes", "draft",
+         "scan", "contract", "slides", "backup", "recipe", "resume", "design"]
+
+TYPES = [("pdf", "application/pdf"), ("jpg", "image/jpeg"), ("png", "image/png"),
+         ("txt", "text/plain"), ("docx", "application/msword"), ("zip", "application/zip")]
+
+
+
+def seed(minidrive, folders, subfolders, files):
+    rng = random.Random(1)
+
+    db = minidrive.get_db()
+    db.execute("INSERT INTO users (username, password) VALUES (?, 'x')", (USER,))
+    db.execute("INSERT INTO drive (username, data) VALUES (?, '{\"recent\": []}')", (USER,))
+
+    now = minidrive.timestamp()
+
+    for i in range(folders):
+        top = f"{rng.choice(WORDS)}-{i}"
+
+        for j in range(subfolders):
+            sub = minidrive.resolve_folder(db, USER, [top, f"{2000 + j}"], create=True)
+
+            rows = []
+            for k in range(files):
+                ext, mime = rng.choice(TYPES)
+                name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{k}.{ext}"
+                rows.append((USER, sub, name, rng.randint(1, 50) * 1024 * 1024, mime,
+                             f"{USER}/{top}/{2000 + j}/{name}", now, now))
+
+            db.executemany(
+                """
+                INSERT INTO nodes (owner, parent_id, name, kind, size, mime, s3_key, created, modified)
+                VALUES (?, ?, ?, 'file', ?, ?, ?, ?, ?)
+                """,
+                rows
+            )
+
+    db.commit()
+    count = db.execute("SELECT COUNT(*) FROM nodes WHERE owner=?", (USER,)).fetchone()[0]
+    db.close()
+
+    return count
+
+
+def seed_big_folder(minidrive, files):
+    """One top folder ("big") with `files` files directly inside."""
+
+    db = minidrive.get_db()
+    folder = minidrive.resolve_folder(db, USER, ["big"], create=True)
+    now = minidrive.timestamp()
+
+    db.executemany(
+        """
+        INSERT INTO nodes (owner, parent_id, name, kind, size, mime, s3_key, created, modified)
+        VALUES (?, ?, ?, 'file', 1024, 'text/plain', ?, ?, ?)
+        """,
+        [(USER, folder, f"f{i}.txt", f"{USER}/big/{i}", now, now) for i in range(files)]
+    )
+    db.commit()
+    db.close()
+
+
+def tree_filter(minidrive, query):
+    """Before: the whole drive to the client, substring filter there."""
+
+    db = minidrive.get_db()
+    tree = minidrive.build_tree(db, USER)
+    db.close()
+
+    found = []
+
+    def walk(folder):
+        for name, item in folder.items():
+            if query in name.lower():
+                found.append(name)
+            if "url" not in item:
+                walk(item)
+
+    walk(tree["root"])
+    return found[:minidrive.SEARCH_PAGE]
+
+
+def timed(fn, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.mean(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--folders", type=int, default=100)
+    parser.add_argument("--subfolders", type=int, default=10)
+    parser.add_argument("--files", type=int, default=99)
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--big-folder", type=int, default=10000,
+                        help="files in the one big folder that is renamed")
+    args = parser.parse_args()
+
+    minidrive = setup_app(tempfile.mkdtemp(prefix="minidrive-bench-"))
+    count = seed(minidrive, args.folders, args.subfolders, args.files)
+
+    client = minidrive.app.test_client()
+    with client.session_transaction() as sess:
+        sess["user"] = USER
+        sess["role"] = "user"
+
+    def search(**params):
+        resp = client.get("/api/search", query_string=params)
+        assert resp.status_code == 200, resp.data
+        return resp
+
+    queries = {
+        "q=invoice_budget": dict(q="invoice_budget"),
+        "q=_42.pdf": dict(q="_42.pdf"),
+        "q=report, 2nd page": dict(q="report", cursor="50"),
+        "q=2003 (path)": dict(q="2003"),
+        "q=holiday&type=image": dict(q="holiday", type="image"),
+        "q=scan&min_size=45": dict(q="scan", min_size=45),
+        "q=zz (no match)": dict(q="zzz"),
+        "q=sc (short, LIKE)": dict(q="sc"),
+    }
+
+    results = {"tree filter (before)": timed(lambda: tree_filter(minidrive, "invoice_budget"), 3)}
+
+    for name, params in queries.items():
+        results[name] = timed(lambda: search(**params), args.runs)
+
+    def rename_folder(name):
+        db = minidrive.get_db()
+        minidrive.move_node(db, USER, name, name + "-x")
+        minidrive.move_node(db, USER, name + "-x", name)
+        db.commit()
+        db.close()
+
+    db = minidrive.get_db()
+    top = db.execute(
+        "SELECT name FROM nodes WHERE owner=? AND parent_id=? LIMIT 1",
+        (USER, minidrive.get_drive_roots(db, USER)["root"])
+    ).fetchone()[0]
+    db.close()
+
+    inside = args.subfolders * (args.files + 1)
+    results[f"rename {inside} entries x2"] = timed(lambda: rename_folder(top), 10)
+
+    if args.big_folder:
+        seed_big_folder(minidrive, args.big_folder)
+        count += args.big_folder + 1
+        results[f"rename {args.big_folder} entries x2"] = timed(lambda: rename_folder("big"), 3)
+
+    print(f"{count} nodes, first page of {minidrive.SEARCH_PAGE}\n")
+    print(f"{'query':<30}{'mean ms':>10}{'p95 ms':>10}")
+
+    for name, (mean, p95) in results.items():
+        print(f"{name:<30}{mean:>10.2f}{p95:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
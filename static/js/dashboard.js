@@ -21,14 +21,79 @@ const searchInput = document.getElementById("searchInput");
 /* DATA */
 
 let data = { root: {}, trash: {}, recent: [] };
+let driveVersion = 0;
+
+/* folders come a page at a time from /api/list and are kept in `data`
+   as they're opened; per folder object: { cursor, done, children } */
+const listing = new WeakMap();
 
 async function loadDrive() {
-  const res = await fetch("/api/drive");
-  data = await res.json();
+  const res = await fetch("/api/drive?tree=0");
+  const info = await res.json();
+
+  // start over, folders are listed again as they're shown (recent
+  // entries come from /api/recent when that view is opened)
+  data = { root: {}, trash: {}, recent: data.recent };
+  driveVersion = info.version;
+
   render();
 
 }
 
+function listMore(path, folder) {
+  let state = listing.get(folder);
+
+  if (!state) {
+    state = { cursor: null, done: false };
+    listing.set(folder, state);
+  }
+
+  if (state.done) return Promise.resolve();
+
+  // one request per folder at a time, every caller waits on the same one
+  if (!state.pending) {
+    state.pending = fetchListPage(path, folder, state)
+      .finally(() => { state.pending = null; });
+  }
+
+  return state.pending;
+}
+
+async function fetchListPage(path, folder, state) {
+  const params = new URLSearchParams({ path: path.join("/") });
+  if (state.cursor) params.set("cursor", state.cursor);
+
+  const res = await fetch(`/api/list?${params}`);
+
+  if (!res.ok) {
+    state.done = true;
+    return;
+  }
+
+  const page = await res.json();
+
+  page.items.forEach(item => {
+
+    if (item.kind === "folder") {
+      if (!folder[item.name] || folder[item.name].url) folder[item.name] = {};
+
+      // empty folders need no listing at all
+      listing.set(folder[item.name], {
+        cursor: null,
+        done: item.children === 0,
+        children: item.children
+      });
+    } else {
+      folder[item.name] = {
+        id: item.id, size: item.size, url: item.url, type: item.type, thumb: item.thumb
+      };
+    }
+  });
+
+  state.cursor = page.next_cursor;
+  state.done = !page.next_cursor;
+}
+
 
 let pathStack = ["root"];
 let inTrash = false;
@@ -74,41 +139,66 @@ function setLight() {
 function getCurrentFolder() {
   let ref = data.root;
   for (let i = 1; i < pathStack.length; i++) {
+    // folders we jumped into without listing their parents
+    if (!ref[pathStack[i]]) ref[pathStack[i]] = {};
     ref = ref[pathStack[i]];
   }
   return ref;
 }
 
-function save() {
-  fetch("/api/drive", {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify(data)
-  });
+/* send edits as small ops against the version we loaded;
+   one request at a time so each one carries the latest version */
+let opsQueue = Promise.resolve();
+
+function sendOps(ops) {
+  opsQueue = opsQueue.then(async () => {
+    const res = await fetch("/api/drive/ops", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ base_version: driveVersion, ops: ops })
+    });
+
+    const result = await res.json();
+
+    if (res.ok) {
+      driveVersion = result.version;
+      return result;
+    }
+
+    // changed somewhere else (other tab, upload...) → take the server's copy
+    await loadDrive();
+
+    if (res.status === 409) {
+      showAlert("Your drive was changed in another window. It has been refreshed.", "Drive Updated");
+    } else {
+      showAlert("That change could not be saved.", "Error");
+    }
+  }).catch(err => console.error("Drive save failed", err));
+
+  return opsQueue;
 }
 
+function folderPath(name) {
+  return [...pathStack, name];
+}
 
-// to search files in recent section
 
-function findInDrive(name, current = data.root, path = []) {
+function samePath(a, b) {
+  return a.length === b.length && a.every((name, i) => name === b[i]);
+}
 
-  for (let key in current) {
 
-    const item = current[key];
+/* background jobs (folder delete / folder move) */
+async function waitForJob(jobId, interval = 1000) {
+  while (true) {
+    const res = await fetch(`/api/jobs/${jobId}`);
+    if (!res.ok) return null;
 
-    // if match get
-    if (key === name) {
-      return { item, path };
-    }
+    const job = await res.json();
+    if (job.state === "done" || job.state === "failed") return job;
 
-    // if folder the search inside
-    if (typeof item === "object" && !item.url) {
-      const result = findInDrive(name, item, [...path, key]);
-      if (result) return result;
-    }
+    await new Promise(resolve => setTimeout(resolve, interval));
   }
-
-  return null;
 }
 
 
@@ -128,78 +218,54 @@ function closeDeleteModal() {
 function confirmPermanentDelete() {
   if (!deleteTarget) return;
 
-  const item = data.trash[deleteTarget];
-
-  // CASE 1: file → delete by URL
-  if (item && item.url) {
-    fetch("/api/delete", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ url: item.url })
-    });
-  }
-
-  //  CASE 2: folder → delete by KEY
-  if (item && !item.url) {
-    // build folder path key
-    const folderKey = deleteTarget + "/";
-
-    fetch("/api/delete", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ key: folderKey })
-    });
+  if (deleteTarget === EMPTY_TRASH) {
+    emptyTrash();
+    closeDeleteModal();
+    return;
   }
 
-  // remove from trash UI + DB
+  // remove from trash UI + DB (the server deletes the objects after it)
   delete data.trash[deleteTarget];
 
-  save();
+  sendOps([{ op: "remove", path: ["trash", deleteTarget] }])
+    .then(result => result && result.job_id && waitForJob(result.job_id))
+    .then(() => refreshStorage());
   render();
   closeDeleteModal();
 }
 
-/*  url fix when rename each files  */
-function updateUrlsRecursively(folder, oldPath, newPath) {
+/* empty trash: the server hides everything at once and purges it in
+   the background, the drive is reloaded once that is done */
+const EMPTY_TRASH = {};
 
-  for (let key in folder) {
-
-    const item = folder[key];
+function askEmptyTrash() {
+  deleteTarget = EMPTY_TRASH;
+  openDeleteModal();
+}
 
-    // file
-    if (item.url) {
+async function emptyTrash() {
+  await opsQueue;
 
-      item.url = item.url.replace(oldPath, newPath);
-    }
-    // subfolder
-    else {
-      updateUrlsRecursively(item, oldPath, newPath);
-    }
+  const res = await fetch("/api/trash/empty", { method: "POST" });
+  if (!res.ok) {
+    showAlert("The trash could not be emptied.", "Error");
+    return;
   }
-}
-/* size calculation of folder  */
-function calculateFolderSize(folder) {
 
-    let total = 0;
-
-    for (let key in folder) {
+  data.trash = {};
+  listing.set(data.trash, { cursor: null, done: true });
+  render();
 
-        const item = folder[key];
+  const { job_id } = await res.json();
+  if (!job_id) return;
 
-        // file
-        if (item.url) {
-            total += Number(item.size) || 0;
-        }
-        // subfolder
-        else {
-            total += calculateFolderSize(item);
-        }
-    }
+  await waitForJob(job_id);
+  refreshStorage();
 
-    return total;
+  // the purge changed the drive version
+  await loadDrive();
 }
 
-
 /* SEARCH (mydrive + recent support)*/
 
 searchInput.addEventListener("input", () => {
@@ -223,113 +289,80 @@ searchInput.addEventListener("input", () => {
 });
 
 
+/* whole-drive search on the server, debounced; late answers to
+   older queries are dropped */
+let searchTimer = null;
+let searchSeq = 0;
+
 function searchFiles(query) {
 
+  clearTimeout(searchTimer);
+  searchSeq++;
+  view = null;
+
   if (!query) {
     render();
     return;
   }
 
   fileArea.innerHTML = "";
-  let total = 0;
-  const items = getCurrentFolder();
+  searchTimer = setTimeout(() => loadSearchPage(query, null, searchSeq), 200);
+}
+
+async function loadSearchPage(query, cursor, seq) {
 
-  for (let key in items) {
+  const params = new URLSearchParams({ q: query });
+  if (cursor) params.set("cursor", cursor);
 
-    if (!key.toLowerCase().includes(query)) continue;
+  const res = await fetch(`/api/search?${params}`);
+  if (!res.ok || seq !== searchSeq) return;
+
+  const { results, next_cursor } = await res.json();
+  if (seq !== searchSeq) return;
+
+  fileArea.querySelector(".search-more")?.remove();
+
+  results.forEach(item => {
 
     const card = document.createElement("div");
     card.className = "file-card";
-    const item = items[key];
-
-    // folder
-    if (typeof item === "object" && !item.url) {
-      card.innerHTML = `<div style="font-size:40px">📁</div><div>${key}</div>`;
-      card.onclick = () => openFolder(key);
-      card.oncontextmenu = (e) => openFileMenu(e, key, "folder", "");
+    const where = item.path.slice(1).join("/") || "My Drive";
+
+    // folder → open it where it lives
+    if (item.kind === "folder") {
+      fillCard(card, emojiIcon("📁"), item.name, where);
+      card.onclick = () => {
+        searchInput.value = "";
+        pathStack = [...item.path, item.name];
+        render();
+      };
     }
     // file
     else {
-      card.innerHTML = `<div style="font-size:40px">📄</div><div>${key}</div><small>${item.size} MB</small>`;
+      fillCard(card, emojiIcon("📄"), item.name, `${item.size} MB · ${where}`);
       card.onclick = () => openFile(item);
-      card.oncontextmenu = (e) => openFileMenu(e, key, "file", item.size);
-      total += Number(item.size);
     }
 
     fileArea.appendChild(card);
-  }
-
+  });
 
+  if (next_cursor) {
+    const more = document.createElement("div");
+    more.className = "file-card search-more";
+    more.innerHTML = `<div style="font-size:40px">⋯</div><div>More results</div>`;
+    more.onclick = () => loadSearchPage(query, next_cursor, seq);
+    fileArea.appendChild(more);
+  } else if (!fileArea.children.length) {
+    fileArea.innerHTML = "<div>No matching files or folders</div>";
+  }
 }
 
-function searchRecent(query) {
-
-  recentBody.innerHTML = "";
-
-  data.recent.forEach(item => {
-
-    if (!item.name.toLowerCase().includes(query)) return;
-
-    const row = document.createElement("tr");
-    row.className = "recent-row";
-
-    row.innerHTML = `
-      <td>
-        ${item.type === "folder" ? "📁" : "📄"}
-        <span class="recent-name">${item.name}</span>
-      </td>
-      <td>${item.time}</td>
-      <td>${item.owner}</td>
-      <td>${item.size ? item.size + " MB" : "-"}</td>
-    `;
-
-    /* left click (open file and folder) */
-    row.onclick = () => {
-
-      const result = findInDrive(item.name, data.root);
-
-      // if not exists anymore → alert only
-      if (!result) {
-        showAlert("This file or folder no longer exists in My Drive", "Not Found");
-        return;
-      }
-
-      // open normally
-      inRecent = false;
-      inTrash = false;
-      pathStack = ["root", ...result.path];
-      render();
-
-      if (result.item.url) {
-        openFile(result.item);
-      }
-    };
-
-
-    /* right click (SELECT + DELETE FROM RECENT ONLY) */
-    row.oncontextmenu = (e) => {
-      e.preventDefault();
-      e.stopPropagation();
-
-      // mark as coming from recent
-      selectedFile = {
-        name: item.name,
-        type: item.type,
-        size: item.size,
-        fromRecent: true
-      };
-
-      // hide rename / recover in recent
-      renameBtn.style.display = "none";
-      recoverBtn.style.display = "none";
-
-      fileMenu.style.display = "block";
-      fileMenu.style.left = e.pageX + "px";
-      fileMenu.style.top = e.pageY + "px";
-    };
+/* recent entries are filtered on the server, a page at a time */
+let recentTimer = null;
 
-    recentBody.appendChild(row);
-  });
+function searchRecent(query) {
+  clearTimeout(recentTimer);
+  recentTimer = setTimeout(() => loadRecent(query), 200);
 }
 
 
@@ -357,6 +390,12 @@ function renderPath() {
     span.className = "current";
     span.innerText = "Trash";
     pathTitle.appendChild(span);
+
+    const empty = document.createElement("button");
+    empty.className = "empty-trash";
+    empty.innerText = "Empty trash";
+    empty.onclick = askEmptyTrash;
+    pathTitle.appendChild(empty);
     return;
   }
 
@@ -439,7 +478,6 @@ function openTrash() {
   fileArea.style.display = "grid";
 
   render();
-  pathTitle.innerHTML = `<span class="current">Trash</span>`;
 }
 
 function openRecent() {
@@ -453,6 +491,7 @@ function openRecent() {
   recentTable.style.display = "table";
 
   renderRecent();
+  loadRecent(searchInput.value.trim());
   pathTitle.innerHTML = `<span class="current">Recent</span>`;
 }
 
@@ -469,18 +508,22 @@ function openFolder(name) {
 
 /* recent add */
 
-function addToRecent(name, type, size) {
+function addToRecent(name, type, size, path = folderPath(name)) {
   const now = new Date().toLocaleString();
 
-  data.recent.unshift({
+  const entry = {
     name,
     type,
     size,
+    path,
     time: now,
     owner: "me"
-  });
+  };
 
-  if (data.recent.length > 30) data.recent.pop();
+  // the server keeps (and trims) the real list
+  data.recent.unshift(entry);
+
+  return { op: "add", path: ["recent"], entry: entry };
 }
 
 
@@ -512,17 +555,17 @@ async function createFolder() {
 
     const result = await res.json();
 
-    // update frontend structure only after backend success
-    const current = getCurrentFolder();
-
-    if (current[name]) {
+    if (result.error === "exists") {
       showAlert("Folder already exists", "Already Exists");
       return;
     }
 
-    current[name] = {};          
-    addToRecent(name, "folder", "");
-    save();
+    if (!res.ok) throw new Error(result.error);
+
+    // the server made the folder, pick it up (and the new version)
+    await loadDrive();
+
+    sendOps([addToRecent(name, "folder", "")]);
     closeModal();
     render();
 
@@ -535,28 +578,218 @@ async function createFolder() {
 
 /*  file uploads */
 
+/* direct to S3: initiate -> browser uploads -> complete
+   (falls back to /api/upload when the server says "proxy") */
+const PART_UPLOADS_IN_FLIGHT = 4;
+
+async function uploadParts(file, ticket) {
+  const parts = [];
+  let next = 0;
+
+  async function worker() {
+    while (next < ticket.urls.length) {
+      const index = next++;
+      const start = index * ticket.part_size;
+      const blob = file.slice(start, start + ticket.part_size);
+
+      const res = await fetch(ticket.urls[index], { method: "PUT", body: blob });
+      if (!res.ok) throw new Error("part " + (index + 1) + " failed");
+
+      parts.push({ PartNumber: index + 1, ETag: res.headers.get("ETag") });
+    }
+  }
+
+  const workers = [];
+  for (let i = 0; i < PART_UPLOADS_IN_FLIGHT; i++) workers.push(worker());
+  await Promise.all(workers);
+
+  return parts;
+}
+
+/* content the drive already has isn't uploaded again: the server links
+   the file when it knows the hash (bigger files are hashed server side).
+   The file is read HASH_CHUNK at a time, so only one slice is in memory;
+   crypto.subtle only hashes whole buffers, hence the SHA-256 below */
+const HASH_MAX_BYTES = 128 * 1024 * 1024;
+const HASH_CHUNK = 4 * 1024 * 1024;
+
+const SHA256_K = new Uint32Array([
+  0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+  0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+  0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+  0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+  0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+  0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+  0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+  0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+]);
+
+function sha256Hasher() {
+  const h = new Uint32Array([
+    0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19
+  ]);
+  const w = new Uint32Array(64);
+  const block = new Uint8Array(64);
+  let filled = 0;
+  let length = 0;
+
+  const rotr = (x, n) => (x >>> n) | (x << (32 - n));
+
+  function compress(bytes, offset) {
+    for (let i = 0; i < 16; i++) {
+      const j = offset + i * 4;
+      w[i] = (bytes[j] << 24) | (bytes[j + 1] << 16) | (bytes[j + 2] << 8) | bytes[j + 3];
+    }
+    for (let i = 16; i < 64; i++) {
+      const s0 = rotr(w[i - 15], 7) ^ rotr(w[i - 15], 18) ^ (w[i - 15] >>> 3);
+      const s1 = rotr(w[i - 2], 17) ^ rotr(w[i - 2], 19) ^ (w[i - 2] >>> 10);
+      w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+    }
+
+    let [a, b, c, d, e, f, g, k] = h;
+
+    for (let i = 0; i < 64; i++) {
+      const t1 = (k + (rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)) + ((e & f) ^ (~e & g)) + SHA256_K[i] + w[i]) | 0;
+      const t2 = ((rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)) + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+      k = g; g = f; f = e; e = (d + t1) | 0;
+      d = c; c = b; b = a; a = (t1 + t2) | 0;
+    }
+
+    h[0] += a; h[1] += b; h[2] += c; h[3] += d;
+    h[4] += e; h[5] += f; h[6] += g; h[7] += k;
+  }
+
+  return {
+    update(bytes) {
+      let i = 0;
+      length += bytes.length;
+
+      if (filled) {
+        i = Math.min(64 - filled, bytes.length);
+        block.set(bytes.subarray(0, i), filled);
+        filled += i;
+        if (filled < 64) return;
+        compress(block, 0);
+        filled = 0;
+      }
+
+      for (; i + 64 <= bytes.length; i += 64) compress(bytes, i);
+
+      block.set(bytes.subarray(i), 0);
+      filled = bytes.length - i;
+    },
+
+    hex() {
+      const tail = new Uint8Array(filled < 56 ? 64 : 128);
+      tail.set(block.subarray(0, filled));
+      tail[filled] = 0x80;
+
+      const view = new DataView(tail.buffer);
+      view.setUint32(tail.length - 8, Math.floor(length / 0x20000000));
+      view.setUint32(tail.length - 4, (length * 8) >>> 0);
+
+      for (let i = 0; i < tail.length; i += 64) compress(tail, i);
+      return Array.from(h, x => x.toString(16).padStart(8, "0")).join("");
+    }
+  };
+}
+
+async function sha256Hex(file) {
+  if (file.size > HASH_MAX_BYTES) return null;
+
+  const hasher = sha256Hasher();
+
+  for (let offset = 0; offset < file.size; offset += HASH_CHUNK) {
+    const slice = file.slice(offset, offset + HASH_CHUNK);
+    hasher.update(new Uint8Array(await slice.arrayBuffer()));
+  }
+
+  return hasher.hex();
+}
+
+async function uploadToDrive(file, path) {
+
+  const init = await fetch("/api/upload/initiate", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({
+      name: file.name,
+      path: path,
+      size: file.size,
+      type: file.type,
+      sha256: await sha256Hex(file)
+    })
+  });
+
+  const ticket = await init.json();
+
+  if (!init.ok) return { ok: false, error: ticket.error };
+
+  // already stored, nothing to send
+  if (ticket.mode === "linked") return { ok: true, result: ticket };
+
+  // server can't presign → old way through Flask
+  if (ticket.mode === "proxy") {
+    // path first: the server reads the file as it arrives
+    const form = new FormData();
+    form.append("path", JSON.stringify(path));
+    form.append("file", file);
+
+    const res = await fetch("/api/upload", { method: "POST", body: form });
+    const result = await res.json();
+
+    return res.ok ? { ok: true, result } : { ok: false, error: result.error };
+  }
+
+  let parts = [];
+
+  try {
+    if (ticket.mode === "post") {
+      const form = new FormData();
+      for (const field in ticket.fields) form.append(field, ticket.fields[field]);
+      form.append("file", file);
+
+      const s3res = await fetch(ticket.url, { method: "POST", body: form });
+      if (!s3res.ok) throw new Error("S3 upload failed");
+    } else {
+      parts = await uploadParts(file, ticket);
+    }
+  } catch (err) {
+    console.error("Direct upload failed", err);
+
+    await fetch("/api/upload/abort", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ upload_id: ticket.upload_id })
+    });
+
+    return { ok: false, error: "UPLOAD_FAILED" };
+  }
+
+  const done = await fetch("/api/upload/complete", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ upload_id: ticket.upload_id, parts: parts })
+  });
+
+  const result = await done.json();
+
+  return done.ok ? { ok: true, result } : { ok: false, error: result.error };
+}
+
 async function uploadFile(input) {
   if (inTrash || inRecent) return;
 
   const file = input.files[0];
   if (!file) return;
 
-  const form = new FormData();
-  form.append("file", file);
-
   // send current folder path to backend
-  form.append("path", JSON.stringify(pathStack));
-
-  const res = await fetch("/api/upload", {
-    method: "POST",
-    body: form
-  });
+  const { ok, result, error } = await uploadToDrive(file, pathStack);
 
   // handle storage full and server errors
-  if (!res.ok) {
-    const err = await res.json();
+  if (!ok) {
 
-    if (err.error === "MINIDRIVE_STORAGE_FULL") {
+    if (error === "MINIDRIVE_STORAGE_FULL") {
       showAlert(
         "MiniDrive storage is full.\nOther users have already used all available space.",
         "Storage Limit Reached"
@@ -570,23 +803,57 @@ async function uploadFile(input) {
     return;
   }
 
-  const result = await res.json();
-
-  const current = getCurrentFolder();
-
-  current[result.name] = {
-    size: result.size,
-    url: result.url,
-    type: result.type
-  };
+  // the server already added the file node
+  await loadDrive();
 
-  addToRecent(result.name, "file", result.size);
-  save();
+  sendOps([addToRecent(result.name, "file", result.size)]);
   render();
   input.value = "";
 }
 
+/* thumbnails: 256px in the grid, 1024px when an image is opened (the
+   original stays one click away in the details panel) */
+function thumbUrl(item, size) {
+  return `${item.thumb}&size=${size}`;
+}
+
+function emojiIcon(emoji) {
+  const icon = document.createElement("div");
+  icon.style.fontSize = "40px";
+  icon.textContent = emoji;
+  return icon;
+}
+
+function fileIcon(item) {
+  if (!item.thumb) return emojiIcon("📄");
+
+  const img = document.createElement("img");
+  img.src = thumbUrl(item, 256);
+  img.alt = "";
+  img.loading = "lazy";
+  img.style.cssText = "width:100%;height:96px;object-fit:cover;border-radius:6px";
+  return img;
+}
+
+/* card contents built as nodes: names come from users, never parse them */
+function fillCard(card, icon, name, note) {
+  const label = document.createElement("div");
+  label.textContent = name;
+  card.replaceChildren(icon, label);
+
+  if (note) {
+    const small = document.createElement("small");
+    small.textContent = note;
+    card.appendChild(small);
+  }
+}
+
 function openFile(fileObj) {
+  if (fileObj.thumb) {
+    window.open(thumbUrl(fileObj, 1024), "_blank");
+    return;
+  }
+
   if (!fileObj.url) return;
   window.open(fileObj.url, "_blank");
 }
@@ -606,13 +873,16 @@ function openFilePicker() {
 
 
 /* File Menu*/
-function openFileMenu(e, name, type, size) {
+function openFileMenu(e, name, type, size, fromRecent = false, path = null) {
   e.preventDefault();
   e.stopPropagation();
 
-  selectedFile = { name, type, size };
+  selectedFile = { name, type, size, fromRecent, path };
 
-  if (inTrash) {
+  if (fromRecent) {
+    renameBtn.style.display = "none";
+    recoverBtn.style.display = "none";
+  } else if (inTrash) {
     renameBtn.style.display = "none";
     recoverBtn.style.display = "block";
   } else {
@@ -652,7 +922,7 @@ function recoverFile() {
   data.root[selectedFile.name] = data.trash[selectedFile.name];
   delete data.trash[selectedFile.name];
 
-  save();
+  sendOps([{ op: "move", from: ["trash", selectedFile.name], to: ["root", selectedFile.name] }]);
   render();
 }
 
@@ -662,11 +932,15 @@ function deleteFile() {
   // If delete from RECENT TAB → only clear from recent
   if (selectedFile && selectedFile.fromRecent) {
 
-    // remove only from recent list
-    data.recent = data.recent.filter(r => r.name !== selectedFile.name);
+    // remove only from recent list (by path when the entry has one)
+    const target = selectedFile.path || [selectedFile.name];
+
+    data.recent = data.recent.filter(r =>
+      selectedFile.path ? !(r.path && samePath(r.path, target)) : r.name !== selectedFile.name
+    );
 
     fileMenu.style.display = "none";
-    save();
+    sendOps([{ op: "remove", path: ["recent", ...target] }]);
     renderRecent();      
     return;
   }
@@ -688,7 +962,7 @@ function deleteFile() {
   delete current[selectedFile.name];
 
   fileMenu.style.display = "none";
-  save();
+  sendOps([{ op: "move", from: folderPath(selectedFile.name), to: ["trash", selectedFile.name] }]);
   render();
 }
 
@@ -717,32 +991,13 @@ async function confirmRename() {
     return;
   }
 
-  // UPDATE UI STRUCTURE 
-  current[newName] = current[oldName];
-  delete current[oldName];
-  
-  
-  //fix url after rename
-
-  if (selectedFile.type === "file" && current[newName].url) {
-    const parts = current[newName].url.split("/");
-    parts[parts.length - 1] = newName;
-    current[newName].url = parts.join("/");
-  }
-
-
-  // UPDATE RECENT
-  data.recent.forEach(item => {
-    if (item.name === oldName) item.name = newName;
-  });
-
-  //BUILD S3 KEYS
+  // paths relative to My Drive
   const basePath = pathStack.slice(1).join("/");
   const oldKey = basePath ? basePath + "/" + oldName : oldName;
   const newKey = basePath ? basePath + "/" + newName : newName;
 
-  // CALL BACKEND RENAME
-  await fetch("/api/rename", {
+  // CALL BACKEND RENAME (metadata only, nothing moves in S3)
+  const res = await fetch("/api/rename", {
     method: "POST",
     headers: { "Content-Type": "application/json" },
     body: JSON.stringify({
@@ -751,11 +1006,35 @@ async function confirmRename() {
       is_folder: selectedFile.type === "folder"
     })
   });
-  if (selectedFile.type === "file") {
-    save();   
+
+  // nothing was renamed: say why and show the folder as the server has it
+  if (!res.ok) {
+    const result = await res.json().catch(() => ({}));
+    closeRename();
+    await loadDrive();
+    showAlert(result.error || "Unable to rename. Please try again.", "Rename Failed");
+    return;
+  }
+
+  await loadDrive();
+
+  // UPDATE RECENT (the item itself and anything recent inside a renamed folder)
+  const oldPath = folderPath(oldName);
+  const newPath = folderPath(newName);
+  let touched = false;
+
+  data.recent.forEach(item => {
+    if (!item.path || !samePath(item.path.slice(0, oldPath.length), oldPath)) return;
+
+    if (item.path.length === oldPath.length) item.name = newName;
+    item.path = [...newPath, ...item.path.slice(oldPath.length)];
+    touched = true;
+  });
+
+  if (touched) {
+    sendOps([{ op: "set", path: ["recent", ...oldPath], attrs: { path: newPath } }]);
   }
 
-  await loadDrive();  
   render();
   closeRename();
 }
@@ -793,15 +1072,21 @@ function showDetails() {
   // folder
   else {
 
-      const folder = getCurrentFolder()[selectedFile.name];
+      // the folder may not be loaded, ask the server for the total
+      sizeText = "…";
+      const params = new URLSearchParams({ path: (inTrash ? ["trash", selectedFile.name] : folderPath(selectedFile.name)).join("/") });
 
-      const totalSize = calculateFolderSize(folder);
+      fetch(`/api/folder-size?${params}`)
+        .then(res => res.json())
+        .then(info => {
+          const totalSize = info.size || 0;
 
-      if (totalSize >= 1024) {
-          sizeText = (totalSize / 1024).toFixed(2) + " GB";
-      } else {
-          sizeText = totalSize.toFixed(2) + " MB";
-      }
+          document.getElementById("detailSize").innerText = "Size: " + (
+            totalSize >= 1024
+              ? (totalSize / 1024).toFixed(2) + " GB"
+              : totalSize.toFixed(2) + " MB"
+          );
+        });
   }
 
   document.getElementById("detailSize").innerText =
@@ -876,14 +1161,10 @@ function showDetails() {
         return;
     }
 
-    const key = decodeURIComponent(
-        file.url.split(".amazonaws.com/")[1]
-    );
-
     const res = await fetch("/api/share", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ key })
+        body: JSON.stringify({ id: file.id })
     });
 
     const result = await res.json();
@@ -933,8 +1214,31 @@ function showDetails() {
   }
   else {
 
-      // Folder → nO button
-      downloadSection.innerHTML = "";
+      // Folder → the whole subtree as one streamed ZIP
+      downloadSection.innerHTML = `
+          <button id="downloadBtn"
+            style="
+              width:100%;
+              margin-top:12px;
+              background:#2d6cdf;
+              color:white;
+              padding:10px;
+              border:none;
+              border-radius:8px;
+              font-weight:600;
+              cursor:pointer;">
+            Download as ZIP
+          </button>
+      `;
+
+      const path = selectedFile.path
+        || (inTrash ? ["trash", selectedFile.name] : folderPath(selectedFile.name));
+
+      document
+        .getElementById("downloadBtn")
+        .addEventListener("click", () => {
+            downloadZip([path]);
+        });
   }
 
   fileMenu.style.display = "none";
@@ -946,6 +1250,14 @@ function closeDetails() {
 detailsModal.style.display = "none";
 }
 
+/* folders (or several items): the server zips them on the fly */
+function downloadZip(paths) {
+  const params = new URLSearchParams();
+  paths.forEach(path => params.append("path", path.join("/")));
+
+  window.location.href = `/api/download-zip?${params}`;
+}
+
 async function downloadFile(fileName){
 
    try {
@@ -969,11 +1281,7 @@ async function downloadFile(fileName){
            return;
        }
 
-       const key = decodeURIComponent(
-           file.url.split(".amazonaws.com/")[1]
-       );
-
-       const res = await fetch(`/api/download?key=${encodeURIComponent(key)}`);
+       const res = await fetch(`/api/download?id=${file.id}`);
 
        if(!res.ok){
            showAlert(
@@ -1001,40 +1309,105 @@ async function downloadFile(fileName){
 
 /*  Render Drive */
 
+/* the folder on screen: its cards are drawn from `data` at once and
+   the rest is listed page by page as the sentinel scrolls into view */
+let view = null;
+
+const pageSentinel = document.createElement("div");
+
+new IntersectionObserver(entries => {
+  if (view && entries.some(e => e.isIntersecting)) loadNextPage(view);
+}).observe(pageSentinel);
+
 function render() {
   fileArea.innerHTML = "";
-  let total = 0;
 
   renderPath();
   recentTable.style.display = "none";
   fileArea.style.display = "grid";
 
-  const items = inTrash ? data.trash : getCurrentFolder();
+  const folder = inTrash ? data.trash : getCurrentFolder();
 
-  for (let key in items) {
-    const card = document.createElement("div");
-    card.className = "file-card";
-    const item = items[key];
+  view = {
+    folder,
+    path: inTrash ? ["trash"] : [...pathStack],
+    shown: new Set()
+  };
 
-    if (typeof item === "object" && !item.url) {
-      card.innerHTML = `<div style="font-size:40px">📁</div><div>${key}</div>`;
-      card.onclick = () => openFolder(key);
-      card.oncontextmenu = (e) => openFileMenu(e, key, "folder", "");
-    } else {
-      card.innerHTML = `<div style="font-size:40px">📄</div><div>${key}</div><small>${item.size} MB</small>`;
-      card.onclick = () => openFile(item);
-      card.oncontextmenu = (e) => openFileMenu(e, key, "file", item.size);
-      total += Number(item.size);
-    }
+  showNewItems(view);
+  loadNextPage(view);
+}
 
-    fileArea.appendChild(card);
+async function loadNextPage(v) {
+  await listMore(v.path, v.folder);
+
+  // the user may have moved on meanwhile
+  if (view !== v) return;
+
+  showNewItems(v);
+}
+
+function showNewItems(v) {
+  pageSentinel.remove();
+
+  for (let key in v.folder) {
+    if (v.shown.has(key)) continue;
+
+    v.shown.add(key);
+    fileArea.appendChild(fileCard(key, v.folder[key]));
   }
 
+  if (!listing.get(v.folder)?.done) fileArea.appendChild(pageSentinel);
+}
+
+function fileCard(key, item) {
+  const card = document.createElement("div");
+  card.className = "file-card";
+
+  if (typeof item === "object" && !item.url) {
+    const children = listing.get(item)?.children;
+    const count = children === undefined ? "" : `${children} items`;
 
+    fillCard(card, emojiIcon("📁"), key, count);
+    card.onclick = () => openFolder(key);
+    card.oncontextmenu = (e) => openFileMenu(e, key, "folder", "");
+  } else {
+    fillCard(card, fileIcon(item), key, `${item.size} MB`);
+    card.onclick = () => openFile(item);
+    card.oncontextmenu = (e) => openFileMenu(e, key, "file", item.size);
+  }
+
+  return card;
 }
 
 /* RENDER RECENT */
 
+let recentQuery = "";
+let recentCursor = null;
+let recentSeq = 0;
+
+async function loadRecent(query = "", more = false) {
+  const seq = ++recentSeq;
+
+  // entries added a moment ago have to reach the server first
+  await opsQueue;
+
+  const params = new URLSearchParams();
+  if (query) params.set("q", query);
+  if (more && recentCursor) params.set("cursor", recentCursor);
+
+  const res = await fetch(`/api/recent?${params}`);
+  if (!res.ok || seq !== recentSeq) return;
+
+  const page = await res.json();
+
+  data.recent = more ? [...data.recent, ...page.items] : page.items;
+  recentQuery = query;
+  recentCursor = page.next_cursor;
+
+  if (inRecent) renderRecent();
+}
+
 function renderRecent() {
   recentBody.innerHTML = "";
 
@@ -1043,48 +1416,67 @@ function renderRecent() {
     const row = document.createElement("tr");
     row.className = "recent-row";
 
-    row.innerHTML = `
-      <td>
-        ${item.type === "folder" ? "📁" : "📄"}
-        <span class="recent-name">${item.name}</span>
-      </td>
-      <td>${item.time}</td>
-      <td>${item.owner}</td>
-      <td>${item.size ? item.size + " MB" : "-"}</td>
-    `;
-
-    /* CLICK BEHAVIOR */
-    row.onclick = () => {
-
-      // Find file/folder in drive
-      const result = findInDrive(item.name, data.root);
-
-      // If not found → show alert only (DO NOT delete from recent)
-      if (!result) {
-        showAlert("This file or folder no longer exists in My Drive", "Not Found");
-        return;
-      }
+    const nameCell = document.createElement("td");
+    const name = document.createElement("span");
+    name.className = "recent-name";
+    name.textContent = item.name;
+    nameCell.append((item.type === "folder" ? "📁" : "📄") + " ", name);
 
-      // Open normally
-      inRecent = false;
-      inTrash = false;
-      pathStack = ["root", ...result.path];
-      render();
+    row.appendChild(nameCell);
 
-      // If file → open
-      if (result.item.url) {
-        openFile(result.item);
-      }
+    [item.time, item.owner, item.size ? item.size + " MB" : "-"].forEach(text => {
+      const cell = document.createElement("td");
+      cell.textContent = text;
+      row.appendChild(cell);
+    });
 
-      
-    };
+    /* CLICK BEHAVIOR */
+    row.onclick = () => openRecentItem(item);
 
     row.oncontextmenu = (e) => {
-      openFileMenu(e, item.name, item.type, item.size, true);
+      openFileMenu(e, item.name, item.type, item.size, true, item.path);
     };
 
   recentBody.appendChild(row);
   });
+
+  if (recentCursor) {
+    const more = document.createElement("tr");
+    more.className = "recent-row";
+    more.innerHTML = `<td colspan="4">Load more…</td>`;
+    more.onclick = () => loadRecent(recentQuery, true);
+    recentBody.appendChild(more);
+  }
+}
+
+/* open a recent entry: the server finds it by name, the path picks the
+   exact one (older entries without a path take the first match) */
+async function openRecentItem(item) {
+
+  const params = new URLSearchParams({ q: item.name });
+  const res = await fetch(`/api/search?${params}`);
+  const { results } = res.ok ? await res.json() : { results: [] };
+
+  const node = results.find(r =>
+    r.name === item.name && (!item.path || samePath([...r.path, r.name], item.path))
+  );
+
+  // If not found → show alert only (DO NOT delete from recent)
+  if (!node) {
+    showAlert("This file or folder no longer exists in My Drive", "Not Found");
+    return;
+  }
+
+  // Open normally
+  inRecent = false;
+  inTrash = false;
+  pathStack = node.path;
+  render();
+
+  // If file → open
+  if (node.url) {
+    openFile(node);
+  }
 }
 
 /* context menu hide*/
@@ -1126,88 +1518,100 @@ window.onpopstate = function (e) {
 };
 
 /*FOLDER UPLOAD TO S3  */
-async function uploadFolder(input) {
-  if (inTrash || inRecent) return;
 
-  const files = input.files;
-  if (!files || files.length === 0) return;
+// files go up in batches: one request + one metadata commit per batch
+const BATCH_MAX_FILES = 200;
+const BATCH_MAX_BYTES = 32 * 1024 * 1024;
 
-  // Extract root folder name
-  const rootFolder = files[0].webkitRelativePath.split("/")[0];
-  const current = getCurrentFolder();
+function splitBatches(files) {
+  const batches = [];
+  let batch = [];
+  let bytes = 0;
 
-  // Create root folder FIRST 
-  if (!current[rootFolder]) {
-    const res = await fetch("/api/create-folder", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({
-        name: rootFolder,
-        path: pathStack
-      })
-    });
+  for (let i = 0; i < files.length; i++) {
+    const file = files[i];
 
-    if (!res.ok) {
-      showAlert("Unable to create folder", "Upload Error");
-      return;
+    if (batch.length && (batch.length >= BATCH_MAX_FILES || bytes + file.size > BATCH_MAX_BYTES)) {
+      batches.push(batch);
+      batch = [];
+      bytes = 0;
     }
 
-    current[rootFolder] = {};
+    batch.push(file);
+    bytes += file.size;
   }
 
-  // Upload files
-  for (let i = 0; i < files.length; i++) {
-    const file = files[i];
+  if (batch.length) batches.push(batch);
+  return batches;
+}
+
+async function uploadFolder(input) {
+  if (inTrash || inRecent) return;
+
+  const files = input.files;
+  if (!files || files.length === 0) return;
 
-    const parts = file.webkitRelativePath.split("/");
-    const subFolders = parts.slice(1, -1); // exclude root + filename
+  let storageFull = false;
+  let failed = 0;
+  const uploaded = [];
 
-    const fullPath = [...pathStack, rootFolder, ...subFolders];
+  for (const batch of splitBatches(files)) {
 
     const form = new FormData();
-    form.append("file", file);
-    form.append("path", JSON.stringify(fullPath));
+    form.append("path", JSON.stringify(pathStack));
+
+    batch.forEach(file => {
+      form.append("files", file);
+      form.append("paths", file.webkitRelativePath);
+    });
 
-    const res = await fetch("/api/upload", {
+    const res = await fetch("/api/upload-batch", {
       method: "POST",
       body: form
     });
 
     if (!res.ok) {
-      const err = await res.json();
-
-      if (err.error === "MINIDRIVE_STORAGE_FULL") {
-        showAlert(
-          "MiniDrive storage is full.\nOther users have already used all available space.",
-          "Storage Limit Reached"
-        );
-        break;
-      }
-
-      showAlert("Folder upload failed", "Upload Error");
-      break;
+      failed += batch.length;
+      continue;
     }
 
-    const result = await res.json();
+    const { results } = await res.json();
 
-    // Build UI tree correctly
-    let ref = current[rootFolder];
-    for (let j = 0; j < subFolders.length; j++) {
-      if (!ref[subFolders[j]]) ref[subFolders[j]] = {};
-      ref = ref[subFolders[j]];
-    }
+    results.forEach(result => {
+      if (result.error) {
+        if (result.error === "MINIDRIVE_STORAGE_FULL") storageFull = true;
+        failed++;
+        return;
+      }
 
-    ref[result.name] = {
-      size: result.size,
-      url: result.url,
-      type: result.type
-    };
+      uploaded.push(result);
+    });
 
-    addToRecent(result.name, "file", result.size);
+    if (storageFull) break;
   }
 
-  save();
-  await loadDrive();   
+  if (storageFull) {
+    showAlert(
+      "MiniDrive storage is full.\nOther users have already used all available space.",
+      "Storage Limit Reached"
+    );
+  } else if (failed) {
+    showAlert(failed + " file(s) could not be uploaded", "Upload Error");
+  }
+
+  // server already has the files, reload before adding them to recent
+  await loadDrive();
+
+  const recentOps = uploaded
+    .slice(-30)
+    .map(result => {
+      const folders = result.path.split("/").filter(p => p && p !== "." && p !== "..");
+      const path = [...pathStack, ...folders.slice(0, -1), result.name];
+      return addToRecent(result.name, "file", result.size, path);
+    });
+
+  if (recentOps.length) sendOps(recentOps);
+
   render();
   input.value = "";
   await refreshStorage();
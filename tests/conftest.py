@@ -0,0 +1,106 @@
+"""Shared setup: the app on moto (in-process S3) and a temporary database.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the app opens database.db in the working directory: point it somewhere
+# empty. Its background threads stay off (no MINIDRIVE_BACKGROUND), tests
+# run jobs themselves with run_jobs()
+os.chdir(tempfile.mkdtemp(prefix="minidrive-test-"))
+os.environ.pop("MINIDRIVE_BACKGROUND", None)
+os.environ["AWS_ACCESS_KEY_ID"] = "test"
+os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+os.environ["AWS_DEFAULT_REGION"] = "ap-south-1"
+
+from moto import mock_aws
+
+mock_aws().start()
+
+sys.path.insert(0, ROOT)
+import app as minidrive
+
+minidrive.s3.create_bucket(
+    Bucket=minidrive.BUCKET_NAME,
+    CreateBucketConfiguration={"LocationConstraint": minidrive.REGION}
+)
+
+usernames = (f"user{n}" for n in itertools.count())
+
+
+@pytest.fixture(autouse=True)
+def no_leftover_jobs():
+    """Jobs a test queued but didn't run don't run in the next one."""
+
+    yield
+
+    db = minidrive.get_db()
+    db.execute("DELETE FROM jobs WHERE state IN ('queued', 'running')")
+    db.commit()
+    db.close()
+
+
+@pytest.fixture
+def md():
+    return minidrive
+
+
+@pytest.fixture
+def make_user():
+    """make_user(role="user") -> (username, logged in test client)."""
+
+    def make(role="user"):
+        username = next(usernames)
+
+        db = minidrive.get_db()
+        db.execute(
+            "INSERT INTO users (username, password, role) VALUES (?, 'x', ?)",
+            (username, role)
+        )
+        db.commit()
+        db.close()
+
+        client = minidrive.app.test_client()
+        with client.session_transaction() as sess:
+            sess["user"] = username
+            sess["role"] = role
+
+        return username, client
+
+    return make
+
+
+@pytest.fixture(params=["s3", "local"])
+def backend(request, monkeypatch, tmp_path):
+    """Run the test against S3 (moto) and against the local-disk backend."""
+
+    if request.param == "local":
+        monkeypatch.setattr(minidrive, "STORAGE_BACKEND", "local")
+        monkeypatch.setattr(minidrive, "s3", minidrive.S3Client(minidrive.LocalStorage(str(tmp_path))))
+
+    return request.param
+
+
+def run_jobs():
+    while minidrive.run_next_job("test"):
+        pass
+
+
+def upload(client, name, body, path=("root",), mime="text/plain"):
+    import io
+    import json
+
+    return client.post(
+        "/api/upload",
+        data={"file": (io.BytesIO(body), name, mime), "path": json.dumps(list(path))},
+        content_type="multipart/form-data"
+    )
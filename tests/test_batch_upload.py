@@ -0,0 +1,72 @@
+import io
+import json
+
+from conftest import run_jobs
+
+
+def ledger(md, username):
+    db = md.get_db()
+    row = db.execute(
+        "SELECT used_bytes, reserved_bytes FROM storage_usage WHERE username=?", (username,)
+    ).fetchone()
+    db.close()
+    return row
+
+
+def batch(client, files, path=("root",)):
+    return client.post(
+        "/api/upload-batch",
+        data={
+            "path": json.dumps(list(path)),
+            "files": [(io.BytesIO(body), rel.split("/")[-1], "text/plain") for rel, body in files],
+            "paths": [rel for rel, _ in files],
+        },
+        content_type="multipart/form-data"
+    )
+
+
+def test_batch_builds_the_folders(md, make_user, backend):
+    _, a = make_user()
+
+    resp = batch(a, [
+        ("photos/2024/a.txt", b"a on " + backend.encode()),
+        ("photos/b.txt", b"b on " + backend.encode()),
+    ])
+    assert resp.status_code == 200
+    assert all("error" not in r for r in resp.get_json()["results"])
+    run_jobs()
+
+    names = lambda path: sorted(i["name"] for i in a.get(f"/api/list?path={path}").get_json()["items"])
+    assert names("root/photos") == ["2024", "b.txt"]
+    assert names("root/photos/2024") == ["a.txt"]
+
+
+def test_batch_keeps_what_worked_when_some_files_fail(md, make_user, monkeypatch):
+    alice, a = make_user()
+    real = md.stream_to_s3
+
+    def flaky(stream, s3_key, content_type, on_part=None):
+        data = stream.read()
+        if data.startswith(b"bad"):
+            raise OSError("connection reset")
+        return real(io.BytesIO(data), s3_key, content_type, on_part)
+
+    monkeypatch.setattr(md, "stream_to_s3", flaky)
+
+    resp = batch(a, [
+        ("docs/good.txt", b"good batch bytes"),
+        ("docs/bad.txt", b"bad batch bytes"),
+        ("..", b"no name at all"),
+    ])
+    assert resp.status_code == 200
+
+    results = {r["path"]: r for r in resp.get_json()["results"]}
+    assert "error" not in results["docs/good.txt"]
+    assert results["docs/bad.txt"]["error"] == "S3 failed"
+    assert results[".."]["error"] == "invalid path"
+
+    items = a.get("/api/list?path=root/docs").get_json()["items"]
+    assert [i["name"] for i in items] == ["good.txt"]
+
+    # nothing stays reserved for the files that failed
+    assert ledger(md, alice)[1] == 0
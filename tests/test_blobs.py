@@ -0,0 +1,151 @@
+import hashlib
+
+from conftest import run_jobs, upload
+
+
+def blob_row(md, body):
+    db = md.get_db()
+    row = db.execute(
+        "SELECT refs, state, idle_since FROM blobs WHERE sha256=?",
+        (hashlib.sha256(body).hexdigest(),)
+    ).fetchone()
+    db.close()
+    return row
+
+
+def file_key(md, username, name):
+    db = md.get_db()
+    row = db.execute(
+        "SELECT s3_key FROM nodes WHERE owner=? AND name=? AND kind='file'", (username, name)
+    ).fetchone()
+    db.close()
+    return row[0]
+
+
+def read(md, key):
+    return md.s3.get_object(Bucket=md.BUCKET_NAME, Key=key)["Body"].read()
+
+
+def delete_file(md, username, name):
+    db = md.get_db()
+    db.execute("DELETE FROM nodes WHERE owner=? AND name=?", (username, name))
+    db.commit()
+    db.close()
+
+
+def stored_blob(md, make_user, body):
+    """A user whose a.txt is `body`, moved into the blob store."""
+
+    alice, a = make_user()
+    assert upload(a, "a.txt", body).status_code == 200
+    run_jobs()
+    assert md.is_blob_key(file_key(md, alice, "a.txt"))
+    return alice, a
+
+
+def test_refs_follow_the_nodes(md, make_user):
+    body = b"counted"
+    alice, a = stored_blob(md, make_user, body)
+    assert blob_row(md, body)[:2] == (1, "live")
+
+    bob, b = make_user()
+    upload(b, "b.txt", body)
+    assert blob_row(md, body)[0] == 2
+
+    delete_file(md, alice, "a.txt")
+    assert blob_row(md, body)[0] == 1
+
+    delete_file(md, bob, "b.txt")
+    refs, state, idle_since = blob_row(md, body)
+    assert refs == 0 and state == "live" and idle_since is not None
+
+
+def test_idle_blob_is_collected_after_the_grace_period(md, make_user):
+    body = b"collected"
+    alice, _ = stored_blob(md, make_user, body)
+    key = file_key(md, alice, "a.txt")
+    delete_file(md, alice, "a.txt")
+
+    # still within BLOB_GRACE
+    md.collect_blobs()
+    assert blob_row(md, body)[1] == "live"
+    assert read(md, key) == body
+
+    db = md.get_db()
+    db.execute(
+        "UPDATE blobs SET idle_since = datetime('now', '-2 hours') WHERE sha256=?",
+        (hashlib.sha256(body).hexdigest(),)
+    )
+    db.commit()
+    db.close()
+
+    assert md.collect_blobs() >= len(body)
+    assert blob_row(md, body) is None
+    assert md.get_object_size(key) == 0
+
+
+def test_stored_content_is_linked_without_an_upload(md, make_user):
+    body = b"linked directly"
+    alice, a = stored_blob(md, make_user, body)
+
+    resp = a.post("/api/upload/initiate", json={
+        "path": ["root"], "name": "again.txt", "size": len(body),
+        "sha256": hashlib.sha256(body).hexdigest()
+    })
+    assert resp.get_json()["mode"] == "linked"
+
+    assert file_key(md, alice, "again.txt") == file_key(md, alice, "a.txt")
+    assert blob_row(md, body)[0] == 2
+
+
+def test_absorb_leaves_an_object_replaced_while_it_was_hashed(md, make_user, monkeypatch):
+    alice, a = make_user()
+    key = md.new_object_key(alice)
+    md.s3.put_object(Bucket=md.BUCKET_NAME, Key=key, Body=b"old")
+
+    db = md.get_db()
+    root = md.get_drive_roots(db, alice)["root"]
+    md.put_file_node(db, alice, root, "a.txt", 3, "text/plain", key)
+    db.commit()
+    db.close()
+
+    copy = md.copy_s3_object
+
+    def copy_then_replace(*args, **kwargs):
+        copy(*args, **kwargs)
+        md.s3.put_object(Bucket=md.BUCKET_NAME, Key=key, Body=b"new")
+
+    monkeypatch.setattr(md, "copy_s3_object", copy_then_replace)
+    md.absorb_upload(alice, key)
+
+    assert file_key(md, alice, "a.txt") == key
+    assert read(md, key) == b"new"
+
+    # the copy made for nothing waits for the collector
+    refs, state, idle_since = blob_row(md, b"old")
+    assert refs == 0 and state == "live" and idle_since is not None
+
+
+def test_upload_racing_the_collector_keeps_its_bytes(md, make_user, monkeypatch):
+    body = b"raced"
+    alice, _ = stored_blob(md, make_user, body)
+    delete_file(md, alice, "a.txt")
+
+    # the collector marks the blob while the upload still saw it live
+    db = md.get_db()
+    db.execute(
+        "UPDATE blobs SET state='deleting' WHERE sha256=?", (hashlib.sha256(body).hexdigest(),)
+    )
+    db.commit()
+    db.close()
+    monkeypatch.setattr(md, "blob_state", lambda sha256: "live")
+
+    bob, b = make_user()
+    assert upload(b, "b.txt", body).status_code == 200
+
+    key = file_key(md, bob, "b.txt")
+    assert key.startswith(bob + "/")
+
+    md.collect_blobs()
+    assert blob_row(md, body) is None
+    assert read(md, key) == body
@@ -0,0 +1,16 @@
+def test_drive_etag_is_per_user(make_user):
+    alice, a = make_user()
+    bob, b = make_user()
+
+    # both drives are new: same version number
+    assert a.get("/api/drive?tree=0").get_json() == b.get("/api/drive?tree=0").get_json()
+
+    first = a.get("/api/drive")
+    assert first.status_code == 200
+
+    etag = first.headers["ETag"]
+    assert a.get("/api/drive", headers={"If-None-Match": etag}).status_code == 304
+
+    resp = b.get("/api/drive", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
@@ -0,0 +1,118 @@
+def version(client):
+    return client.get("/api/drive?tree=0").get_json()["version"]
+
+
+def test_add_file_op_takes_either_backends_url(md, make_user, backend):
+    alice, a = make_user()
+    url = md.s3_url(f"{alice}/{'0' * 32}")
+
+    resp = a.post("/api/drive/ops", json={
+        "base_version": version(a),
+        "ops": [{"op": "add", "path": ["root", "a.txt"], "kind": "file",
+                 "url": url, "size": 1, "type": "text/plain"}]
+    })
+    assert resp.status_code == 200, resp.get_json()
+
+    items = a.get("/api/list?path=root").get_json()["items"]
+    assert [(i["name"], i["url"]) for i in items] == [("a.txt", url)]
+
+
+def test_add_file_op_refuses_other_users_objects(md, make_user, backend):
+    alice, a = make_user()
+    bob, _ = make_user()
+
+    for url in (md.s3_url(f"{bob}/{'0' * 32}"), "https://example.com/x"):
+        resp = a.post("/api/drive/ops", json={
+            "base_version": version(a),
+            "ops": [{"op": "add", "path": ["root", "a.txt"], "kind": "file", "url": url}]
+        })
+        assert resp.status_code == 400
+
+
+def test_delete_unlinked_object(md, make_user, backend):
+    alice, a = make_user()
+    key = f"{alice}/{'1' * 32}"
+    md.s3.put_object(Bucket=md.BUCKET_NAME, Key=key, Body=b"abc")
+
+    resp = a.post("/api/delete", json={"url": md.s3_url(key)})
+    assert resp.status_code == 200
+
+    assert md.get_object_size(key) == 0
+
+
+def test_recent_ops_ignore_the_drive_version(make_user):
+    _, a = make_user()
+    stale = version(a) - 1
+
+    resp = a.post("/api/drive/ops", json={
+        "base_version": stale,
+        "ops": [{"op": "add", "path": ["recent"], "entry": {"name": "a.txt"}}]
+    })
+    assert resp.status_code == 200, resp.get_json()
+
+    resp = a.post("/api/drive/ops", json={
+        "base_version": stale,
+        "ops": [{"op": "add", "path": ["recent"], "entry": {"name": "a.txt"}},
+                {"op": "add", "path": ["root", "docs"], "kind": "folder"}]
+    })
+    assert resp.status_code == 409
+
+
+def test_absorbing_an_upload_keeps_the_version(md, make_user):
+    alice, a = make_user()
+    key = f"{alice}/{'2' * 32}"
+    md.s3.put_object(Bucket=md.BUCKET_NAME, Key=key, Body=b"abc")
+
+    # as finishing a direct upload leaves it
+    db = md.get_db()
+    root = md.get_drive_roots(db, alice)["root"]
+    md.put_file_node(db, alice, root, "a.txt", 3, "text/plain", key)
+    db.commit()
+    db.close()
+
+    before = version(a)
+    etag = a.get("/api/drive").headers["ETag"]
+
+    md.absorb_upload(alice, key)
+
+    items = a.get("/api/list?path=root").get_json()["items"]
+    assert items[0]["url"] != md.s3_url(key)
+
+    # same tree, new url: edits based on the old version still apply,
+    # cached copies of the tree don't
+    assert version(a) == before
+    assert a.get("/api/drive", headers={"If-None-Match": etag}).status_code == 200
+
+
+def node_size(md, username, name):
+    db = md.get_db()
+    size = db.execute(
+        "SELECT size FROM nodes WHERE owner=? AND name=?", (username, name)
+    ).fetchone()[0]
+    db.close()
+    return size
+
+
+def test_linked_files_get_their_stored_size(md, make_user, backend):
+    alice, a = make_user()
+    key = f"{alice}/{'3' * 32}"
+    md.s3.put_object(Bucket=md.BUCKET_NAME, Key=key, Body=b"abc")
+    url = md.s3_url(key)
+
+    # the posted size (in MB) is ignored, by the ops and by a whole-tree save
+    resp = a.post("/api/drive/ops", json={
+        "base_version": version(a),
+        "ops": [{"op": "add", "path": ["root", "a.txt"], "kind": "file",
+                 "url": url, "size": 1000, "type": "text/plain"}]
+    })
+    assert resp.status_code == 200
+    assert node_size(md, alice, "a.txt") == 3
+
+    tree = {"root": {
+        "a.txt": {"url": url, "size": 2000, "type": "text/plain"},
+        "b.txt": {"url": url, "size": 3000, "type": "text/plain"},
+    }, "trash": {}}
+    assert a.post("/api/drive", json=tree).status_code == 200
+
+    assert node_size(md, alice, "a.txt") == 3
+    assert node_size(md, alice, "b.txt") == 3
@@ -0,0 +1,74 @@
+import threading
+import time
+
+from conftest import run_jobs
+
+
+def job_row(md, job_id):
+    db = md.get_db()
+    row = db.execute(
+        "SELECT state, attempts, locked_at, error FROM jobs WHERE id=?", (job_id,)
+    ).fetchone()
+    db.close()
+    return row
+
+
+def test_running_job_keeps_its_lease(md, monkeypatch):
+    monkeypatch.setattr(md, "JOB_HEARTBEAT", 0.02)
+    seen = []
+
+    def slow(payload, progress):
+        # never reports progress
+        started = time.time()
+        time.sleep(0.2)
+        seen.append(job_row(md, job_id)[2] - started)
+        return {}
+
+    monkeypatch.setitem(md.JOB_HANDLERS, "slow", slow)
+    job_id = md.enqueue_job("slow", {})
+
+    run_jobs()
+
+    assert job_row(md, job_id)[0] == "done"
+    assert seen[0] > 0.1
+
+
+def test_lost_job_is_not_rerun_past_max_attempts(md, monkeypatch):
+    calls = []
+    monkeypatch.setitem(md.JOB_HANDLERS, "once", lambda payload, progress: calls.append(1))
+
+    job_id = md.enqueue_job("once", {}, max_attempts=2)
+
+    # a worker that died during its second attempt
+    db = md.get_db()
+    db.execute(
+        "UPDATE jobs SET state='running', attempts=2, locked_by='gone', locked_at=? WHERE id=?",
+        (time.time() - md.JOB_LEASE - 1, job_id)
+    )
+    db.commit()
+    db.close()
+
+    run_jobs()
+
+    state, attempts, _, error = job_row(md, job_id)
+    assert (state, attempts, error) == ("failed", 2, "worker lost")
+    assert calls == []
+
+
+def test_import_starts_no_threads(md):
+    names = {t.name for t in threading.enumerate()}
+    assert not any(n.startswith(("job-worker", "storage-reconcile", "trash-purge")) for n in names)
+
+
+def test_migrations_run_once(md, monkeypatch):
+    calls = []
+    monkeypatch.setattr(md, "MIGRATIONS", (("test_once", lambda: calls.append(1)),))
+
+    md.run_migrations()
+    md.run_migrations()
+    assert calls == [1]
+
+    db = md.get_db()
+    names = {r[0] for r in db.execute("SELECT name FROM migrations").fetchall()}
+    db.close()
+    assert {"drive_blobs", "recent_lists", "test_once"} <= names
@@ -0,0 +1,62 @@
+from conftest import upload
+
+
+def list_all(client, path="root", sort="name", limit=2):
+    """Every page of a folder; returns (names, number of pages)."""
+
+    names, pages, cursor = [], 0, None
+
+    while True:
+        params = {"path": path, "sort": sort, "limit": limit}
+        if cursor:
+            params["cursor"] = cursor
+        page = client.get("/api/list", query_string=params).get_json()
+
+        names += [i["name"] for i in page["items"]]
+        pages += 1
+        cursor = page["next_cursor"]
+        if not cursor:
+            return names, pages
+
+
+def test_pages_list_folders_then_files(make_user):
+    _, a = make_user()
+    for name in ("b-dir", "A-dir"):
+        a.post("/api/create-folder", json={"name": name, "path": ["root"]})
+    for name, body in (("c.txt", b"12345"), ("a.txt", b"1"), ("B.txt", b"123")):
+        upload(a, name, body)
+
+    assert list_all(a) == (["A-dir", "b-dir", "a.txt", "B.txt", "c.txt"], 3)
+
+    # folders have no size, they keep their name order
+    names, _ = list_all(a, sort="size")
+    assert names == ["A-dir", "b-dir", "c.txt", "B.txt", "a.txt"]
+
+
+def test_rows_added_meanwhile_do_not_shift_later_pages(make_user):
+    _, a = make_user()
+    for name in ("b.txt", "d.txt", "f.txt"):
+        upload(a, name, b"x" + name.encode())
+
+    first = a.get("/api/list", query_string={"path": "root", "limit": 2}).get_json()
+    assert [i["name"] for i in first["items"]] == ["b.txt", "d.txt"]
+
+    upload(a, "a.txt", b"early")
+    upload(a, "e.txt", b"late")
+
+    rest = a.get("/api/list", query_string={
+        "path": "root", "limit": 2, "cursor": first["next_cursor"]
+    }).get_json()
+    assert [i["name"] for i in rest["items"]] == ["e.txt", "f.txt"]
+
+
+def test_cursor_must_match_the_sort(make_user):
+    _, a = make_user()
+    upload(a, "a.txt", b"a")
+    upload(a, "b.txt", b"b")
+
+    cursor = a.get("/api/list?path=root&limit=1").get_json()["next_cursor"]
+
+    for params in ({"sort": "size", "cursor": cursor}, {"cursor": "not a cursor"}):
+        resp = a.get("/api/list", query_string={"path": "root", **params})
+        assert resp.status_code == 400
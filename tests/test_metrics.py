@@ -0,0 +1,55 @@
+from conftest import upload
+
+
+def scrape(client, **kwargs):
+    resp = client.get("/metrics", **kwargs)
+    assert resp.status_code == 200
+    assert resp.content_type == "text/plain; version=0.0.4; charset=utf-8"
+
+    samples = {}
+    for line in resp.get_data(as_text=True).splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+
+    return resp.get_data(as_text=True), samples
+
+
+def test_metrics_are_admin_or_token_only(md, make_user, monkeypatch):
+    _, user = make_user()
+    assert user.get("/metrics").status_code == 403
+
+    anonymous = md.app.test_client()
+    monkeypatch.setattr(md, "METRICS_TOKEN", "secret")
+    # a wrong token is just a visitor without a session
+    assert anonymous.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 302
+    scrape(anonymous, headers={"Authorization": "Bearer secret"})
+
+
+def test_metrics_cover_requests_s3_and_the_ledger(md, make_user):
+    _, admin = make_user("admin")
+    upload(admin, "a.txt", b"metrics")
+    admin.get("/api/list?path=root")
+
+    text, samples = scrape(admin)
+
+    assert "# TYPE minidrive_http_request_duration_seconds histogram" in text
+
+    # buckets are cumulative, +Inf is the count
+    labels = 'endpoint="list_folder",method="GET",status="200"'
+    buckets = [
+        value for name, value in samples.items()
+        if name.startswith("minidrive_http_request_duration_seconds_bucket{" + labels)
+    ]
+    assert buckets == sorted(buckets) and len(buckets) == len(md.LATENCY_BUCKETS) + 1
+    assert buckets[-1] == samples["minidrive_http_request_duration_seconds_count{" + labels + "}"]
+
+    assert samples['minidrive_s3_requests_total{operation="put_object"}'] >= 1
+    assert samples['minidrive_s3_bytes_total{operation="put_object"}'] >= len(b"metrics")
+    assert 'minidrive_storage_bytes{kind="used"}' in samples
+    assert samples["minidrive_http_requests_in_flight"] == 1     # the scrape itself
+    assert any(name.startswith("minidrive_db_queries_total{") for name in samples)
+
+
+def test_label_values_are_escaped(md):
+    assert md.metric_labels(("path",), ('a"b\\c\nd',)) == '{path="a\\"b\\\\c\\nd"}'
@@ -0,0 +1,40 @@
+def add_recent(client, *entries):
+    base = client.get("/api/drive?tree=0").get_json()["version"]
+    resp = client.post("/api/drive/ops", json={
+        "base_version": base,
+        "ops": [{"op": "add", "path": ["recent"], "entry": e} for e in entries]
+    })
+    assert resp.status_code == 200, resp.get_json()
+
+
+def recent(client, **params):
+    page = client.get("/api/recent", query_string=params).get_json()
+    return [i["name"] for i in page["items"]], page["next_cursor"]
+
+
+def test_recent_keeps_the_newest_entries(md, make_user, monkeypatch):
+    monkeypatch.setattr(md, "RECENT_LIMIT", 5)
+    _, a = make_user()
+
+    add_recent(a, *({"name": f"file-{n}.txt"} for n in range(8)))
+
+    names, cursor = recent(a)
+    assert names == [f"file-{n}.txt" for n in (7, 6, 5, 4, 3)]
+    assert cursor is None
+
+
+def test_recent_pages_and_filters(make_user):
+    _, a = make_user()
+    add_recent(
+        a,
+        {"name": "a.txt"}, {"name": "docs", "type": "folder"},
+        {"name": "b.txt"}, {"name": "c.pdf"}
+    )
+
+    first, cursor = recent(a, limit=3)
+    assert first == ["c.pdf", "b.txt", "docs"]
+    assert recent(a, limit=3, cursor=cursor) == (["a.txt"], None)
+
+    assert recent(a, type="folder")[0] == ["docs"]
+    assert recent(a, q=".txt")[0] == ["b.txt", "a.txt"]
+    assert a.get("/api/recent?cursor=x").status_code == 400
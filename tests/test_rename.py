@@ -0,0 +1,49 @@
+def add_folders(client, *paths):
+    base = client.get("/api/drive?tree=0").get_json()["version"]
+    resp = client.post("/api/drive/ops", json={
+        "base_version": base,
+        "ops": [{"op": "add", "path": ["root", *p.split("/")], "kind": "folder"}
+                for p in paths]
+    })
+    assert resp.status_code == 200, resp.get_json()
+
+
+def names(client, path="root"):
+    items = client.get(f"/api/list?path={path}").get_json()["items"]
+    return sorted(i["name"] for i in items)
+
+
+def test_rename_refuses_moving_a_folder_into_itself(make_user):
+    _, a = make_user()
+    add_folders(a, "a", "a/b")
+
+    for new_key in ("a/a2", "a/b/a2"):
+        resp = a.post("/api/rename", json={"old_key": "a/", "new_key": new_key + "/"})
+        assert resp.status_code == 400
+
+    assert names(a) == ["a"]
+    assert names(a, "root/a") == ["b"]
+
+
+def test_rename_into_missing_folder_creates_nothing(make_user):
+    _, a = make_user()
+    add_folders(a, "a")
+
+    resp = a.post("/api/rename", json={"old_key": "a", "new_key": "x/y/a"})
+    assert resp.status_code == 400
+
+    resp = a.post("/api/rename", json={"old_key": "nope", "new_key": "a/nope"})
+    assert resp.status_code == 404
+
+    assert names(a) == ["a"]
+
+
+def test_rename_moves_between_folders(make_user):
+    _, a = make_user()
+    add_folders(a, "a", "b")
+
+    resp = a.post("/api/rename", json={"old_key": "a/", "new_key": "b/a/"})
+    assert resp.status_code == 200
+
+    assert names(a) == ["b"]
+    assert names(a, "root/b") == ["a"]
@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+
+
+class SlowClient:
+    """The moto client, with some operations held until `release` is set
+    (or for good)."""
+
+    def __init__(self, client, slow):
+        self.client = client
+        self.exceptions = client.exceptions
+        self.slow = slow
+        self.release = threading.Event()
+
+    def __getattr__(self, operation):
+        call = getattr(self.client, operation)
+
+        if operation not in self.slow:
+            return call
+
+        def held(**kwargs):
+            self.release.wait(5)
+            return call(**kwargs)
+
+        return held
+
+
+@pytest.fixture
+def slow_s3(md, monkeypatch):
+    """slow_s3(*operations, in_flight=4) -> the SlowClient now behind md.s3,
+    with 0.2 s deadlines."""
+
+    made = []
+
+    def make(*slow, in_flight=4):
+        monkeypatch.setattr(md, "S3_DEADLINE", 0.2)
+        monkeypatch.setattr(md, "S3_SLOW_DEADLINE", 0.2)
+        monkeypatch.setattr(md, "S3_MAX_IN_FLIGHT", in_flight)
+
+        client = SlowClient(md.s3.client, set(slow))
+        monkeypatch.setattr(md, "s3", md.S3Client(client))
+        made.append(client)
+        return client
+
+    yield make
+
+    for client in made:
+        client.release.set()
+
+
+def test_call_past_its_deadline_is_a_503(md, make_user, slow_s3):
+    alice, a = make_user()
+    slow_s3("head_object")
+
+    started = time.perf_counter()
+    resp = a.post("/api/delete", json={"url": md.s3_url(f"{alice}/{'4' * 32}")})
+
+    assert resp.status_code == 503
+    assert time.perf_counter() - started < 2
+    assert md.s3.stats()["timeouts"] == 1
+
+
+def test_calls_past_the_in_flight_limit_fail_fast(md, slow_s3):
+    client = slow_s3("head_object", in_flight=1)
+
+    # one call holds the only slot
+    held = md.s3.submit("head_object", Bucket=md.BUCKET_NAME, Key="nothing")
+
+    with pytest.raises(md.S3Unavailable):
+        md.s3.list_objects_v2(Bucket=md.BUCKET_NAME, MaxKeys=1)
+
+    client.release.set()
+    with pytest.raises(md.s3.exceptions.ClientError):
+        md.s3.result(held)
+
+    # and the slot is free again
+    assert md.s3.list_objects_v2(Bucket=md.BUCKET_NAME, MaxKeys=1)["ResponseMetadata"]
+    assert md.s3.stats()["in_flight"] == 0
@@ -0,0 +1,79 @@
+from conftest import upload
+
+
+def search(client, q, **params):
+    resp = client.get("/api/search", query_string={"q": q, **params})
+    assert resp.status_code == 200, resp.get_json()
+    return [("/".join(r["path"]), r["name"]) for r in resp.get_json()["results"]]
+
+
+def test_renamed_folder_moves_its_contents_paths(make_user):
+    _, a = make_user()
+    a.post("/api/create-folder", json={"name": "projects", "path": ["root"]})
+    a.post("/api/create-folder", json={"name": "2024", "path": ["root", "projects"]})
+    upload(a, "notes.txt", b"x", path=("root", "projects", "2024"))
+
+    # name hit first, then what is inside the folder
+    assert search(a, "projects") == [
+        ("root", "projects"), ("root/projects", "2024"), ("root/projects/2024", "notes.txt")
+    ]
+
+    resp = a.post("/api/rename", json={"old_key": "projects/", "new_key": "archive/"})
+    assert resp.status_code == 200
+
+    assert search(a, "projects") == []
+    assert search(a, "notes") == [("root/archive/2024", "notes.txt")]
+    assert search(a, "archive")[-1] == ("root/archive/2024", "notes.txt")
+
+
+def test_search_stays_in_its_area(make_user):
+    _, a = make_user()
+    upload(a, "kept.txt", b"x")
+    upload(a, "gone.txt", b"x")
+
+    base = a.get("/api/drive?tree=0").get_json()["version"]
+    a.post("/api/drive/ops", json={"base_version": base, "ops": [
+        {"op": "move", "from": ["root", "gone.txt"], "to": ["trash", "gone.txt"]}
+    ]})
+
+    assert search(a, "txt") == [("root", "kept.txt")]
+    assert search(a, "txt", area="trash") == [("trash", "gone.txt")]
+
+
+def test_name_hits_rank_above_type_hits(make_user):
+    _, a = make_user()
+    upload(a, "notes.txt", b"x", mime="image/png")
+    upload(a, "photo.png", b"y", mime="image/png")
+    upload(a, "image-list.txt", b"z")
+
+    # "image" is in one name and in two mime types
+    assert search(a, "image")[0] == ("root", "image-list.txt")
+    assert sorted(search(a, "image")[1:]) == [("root", "notes.txt"), ("root", "photo.png")]
+
+    assert sorted(search(a, "image", type="image")) == [("root", "notes.txt"), ("root", "photo.png")]
+    assert search(a, "no", type="folder") == []
+
+
+def test_search_pages_with_its_cursor(make_user):
+    _, a = make_user()
+    for n in range(7):
+        upload(a, f"report-{n}.txt", f"report {n}".encode())
+
+    seen, cursor = [], None
+    while True:
+        params = {"q": "report", "limit": 3}
+        if cursor:
+            params["cursor"] = cursor
+        page = a.get("/api/search", query_string=params).get_json()
+
+        assert len(page["results"]) <= 3
+        seen += [r["name"] for r in page["results"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+
+    assert sorted(seen) == [f"report-{n}.txt" for n in range(7)]
+    assert len(seen) == len(set(seen))
+
+    bad = a.get("/api/search", query_string={"q": "report", "cursor": "x"})
+    assert bad.status_code == 400
@@ -0,0 +1,26 @@
+def change_user(md, username, sql):
+    # as another worker process would: straight in the database, no
+    # invalidate_user_session() in this one
+    db = md.get_db()
+    db.execute(sql, (username,))
+    db.commit()
+    db.close()
+
+
+def test_deleted_user_is_logged_out_at_once(md, make_user):
+    alice, a = make_user()
+    assert a.get("/api/drive?tree=0").status_code == 200
+
+    change_user(md, alice, "DELETE FROM users WHERE username=?")
+
+    resp = a.get("/api/drive?tree=0")
+    assert resp.status_code == 302
+
+
+def test_role_change_applies_at_once(md, make_user):
+    alice, a = make_user(role="admin")
+    assert a.get("/admin").status_code == 200
+
+    change_user(md, alice, "UPDATE users SET role='user' WHERE username=?")
+
+    assert a.get("/admin").status_code != 200
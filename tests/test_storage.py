@@ -0,0 +1,38 @@
+def ledger(md, username):
+    db = md.get_db()
+    row = db.execute(
+        "SELECT used_bytes, reserved_bytes FROM storage_usage WHERE username=?", (username,)
+    ).fetchone()
+    db.close()
+    return row
+
+
+def test_reconcile_leaves_uploads_in_progress_alone(md, make_user):
+    alice, _ = make_user()
+
+    # an upload of 100 bytes, half of it in the bucket already
+    assert md.reserve_storage(alice, 100)
+    md.s3.put_object(Bucket=md.BUCKET_NAME, Key=md.new_object_key(alice), Body=b"x" * 50)
+
+    md.reconcile_storage()
+    assert ledger(md, alice) == (0, 100)
+
+    # it finishes at 50 bytes, charged once
+    md.commit_storage(alice, 100, 50)
+    md.reconcile_storage()
+    assert ledger(md, alice) == (50, 0)
+
+
+def test_reconcile_corrects_what_reservations_cannot_explain(md, make_user):
+    alice, _ = make_user()
+
+    assert md.reserve_storage(alice, 10)
+    md.s3.put_object(Bucket=md.BUCKET_NAME, Key=md.new_object_key(alice), Body=b"x" * 50)
+
+    # at least 40 of the 50 bytes are settled files
+    md.reconcile_storage()
+    assert ledger(md, alice) == (40, 10)
+
+    md.release_storage(alice, 10)
+    md.reconcile_storage()
+    assert ledger(md, alice) == (50, 0)
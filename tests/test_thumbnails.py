@@ -0,0 +1,72 @@
+import io
+
+from PIL import Image
+
+from conftest import run_jobs, upload
+
+
+def png(width, height, color):
+    out = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(out, "PNG")
+    return out.getvalue()
+
+
+def listed(client, name):
+    items = client.get("/api/list?path=root").get_json()["items"]
+    return next(i for i in items if i["name"] == name)
+
+
+def thumb_state(md, client, name):
+    db = md.get_db()
+    row = db.execute(
+        "SELECT t.state FROM thumbs t JOIN nodes n ON n.s3_key = t.s3_key WHERE n.id=?",
+        (listed(client, name)["id"],)
+    ).fetchone()
+    db.close()
+    return row[0]
+
+
+def test_image_gets_its_thumbnails(md, make_user, backend):
+    _, a = make_user()
+    upload(a, "photo.png", png(1600, 1200, (200, 10, 10 if backend == "s3" else 11)), mime="image/png")
+    run_jobs()
+
+    item = listed(a, "photo.png")
+    assert "thumb" in item
+
+    for size, box in ((256, (256, 192)), (1024, (1024, 768))):
+        resp = a.get(item["thumb"] + f"&size={size}")
+        assert resp.status_code == 200 and resp.mimetype == "image/webp"
+        assert Image.open(io.BytesIO(resp.data)).size == box
+
+
+def test_oversized_images_are_not_decoded(md, make_user, monkeypatch):
+    alice, a = make_user()
+
+    # past the pixel limit: refused from the header
+    assert md.Image.MAX_IMAGE_PIXELS == md.THUMB_MAX_PIXELS
+    monkeypatch.setattr(md.Image, "MAX_IMAGE_PIXELS", 100)
+    upload(a, "wide.png", png(40, 40, (1, 2, 3)), mime="image/png")
+    run_jobs()
+
+    assert thumb_state(md, a, "wide.png") == "failed"
+
+    # past the byte limit when the job gets to it: not even read
+    body = png(30, 30, (4, 5, 6))
+    upload(a, "heavy.png", body, mime="application/octet-stream")
+    run_jobs()
+
+    db = md.get_db()
+    key = db.execute(
+        "SELECT s3_key FROM nodes WHERE owner=? AND name='heavy.png'", (alice,)
+    ).fetchone()[0]
+    db.close()
+
+    md.queue_thumbnails([(key, "image/png", len(body))])
+    monkeypatch.setattr(md, "THUMB_MAX_BYTES", len(body) - 1)
+    rendered = []
+    monkeypatch.setattr(md, "render_thumbnails", rendered.append)
+
+    assert md.make_thumbnails(key) == 0
+    assert thumb_state(md, a, "heavy.png") == "failed"
+    assert rendered == []
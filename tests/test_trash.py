@@ -0,0 +1,71 @@
+import io
+import zipfile
+
+from conftest import upload
+
+
+def trash(client, *names):
+    base = client.get("/api/drive?tree=0").get_json()["version"]
+    resp = client.post("/api/drive/ops", json={
+        "base_version": base,
+        "ops": [{"op": "move", "from": ["root", n], "to": ["trash", n]} for n in names]
+    })
+    assert resp.status_code == 200, resp.get_json()
+
+
+def search(client, q):
+    resp = client.get("/api/search", query_string={"q": q, "area": "trash"})
+    return sorted(r["name"] for r in resp.get_json()["results"])
+
+
+def zip_names(resp):
+    return sorted(zipfile.ZipFile(io.BytesIO(resp.data)).namelist())
+
+
+def test_expired_trash_is_not_searched_or_zipped(md, make_user):
+    alice, a = make_user()
+    a.post("/api/create-folder", json={"name": "old", "path": ["root"]})
+    upload(a, "report-a.txt", b"a", path=("root", "old"))
+    upload(a, "report-b.txt", b"b")
+    trash(a, "old")
+
+    # "old" is past its TTL (not purged yet), report-b.txt is trashed now
+    db = md.get_db()
+    db.execute("UPDATE trash SET deleted_at = 0 WHERE owner=?", (alice,))
+    db.commit()
+    db.close()
+    trash(a, "report-b.txt")
+
+    assert search(a, "report") == ["report-b.txt"]
+    assert search(a, "old") == []
+
+    resp = a.get("/api/download-zip?path=trash")
+    assert zip_names(resp) == ["report-b.txt"]
+
+    for path in ("trash/old", "trash/old/report-a.txt"):
+        assert a.get("/api/download-zip", query_string={"path": path}).status_code == 404
+
+
+def test_expired_trash_is_not_listed_or_counted(md, make_user):
+    alice, a = make_user()
+    for name in ("old", "new"):
+        a.post("/api/create-folder", json={"name": name, "path": ["root"]})
+        a.post("/api/create-folder", json={"name": "sub", "path": ["root", name]})
+        upload(a, "f.txt", b"abc", path=("root", name, "sub"))
+
+    trash(a, "old")
+    db = md.get_db()
+    db.execute("UPDATE trash SET deleted_at = 0 WHERE owner=?", (alice,))
+    db.commit()
+    db.close()
+    trash(a, "new")
+
+    names = [i["name"] for i in a.get("/api/list?path=trash").get_json()["items"]]
+    assert names == ["new"]
+
+    for path in ("trash/old", "trash/old/sub"):
+        assert a.get("/api/list", query_string={"path": path}).status_code == 404
+        assert a.get("/api/folder-size", query_string={"path": path}).status_code == 404
+
+    assert [i["name"] for i in a.get("/api/list?path=trash/new/sub").get_json()["items"]] == ["f.txt"]
+    assert a.get("/api/folder-size?path=trash/new").get_json()["files"] == 1
@@ -0,0 +1,145 @@
+from conftest import run_jobs, upload
+
+
+def test_initiate_picks_proxy_on_local_storage(make_user, backend):
+    _, a = make_user()
+
+    resp = a.post("/api/upload/initiate", json={"path": ["root"], "name": "a.txt", "size": 3})
+    assert resp.status_code == 200
+
+    mode = resp.get_json().get("mode")
+    assert mode == ("proxy" if backend == "local" else "post")
+
+
+def ledger(md, username):
+    db = md.get_db()
+    row = db.execute(
+        "SELECT used_bytes, reserved_bytes, linked_bytes FROM storage_usage WHERE username=?",
+        (username,)
+    ).fetchone()
+    db.close()
+    return row or (0, 0, 0)
+
+
+def test_upload_over_a_folder_name_is_refused(md, make_user):
+    alice, a = make_user()
+    assert a.post("/api/create-folder", json={"name": "docs", "path": ["root"]}).status_code == 200
+
+    resp = upload(a, "docs", b"same name as the folder")
+    assert resp.status_code == 409
+
+    items = a.get("/api/list?path=root").get_json()["items"]
+    assert [(i["name"], i["kind"]) for i in items] == [("docs", "folder")]
+    assert ledger(md, alice) == (0, 0, 0)
+
+    # what was streamed in is deleted again
+    run_jobs()
+    assert md.list_prefix_usage(alice + "/") == (0, 0)
+
+
+def test_plain_object_over_a_folder_name_is_deleted(md, make_user):
+    alice, a = make_user()
+    a.post("/api/create-folder", json={"name": "docs", "path": ["root"]})
+
+    key = md.new_object_key(alice)
+    md.s3.put_object(Bucket=md.BUCKET_NAME, Key=key, Body=b"abc")
+    assert md.reserve_storage(alice, 3)
+
+    with md.app.test_request_context():
+        resp = md.finish_upload(alice, ["root"], "docs", 3, "text/plain", key, 3)
+        assert resp[1] == 409
+
+    assert ledger(md, alice) == (0, 0, 0)
+
+    run_jobs()
+    assert md.get_object_size(key) == 0
+    assert ledger(md, alice) == (0, 0, 0)
+
+
+def test_expired_ticket_deletes_what_was_posted(md, make_user):
+    alice, a = make_user()
+
+    resp = a.post("/api/upload/initiate", json={"path": ["root"], "name": "a.txt", "size": 3})
+    key = resp.get_json()["fields"]["key"]
+    assert ledger(md, alice) == (0, 3, 0)
+
+    # the browser POSTed the file but never called /complete
+    md.s3.put_object(Bucket=md.BUCKET_NAME, Key=key, Body=b"abc")
+
+    db = md.get_db()
+    db.execute("UPDATE pending_uploads SET created = created - ?", (3 * md.PRESIGN_EXPIRY,))
+    db.commit()
+    db.close()
+
+    md.expire_pending_uploads()
+    assert ledger(md, alice) == (0, 0, 0)
+
+    run_jobs()
+    assert not md.object_exists(key)
+    assert ledger(md, alice) == (0, 0, 0)
+
+
+def test_upload_is_read_with_the_path_after_the_file(md, make_user, backend, monkeypatch):
+    alice, a = make_user()
+
+    # streamed, never spooled by Werkzeug's form parser
+    def spool(*args, **kwargs):
+        raise AssertionError("upload spooled")
+
+    monkeypatch.setattr(md.app.request_class, "_get_file_stream", spool)
+    body = backend.encode() + bytes(range(256)) * (md.UPLOAD_PART_SIZE // 256 + 1000)
+
+    # the test client sends the fields in this order: file, then path
+    resp = upload(a, "big.bin", body, path=("root", "in", "here"))
+    assert resp.status_code == 200
+
+    run_jobs()
+
+    items = a.get("/api/list?path=root/in/here").get_json()["items"]
+    assert [i["name"] for i in items] == ["big.bin"]
+
+    db = md.get_db()
+    size, key = db.execute(
+        "SELECT size, s3_key FROM nodes WHERE owner=? AND name='big.bin'", (alice,)
+    ).fetchone()
+    db.close()
+    assert size == len(body)
+    assert md.s3.get_object(Bucket=md.BUCKET_NAME, Key=key)["Body"].read() == body
+    assert ledger(md, alice) == (0, 0, len(body))
+
+
+def test_streamed_upload_of_stored_content_is_linked(md, make_user, backend):
+    alice, a = make_user()
+    bob, b = make_user()
+
+    body = b"the same bytes on " + backend.encode()
+
+    assert upload(a, "a.txt", body).status_code == 200
+    run_jobs()
+    assert upload(b, "b.txt", body).status_code == 200
+
+    # nothing of bob's own is left in storage, the file is the blob
+    assert md.list_prefix_usage(bob + "/") == (0, 0)
+
+    db = md.get_db()
+    keys = db.execute(
+        "SELECT DISTINCT s3_key FROM nodes WHERE owner IN (?, ?) AND kind='file'",
+        (alice, bob)
+    ).fetchall()
+    db.close()
+    assert len(keys) == 1
+
+
+def test_upload_without_a_path_is_refused(md, make_user):
+    import io
+
+    alice, a = make_user()
+
+    resp = a.post(
+        "/api/upload",
+        data={"file": (io.BytesIO(b"abc"), "a.txt")},
+        content_type="multipart/form-data"
+    )
+    assert resp.status_code == 400
+    assert ledger(md, alice) == (0, 0, 0)
+    assert md.list_prefix_usage(alice + "/") == (0, 0)
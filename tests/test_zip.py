@@ -0,0 +1,40 @@
+import io
+import zipfile
+
+import pytest
+
+from conftest import run_jobs, upload
+
+
+def test_zip_holds_the_folder_as_it_is(make_user, backend):
+    _, a = make_user()
+    a.post("/api/create-folder", json={"name": "docs", "path": ["root"]})
+    a.post("/api/create-folder", json={"name": "empty", "path": ["root", "docs"]})
+    first, second = b"first on " + backend.encode(), b"second" * 10000 + backend.encode()
+    upload(a, "a.txt", first, path=("root", "docs"))
+    upload(a, "b.txt", second, path=("root", "docs"))
+    run_jobs()
+
+    resp = a.get("/api/download-zip?path=root/docs")
+    assert resp.status_code == 200
+    assert resp.headers["Content-Disposition"].endswith('docs.zip"')
+
+    archive = zipfile.ZipFile(io.BytesIO(resp.data))
+    assert sorted(archive.namelist()) == ["docs/", "docs/a.txt", "docs/b.txt", "docs/empty/"]
+    assert archive.read("docs/a.txt") == first
+    assert archive.read("docs/b.txt") == second
+
+
+def test_zip_breaks_off_when_a_file_cannot_be_read(md, make_user, monkeypatch):
+    _, a = make_user()
+    upload(a, "a.txt", b"first")
+    upload(a, "b.txt", b"second")
+
+    def fail(s3_key, size):
+        raise RuntimeError("GetObject failed")
+
+    monkeypatch.setattr(md, "open_zip_member", fail)
+
+    # raised out of the response body, after the headers went out
+    with pytest.raises(RuntimeError):
+        a.get("/api/download-zip?path=root").data